@@ -0,0 +1,614 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    Benchmarks of the ATS9360 data pipeline which do not need the board.
+
+    Run from the directory containing the ATS9360 package:
+        python -m ATS9360.Benchmark transfer
+        python -m ATS9360.Benchmark processors
+        python -m ATS9360.Benchmark demodulation
+        python -m ATS9360.Benchmark stress
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import pickle
+import time
+import multiprocessing as mp
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from ATS9360.SharedMemory import RingBuffer, ControlBlock
+import ATS9360.DataTreatment as dt
+from ATS9360.Demodulation import Demodulator
+from ATS9360 import Scheduling
+
+
+
+################################################################################
+# Transfer between the acquisition and the treatment processes
+################################################################################
+
+
+
+def _produce(queue_data, buff, nb_buffers, copy):
+    """
+        Mimic the acquisition process: send nb_buffers times the buffer.
+    """
+
+    for i in range(nb_buffers):
+        if copy:
+            queue_data.put(np.copy(buff))
+        else:
+            queue_data.put(buff)
+
+
+
+def _consume(queue_data, nb_buffers, elapsed):
+    """
+        Mimic the treatment process: receive nb_buffers buffers and read
+        their first sample.
+    """
+
+    start = time.time()
+    for i in range(nb_buffers):
+        data = queue_data.get()
+        data[0]
+    elapsed.value = time.time() - start
+
+
+
+def transfer_throughput(transfer, samples_per_buffer, nb_buffers, nb_slots=16):
+    """
+        Measure the rate at which buffers go from one process to another.
+
+        Input:
+            - transfer (string): "queue" or "shared_memory"
+            - samples_per_buffer (int): number of uint16 samples per buffer
+            - nb_buffers (int): number of transferred buffers
+            - nb_slots (int): number of slots of the shared memory ring
+
+        Output:
+            - rate (float): transfer rate in MS/s
+    """
+
+    if transfer == 'queue':
+        queue_data = mp.Queue()
+    elif transfer == 'shared_memory':
+        queue_data = RingBuffer(nb_slots, samples_per_buffer)
+    else:
+        raise ValueError('transfer must be "queue" or "shared_memory"')
+
+    buff    = np.random.randint(0, 2**16, samples_per_buffer).astype(np.uint16)
+    elapsed = mp.Value('d', 0.)
+
+    producer = mp.Process(target=_produce,
+                          args=(queue_data, buff, nb_buffers, transfer == 'queue'))
+    consumer = mp.Process(target=_consume,
+                          args=(queue_data, nb_buffers, elapsed))
+
+    consumer.start()
+    producer.start()
+    producer.join()
+    consumer.join()
+
+    return samples_per_buffer*nb_buffers/elapsed.value/1e6
+
+
+
+def compare_transfer(samplesPerRecord=128*80, records_per_buffer=250,
+                     nb_buffers=200, nb_slots=16):
+    """
+        Compare the transfer rate of the multiprocessing queue and of the
+        shared memory ring for buffers of the given geometry.
+        Return a dictionnary {transfer: rate in MS/s}.
+    """
+
+    samples_per_buffer = samplesPerRecord*records_per_buffer
+
+    print('Transfer of %d buffers of %d records x %d samples (%.1f MB)'\
+          % (nb_buffers, records_per_buffer, samplesPerRecord,
+             samples_per_buffer*2/1024**2))
+
+    rates = {}
+    for transfer in ('queue', 'shared_memory'):
+        rates[transfer] = transfer_throughput(transfer, samples_per_buffer,
+                                              nb_buffers, nb_slots)
+        print('    %-14s %10.1f MS/s' % (transfer, rates[transfer]))
+
+    print('    speedup        %10.2f' % (rates['shared_memory']/rates['queue']))
+
+    return rates
+
+
+
+################################################################################
+# Data treatment processors
+################################################################################
+
+
+
+# Intermediate frequency of the synthetic signal in Hz
+IF_FREQUENCY = 50e6
+
+def _float32(processor):
+    """
+        Set the processor to treat the data in V in float32.
+    """
+
+    processor.dtype = np.float32
+
+    return processor
+
+
+
+# Factories of the benchmarked processors.
+# Each one takes (acquisition_time [s], samplerate [S/s], nb_sequence).
+# The processors converting the data in V are also benchmarked in float32.
+# SweepRealImag averages 10 records per point when it can.
+# SeveralRealImagPerSequence is not benchmarked since it cannot be
+# instantiated yet.
+PROCESSORS = {
+    'Raw'                         : lambda t, sr, n: dt.Raw(),
+    'Average'                     : lambda t, sr, n: dt.Average(),
+    'Average_time'                : lambda t, sr, n: dt.Average_time(),
+    'Average_time_adaptive'       : lambda t, sr, n: dt.Average_time(noise_floor=0.),
+    'AmplitudePhase'              : lambda t, sr, n: dt.AmplitudePhase(t, sr, IF_FREQUENCY),
+    'DBPhase'                     : lambda t, sr, n: dt.DBPhase(t, sr, IF_FREQUENCY, -30.),
+    'RealImag'                    : lambda t, sr, n: dt.RealImag(t, sr, IF_FREQUENCY),
+    'AmplitudePhasePerSequence'   : lambda t, sr, n: dt.AmplitudePhasePerSequence(t, sr, IF_FREQUENCY, n),
+    'AmplitudePhasePerSequencedB' : lambda t, sr, n: dt.AmplitudePhasePerSequencedB(t, sr, IF_FREQUENCY, -30.),
+    'RealImagPerSequence'         : lambda t, sr, n: dt.RealImagPerSequence(t, sr, IF_FREQUENCY),
+    'RealImag_raw'                : lambda t, sr, n: dt.RealImag_raw(t, sr, IF_FREQUENCY),
+    'SweepRealImag'               : lambda t, sr, n: dt.SweepRealImag(t, sr, IF_FREQUENCY, n if n % 10 else n//10),
+    'Average_IQ'                  : lambda t, sr, n: dt.Average_IQ(t, sr, IF_FREQUENCY, 10e6),
+    'IQHistogram'                 : lambda t, sr, n: dt.IQHistogram(t, sr, IF_FREQUENCY, (-0.2, 0.2), (-0.2, 0.2), 100, (0., 0.)),
+    'MultiTone'                   : lambda t, sr, n: dt.MultiTone(t, sr, IF_FREQUENCY + 5e6*np.arange(8)),
+    'MultiTone_raw'               : lambda t, sr, n: dt.MultiTone(t, sr, IF_FREQUENCY + 5e6*np.arange(8), raw=True),
+    'RealImagPerSequence_reset'   : lambda t, sr, n: dt.RealImagPerSequence_reset(t, sr, IF_FREQUENCY),
+    'HomodyneRealImagPerSequence' : lambda t, sr, n: dt.HomodyneRealImagPerSequence(t/2., sr, t/8.),
+    'HomodyneRealImag_raw'        : lambda t, sr, n: dt.HomodyneRealImag_raw(t/2., sr, t/8.),
+    'HomodyneRealImag_raw_sevRO'  : lambda t, sr, n: dt.HomodyneRealImag_raw_sevRO(t/4., 0., t/4., t/2., sr, t/8.),
+    'HomodyneRealImag_Nraw'       : lambda t, sr, n: dt.HomodyneRealImag_Nraw(t/4., sr, t/8., 2),
+    'Homodyne_Tchebytchev'        : lambda t, sr, n: dt.Homodyne_Tchebytchev(t, sr, 10e6, 40., 4, True),
+    'HomodyneRealImagPerSequenceWeighted' : lambda t, sr, n: dt.HomodyneRealImagPerSequenceWeighted(t, t/2., sr, t/8., t/20.),
+    'HomodyneRealImag_rawWeighted'        : lambda t, sr, n: dt.HomodyneRealImag_rawWeighted(t, t/2., sr, t/8., t/20.),
+    'HomodyneRealImag_raw_sevROWeighted'  : lambda t, sr, n: dt.HomodyneRealImag_raw_sevROWeighted(t, t/4., 0., t/4., t/2., sr, t/8., t/20.),
+    'HomodyneRealImagPerSequence_float32' : lambda t, sr, n: _float32(dt.HomodyneRealImagPerSequence(t/2., sr, t/8.)),
+    'HomodyneRealImag_raw_float32'        : lambda t, sr, n: _float32(dt.HomodyneRealImag_raw(t/2., sr, t/8.)),
+    'HomodyneRealImag_raw_sevRO_float32'  : lambda t, sr, n: _float32(dt.HomodyneRealImag_raw_sevRO(t/4., 0., t/4., t/2., sr, t/8.)),
+    'HomodyneRealImag_Nraw_float32'       : lambda t, sr, n: _float32(dt.HomodyneRealImag_Nraw(t/4., sr, t/8., 2)),
+    'HomodyneRealImagPerSequenceWeighted_float32' : lambda t, sr, n: _float32(dt.HomodyneRealImagPerSequenceWeighted(t, t/2., sr, t/8., t/20.)),
+    'HomodyneRealImag_rawWeighted_float32'        : lambda t, sr, n: _float32(dt.HomodyneRealImag_rawWeighted(t, t/2., sr, t/8., t/20.)),
+    'HomodyneRealImag_raw_sevROWeighted_float32'  : lambda t, sr, n: _float32(dt.HomodyneRealImag_raw_sevROWeighted(t, t/4., 0., t/4., t/2., sr, t/8., t/20.)),
+    'HomodyneMatchedFilter'               : lambda t, sr, n: dt.HomodyneMatchedFilter(np.hanning(int(t*sr))),
+    'HomodyneMatchedFilter_raw'           : lambda t, sr, n: dt.HomodyneMatchedFilter(np.hanning(int(t*sr)), raw=True),
+    'PowerSpectrum'                       : lambda t, sr, n: dt.PowerSpectrum(),
+    }
+
+
+
+class _BufferSource(object):
+    """
+        Stand-in for the data queue of a treatment process.
+        Deliver nb_buffers synthetic buffers, then None, and record when each
+        one is asked for.
+    """
+
+    def __init__(self, samples_per_buffer, samplerate, nb_buffers):
+
+        # Synthetic buffers, uint16 with the 12 bits code in the MSB
+        random = np.random.RandomState(0)
+        time_buffer = np.arange(samples_per_buffer)/samplerate
+        self.buffers = []
+        for i in range(2):
+            signal = 0.1*np.cos(2.*np.pi*IF_FREQUENCY*time_buffer)\
+                     + 0.02*random.randn(samples_per_buffer)
+            code   = np.clip(np.round(signal*2047.5/0.4 + 2047.5), 0, 4095)
+            self.buffers.append(code.astype(np.uint16) << 4)
+
+        self.nb_buffers = nb_buffers
+        self.times = []
+
+    def get(self):
+
+        self.times.append(time.time())
+        if len(self.times) > self.nb_buffers:
+            return None
+
+        return self.buffers[len(self.times) % 2]
+
+    def close(self):
+
+        pass
+
+
+
+class _ResultSink(object):
+    """
+        Stand-in for the treatment queue of a treatment process.
+        Results are pickled as a multiprocessing queue would do.
+    """
+
+    def put(self, result):
+
+        pickle.dumps(result, -1)
+
+    def close(self):
+
+        pass
+
+
+
+def _peak_rss():
+    """
+        Peak resident memory of the current process in MB, None if unknown.
+    """
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+
+def _treat(name, samplesPerRecord, nb_sequence, records_per_buffer,
+           nb_buffers, samplerate, queue_result):
+    """
+        Run treat_data of the processor on synthetic buffers and send the
+        performance figures in queue_result.
+    """
+
+    processor = PROCESSORS[name](samplesPerRecord/samplerate, samplerate,
+                                 nb_sequence)
+
+    parameters = {'samplesPerRecord'        : samplesPerRecord,
+                  'records_per_buffer'      : records_per_buffer,
+                  'buffers_per_acquisition' : nb_buffers,
+                  'nb_sequence'             : nb_sequence,
+                  'nb_workers'              : 1,
+                  'samplerate'              : samplerate/1e6,
+                  'fft_format'              : 'U16_AMP2'}
+
+    source = _BufferSource(samplesPerRecord*records_per_buffer, samplerate,
+                           nb_buffers)
+
+    processor.treat_data(source, _ResultSink(), parameters, ControlBlock())
+
+    # The raw data are stored in a file
+    if isinstance(processor, dt.Raw):
+        del processor.data
+        os.remove(processor.filename)
+
+    latencies = np.diff(source.times)
+
+    queue_result.put({'rate'     : samplesPerRecord*records_per_buffer\
+                                   *nb_buffers/np.sum(latencies)/1e6,
+                      'latency'  : np.percentile(latencies, [50., 90., 99.])*1e3,
+                      'peak_rss' : _peak_rss()})
+
+
+
+def processor_throughput(name, samplesPerRecord, nb_sequence,
+                         records_per_buffer, nb_buffers, samplerate=1e9,
+                         cpus=None, priority=None):
+    """
+        Measure the treatment rate of one processor.
+        The treatment runs in a new process so that its peak memory is
+        measured independently of the other benchmarks.
+
+        Input:
+            - name (string): key of PROCESSORS
+            - samplesPerRecord (int): number of samples per record
+            - nb_sequence (int): number of sequences
+            - records_per_buffer (int): number of records per buffer
+            - nb_buffers (int): number of treated buffers
+            - samplerate (float): samplerate in S/s
+            - cpus (list): CPUs the treatment process is pinned on, None to
+              leave it to the system
+            - priority (string): scheduling priority of the treatment
+              process, see the Scheduling module, None for the normal one
+
+        Output:
+            - result (dict): 'rate' treatment rate in MS/s,
+              'latency' 50, 90 and 99 percentiles of the treatment time of a
+              buffer in ms, 'peak_rss' peak memory of the process in MB.
+    """
+
+    queue_result = mp.Queue()
+    worker = mp.Process(target=_treat,
+                        args=(name, samplesPerRecord, nb_sequence,
+                              records_per_buffer, nb_buffers, samplerate,
+                              queue_result))
+    worker.start()
+
+    if cpus is not None:
+        Scheduling.set_affinity(worker.pid, cpus)
+    if priority is not None:
+        Scheduling.set_priority(worker.pid, priority)
+
+    result = queue_result.get()
+    worker.join()
+
+    return result
+
+
+
+def benchmark_processors(names=None, samplesPerRecords=(1024, 10240),
+                         nb_sequences=(1, 250), records_per_buffers=(250,),
+                         nb_buffers=(20,), samplerate=1e9, trigger_rate=None):
+    """
+        Benchmark the processors over a grid of acquisition geometries.
+
+        A configuration is flagged "DROP" when its treatment rate is lower
+        than the rate at which one channel of the board produces samples:
+        samplesPerRecord*trigger_rate, or the samplerate if the trigger rate
+        is not given.
+
+        Output:
+            - results (list): one dictionnary per benchmarked configuration
+    """
+
+    if names is None:
+        names = sorted(PROCESSORS)
+
+    print('%-36s %7s %5s %5s %5s %9s %8s %8s %8s %8s' \
+          % ('processor', 'S/rec', 'seq', 'rec/b', 'buf', 'MS/s',
+             'p50 ms', 'p90 ms', 'p99 ms', 'RSS MB'))
+
+    results = []
+    for name in names:
+        for samplesPerRecord in samplesPerRecords:
+            for nb_sequence in nb_sequences:
+                for records_per_buffer in records_per_buffers:
+                    for nb_buffer in nb_buffers:
+
+                        result = processor_throughput(name, samplesPerRecord,
+                                                      nb_sequence,
+                                                      records_per_buffer,
+                                                      nb_buffer, samplerate)
+
+                        if trigger_rate is None:
+                            required_rate = samplerate/1e6
+                        else:
+                            required_rate = samplesPerRecord*trigger_rate/1e6
+
+                        result.update({'processor'          : name,
+                                       'samplesPerRecord'   : samplesPerRecord,
+                                       'nb_sequence'        : nb_sequence,
+                                       'records_per_buffer' : records_per_buffer,
+                                       'nb_buffers'         : nb_buffer,
+                                       'drop'               : result['rate'] < required_rate})
+                        results.append(result)
+
+                        print('%-36s %7d %5d %5d %5d %9.1f %8.2f %8.2f %8.2f %8s %s' \
+                              % ((name, samplesPerRecord, nb_sequence,
+                                  records_per_buffer, nb_buffer, result['rate'])
+                                 + tuple(result['latency'])
+                                 + ('-' if result['peak_rss'] is None
+                                    else '%.0f' % result['peak_rss'],
+                                    'DROP' if result['drop'] else '')))
+
+    return results
+
+
+
+################################################################################
+# Treatment under a background load
+################################################################################
+
+
+
+def _load(stop):
+    """
+        Mimic the GUI and the plots: keep a core busy until stop is set.
+    """
+
+    data = np.random.rand(512, 512)
+    while not stop.is_set():
+        np.dot(data, data)
+
+
+
+def benchmark_stress(name='RealImagPerSequence', nb_load=None, cpus=None,
+                     priority='high', samplesPerRecord=1024, nb_sequence=250,
+                     records_per_buffer=250, nb_buffers=200, samplerate=1e9):
+    """
+        Compare the sustained buffer rate of a treatment process while
+        nb_load processes keep the cores busy, left to the system and pinned
+        on cpus with the priority.
+        The load processes are left to the system as a GUI would be.
+
+        Input:
+            - name (string): key of PROCESSORS
+            - nb_load (int): number of load processes, one per CPU by default
+            - cpus (list): CPUs of the treatment process, the last one by
+              default
+            - priority (string): "high", "realtime" or None, see the
+              Scheduling module
+
+        Output:
+            - results (dict): {configuration: result of processor_throughput
+              with 'buffer_rate' the number of buffers treated per second}
+    """
+
+    if nb_load is None:
+        nb_load = mp.cpu_count()
+
+    if cpus is None:
+        cpus = [mp.cpu_count() - 1]
+
+    configurations = (('idle',             0,       None, None),
+                      ('load',             nb_load, None, None),
+                      ('load, scheduled',  nb_load, cpus, priority))
+
+    print('%s, %d records x %d samples per buffer, %d load processes, '\
+          'CPUs %s, priority %s' % (name, records_per_buffer,
+                                    samplesPerRecord, nb_load, cpus, priority))
+    print('%-18s %9s %9s %8s %8s %8s' % ('', 'MS/s', 'buffer/s', 'p50 ms',
+                                         'p90 ms', 'p99 ms'))
+
+    results = {}
+    for configuration, nb_process, pinned_cpus, process_priority\
+        in configurations:
+
+        stop = mp.Event()
+        loads = [mp.Process(target=_load, args=(stop,))
+                 for i in range(nb_process)]
+        for load in loads:
+            load.start()
+
+        try:
+            result = processor_throughput(name, samplesPerRecord,
+                                          nb_sequence, records_per_buffer,
+                                          nb_buffers, samplerate,
+                                          pinned_cpus, process_priority)
+        finally:
+            stop.set()
+            for load in loads:
+                load.join()
+
+        result['buffer_rate'] = result['rate']*1e6\
+                                /(samplesPerRecord*records_per_buffer)
+        results[configuration] = result
+
+        print('%-18s %9.1f %9.1f %8.2f %8.2f %8.2f' \
+              % ((configuration, result['rate'], result['buffer_rate'])
+                 + tuple(result['latency'])))
+
+    return results
+
+
+
+################################################################################
+# Demodulation kernel
+################################################################################
+
+
+
+def _demodulate_mean(data, cos, sin):
+    """
+        Demodulation as the processors did before the Demodulator.
+    """
+
+    data = dt.DataTreatment.data_in_volt(data)
+
+    real = 2.*np.mean(data*cos, axis=1)
+    imag = 2.*np.mean(data*sin, axis=1)
+
+    return real, imag
+
+
+
+def benchmark_demodulation(samplesPerRecords=(128, 1024, 10240),
+                           records_per_buffer=250, repeat=20, samplerate=1e9):
+    """
+        Compare the time to demodulate one buffer by the cos, sin products
+        and by the Demodulator.
+
+        Output:
+            - results (list): one dictionnary per benchmarked geometry with
+              the times in ms and the largest relative difference of the
+              real parts.
+    """
+
+    print('%7s %5s %10s %10s %8s %9s' \
+          % ('S/rec', 'rec/b', 'mean ms', 'gemm ms', 'speedup', 'rel diff'))
+
+    results = []
+    for samplesPerRecord in samplesPerRecords:
+
+        source = _BufferSource(samplesPerRecord*records_per_buffer,
+                               samplerate, 0)
+        data = source.buffers[0].reshape(records_per_buffer, -1)
+
+        demodulator = Demodulator(samplesPerRecord, samplerate, IF_FREQUENCY)
+
+        timings = []
+        for demodulate in (lambda: _demodulate_mean(data, demodulator.cos,
+                                                    demodulator.sin),
+                           lambda: demodulator.demodulate(data)):
+            demodulate()
+            start = time.time()
+            for i in range(repeat):
+                real, imag = demodulate()
+            timings.append((time.time() - start)/repeat*1e3)
+            result = real
+
+        reference = _demodulate_mean(data, demodulator.cos, demodulator.sin)[0]
+
+        results.append({'samplesPerRecord'   : samplesPerRecord,
+                        'records_per_buffer' : records_per_buffer,
+                        'mean'               : timings[0],
+                        'gemm'               : timings[1],
+                        'difference'         : np.max(np.abs(result - reference))\
+                                               /np.max(np.abs(reference))})
+
+        print('%7d %5d %10.3f %10.3f %8.1f %9.1e' \
+              % (samplesPerRecord, records_per_buffer, timings[0], timings[1],
+                 timings[0]/timings[1], results[-1]['difference']))
+
+    return results
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the ATS9360 '
+                                                 'data pipeline')
+    parser.add_argument('benchmark', choices=('transfer', 'processors',
+                                              'demodulation', 'stress'))
+    parser.add_argument('--processors', nargs='+', default=None,
+                        help='processors to benchmark (default: all)')
+    parser.add_argument('--samplerate', type=float, default=1e9,
+                        help='samplerate in S/s')
+    parser.add_argument('--trigger-rate', type=float, default=None,
+                        help='trigger rate in Hz')
+    parser.add_argument('--load', type=int, default=None,
+                        help='number of load processes of the stress '
+                             'benchmark (default: one per CPU)')
+    parser.add_argument('--cpus', type=int, nargs='+', default=None,
+                        help='CPUs of the treatment process of the stress '
+                             'benchmark (default: the last one)')
+    parser.add_argument('--priority', choices=('high', 'realtime', 'none'),
+                        default='high',
+                        help='priority of the treatment process of the '
+                             'stress benchmark')
+    args = parser.parse_args()
+
+    if args.benchmark == 'transfer':
+        compare_transfer()
+    elif args.benchmark == 'demodulation':
+        benchmark_demodulation(samplerate=args.samplerate)
+    elif args.benchmark == 'stress':
+        benchmark_stress(args.processors[0] if args.processors
+                         else 'RealImagPerSequence', args.load, args.cpus,
+                         None if args.priority == 'none' else args.priority,
+                         samplerate=args.samplerate)
+    else:
+        benchmark_processors(args.processors, samplerate=args.samplerate,
+                             trigger_rate=args.trigger_rate)
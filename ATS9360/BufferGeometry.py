@@ -0,0 +1,123 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    Choice of the geometry of the DMA buffers.
+
+    Each buffer costs a DMA transfer, a transfer to a treatment process and a
+    call of the processor: small buffers spend their time in these overheads
+    while very large buffers delay the results and waste memory. The number
+    of records per buffer is chosen so that a buffer holds a few MB.
+    The buffers must stay aligned on the sequences: a buffer holds an
+    integer number of sequences or, when a sequence is too large, an integer
+    fraction of it. The number of averages is kept when possible, otherwise
+    it is rounded up as little as possible.
+"""
+
+from __future__ import division
+import numpy as np
+
+
+def optimal_geometry(record_bytes, nb_sequence, nb_averaging,
+                     target_bytes=4*1024**2, min_bytes=1024**2,
+                     max_bytes=16*1024**2, allocated_bytes=64*1024**2):
+    """
+        Return the geometry of the DMA buffers of an acquisition.
+
+        Input:
+            - record_bytes (int): size of a record in bytes, all the
+              acquired channels included.
+            - nb_sequence (int): number of records of a sequence
+            - nb_averaging (int): number of averages of each sequence
+            - target_bytes (int): preferred size of a buffer
+            - min_bytes, max_bytes (int): range of the size of a buffer.
+              A smaller buffer is only used when the whole acquisition is
+              smaller, a buffer is never larger except for a single record.
+            - allocated_bytes (int): size of the DMA buffers allocated
+              together, between 4 and 64 buffers are allocated but not more
+              than the acquired ones.
+
+        Output:
+            - geometry (dict):
+                'records_per_buffer' (int)
+                'buffers_per_acquisition' (int)
+                'nb_buffer_allocated' (int)
+                'buffer_bytes' (int): size of a buffer
+                'nb_averaging' (int): number of averages acquired, larger
+                    than the requested one if it has been rounded up
+    """
+
+    record_bytes = int(record_bytes)
+    nb_sequence  = int(nb_sequence)
+    nb_averaging = int(nb_averaging)
+
+    if record_bytes < 1 or nb_sequence < 1 or nb_averaging < 1:
+        raise ValueError('The record size, the number of sequence and the '\
+                         'averaging must be larger than 1')
+
+    sequence_bytes = record_bytes*nb_sequence
+
+    if sequence_bytes > max_bytes:
+
+        # A sequence is shared between several buffers, each one holding the
+        # same fraction of it
+        divisors = np.array([divisor for divisor in range(1, nb_sequence + 1)
+                             if nb_sequence % divisor == 0
+                             and divisor*record_bytes <= max_bytes] or [1])
+
+        distance = np.abs(np.log(divisors*record_bytes/target_bytes))
+
+        records_per_buffer      = int(divisors[np.argmin(distance)])
+        buffers_per_acquisition = nb_averaging*nb_sequence//records_per_buffer
+        acquired_averaging      = nb_averaging
+
+    else:
+
+        # Number of sequences per buffer
+        sequences = np.arange(1, min(max_bytes//sequence_bytes,
+                                     nb_averaging) + 1)
+
+        buffers = -(-nb_averaging//sequences)
+        extra   = buffers*sequences - nb_averaging
+        size    = sequences*sequence_bytes
+
+        # Smaller buffers are only used if no larger one is possible
+        window = size >= min(min_bytes, size[-1])
+
+        # The averaging is kept first, then the buffer size closest to the
+        # target is taken
+        distance = np.abs(np.log(size/target_bytes))
+        order    = np.lexsort((distance, extra, ~window))
+        best     = order[0]
+
+        records_per_buffer      = int(sequences[best])*nb_sequence
+        buffers_per_acquisition = int(buffers[best])
+        acquired_averaging      = nb_averaging + int(extra[best])
+
+    buffer_bytes = records_per_buffer*record_bytes
+
+    # More buffers than acquired are not allocated, at least 4 are posted to
+    # the board as usual
+    nb_buffer_allocated = min(int(np.clip(allocated_bytes//buffer_bytes, 4, 64)),
+                              max(buffers_per_acquisition, 4))
+
+    return {'records_per_buffer'      : records_per_buffer,
+            'buffers_per_acquisition' : buffers_per_acquisition,
+            'nb_buffer_allocated'     : nb_buffer_allocated,
+            'buffer_bytes'            : buffer_bytes,
+            'nb_averaging'            : acquired_averaging}
@@ -20,9 +20,224 @@ from __future__ import division
 import ctypes
 import numpy as np
 import time
-import atsapi as ats
 
-windowType = ats.DSP_WINDOW_HAMMING
+try:
+    import atsapi as ats
+except OSError:
+    # Without the AlazarTech library, only the simulated board can be used
+    import SimulatedBoard as ats
+
+import SimulatedBoard
+
+# Parameters applied together on the board, see DataAcquisition.run_session
+BOARD_PARAMETERS    = ('simulation', 'nb_boards')
+CLOCK_PARAMETERS    = ('samplerate', 'clock_source', 'clock_edge')
+TRIGGER_PARAMETERS  = ('samplerate', 'trigger_range', 'trigger_slope',
+                       'trigger_level', 'trigger_delay')
+GEOMETRY_PARAMETERS = ('mode', 'samplesPerRecord', 'records_per_buffer',
+                       'nb_buffer_allocated', 'hardware_averaging',
+                       'fft_format')
+
+
+class BufferMonitor(object):
+    """
+        Statistics of the buffers of an acquisition, updated by the
+        acquisition process for each completed buffer:
+            - the interval between the completion of successive buffers, its
+              mean, standard deviation (the jitter) and maximum in second,
+            - with the record footers, the records lost between buffers, seen
+              as gaps in the record numbers, and the missed triggers, seen as
+              intervals between trigger timestamps longer than 1.5 trigger
+              period. The trigger period, in timestamp counts, is the median
+              interval between the triggers of the first buffer.
+            - if the transfer stopped on a DMA overflow.
+        The statistics are accumulated so that their cost does not depend on
+        the number of buffers.
+    """
+
+    # Size of the footer at the end of each record
+    footer_bytes = 16
+
+    # Samples added to each record to hold its footer, the record length
+    # being a multiple of 128 samples, see DataAcquisition.prepare_acquisition
+    footer_samples = 128
+
+
+
+    def __init__(self, board, buffers, parameters):
+        """
+            Input:
+                - board: board prepared for the acquisition
+                - buffers (list): its DMA buffers
+                - parameters (dict): parameters of the acquisition, the
+                  footers are read if parameters['footers'] is True.
+        """
+
+        self.board = board
+
+        self.nb_intervals  = 0
+        self.interval_sum  = 0.
+        self.square_sum    = 0.
+        self.interval_max  = 0.
+        self.overflow      = False
+        self._last_time    = None
+
+        self.footers = parameters['footers']
+        if not self.footers:
+            return
+
+        recordsPerBuffer = parameters['records_per_buffer']
+
+        # Words of a record given to the treatment, the samples of the
+        # channels alternating in CHANNEL_AB
+        if parameters['mode'] == 'CHANNEL_AB':
+            self.record_words = 2*parameters['samplesPerRecord']
+        else:
+            self.record_words = parameters['samplesPerRecord']
+
+        # The simulated board writes its own footers
+        if isinstance(board, SimulatedBoard.Board):
+            self._module = SimulatedBoard
+        else:
+            self._module = ats
+
+        self.recordSize_bytes = buffers[0].size_bytes//recordsPerBuffer
+        self._footers = (self._module.NPTFooter*recordsPerBuffer)()
+
+        # Numpy view of the fields of the footers used for the statistics
+        footer = self._module.NPTFooter
+        dtype  = np.dtype({'names'    : ['trigger_timestamp', 'record_number'],
+                           'formats'  : ['<u8', '<u4'],
+                           'offsets'  : [footer.trigger_timestamp.offset,
+                                         footer.record_number.offset],
+                           'itemsize' : ctypes.sizeof(footer)})
+        self._view = np.frombuffer(self._footers, dtype=dtype)
+
+        self.dropped_records = 0
+        self.missed_triggers = 0
+        self.trigger_period  = None
+        self._last_record    = None
+        self._last_timestamp = None
+
+
+
+    def buffer_completed(self, buff):
+        """
+            Update the statistics with the buffer which has just been filled
+            by the board.
+        """
+
+        now = time.time()
+        if self._last_time is not None:
+            interval = now - self._last_time
+            self.nb_intervals += 1
+            self.interval_sum += interval
+            self.square_sum   += interval**2.
+            self.interval_max  = max(self.interval_max, interval)
+        self._last_time = now
+
+        if not self.footers:
+            return
+
+        self._module.extractNPTFooters(buff.addr, self.recordSize_bytes,
+                                       buff.size_bytes, self._footers,
+                                       len(self._footers))
+
+        records    = self._view['record_number'].astype(np.int64)
+        timestamps = self._view['trigger_timestamp'].astype(np.int64)
+
+        if self._last_record is not None:
+            records    = np.concatenate(([self._last_record], records))
+            timestamps = np.concatenate(([self._last_timestamp], timestamps))
+
+        self.dropped_records += int(np.sum(np.diff(records) - 1))
+
+        intervals = np.diff(timestamps)
+        if self.trigger_period is None and intervals.size:
+            self.trigger_period = float(np.median(intervals))
+
+        if self.trigger_period:
+            gaps = intervals[intervals > 1.5*self.trigger_period]
+            self.missed_triggers += int(np.sum(np.round(gaps/self.trigger_period) - 1))
+
+        self._last_record    = records[-1]
+        self._last_timestamp = timestamps[-1]
+
+
+
+    def records(self, data):
+        """
+            Return the samples of the buffer data given to the treatment.
+            With the footers, a view of the requested samples of the records,
+            shape (records, samples), without the samples added to hold the
+            footers. Otherwise data itself.
+        """
+
+        if not self.footers:
+            return data
+
+        return data.reshape(len(self._footers), -1)[:, :self.record_words]
+
+
+
+    def status(self):
+        """
+            Return the statistics as fields of the acquisition status of a
+            ControlBlock. Without footers, the fields depending on them are
+            -1.
+        """
+
+        if self.nb_intervals:
+            mean = self.interval_sum/self.nb_intervals
+            std  = np.sqrt(max(self.square_sum/self.nb_intervals - mean**2., 0.))
+        else:
+            mean = 0.
+            std  = 0.
+
+        status = {'buffer_interval_mean' : mean,
+                  'buffer_interval_std'  : std,
+                  'buffer_interval_max'  : self.interval_max,
+                  'overflow'             : float(self.overflow),
+                  'dropped_records'      : -1.,
+                  'missed_triggers'      : -1.,
+                  'trigger_period'       : -1.}
+
+        if self.footers:
+            status['dropped_records'] = self.dropped_records
+            status['missed_triggers'] = self.missed_triggers
+            if self.trigger_period is not None:
+                status['trigger_period'] = self.trigger_period
+
+        return status
+
+
+
+    @staticmethod
+    def merge(monitors):
+        """
+            Return the statistics of the boards of a system as a single
+            acquisition status: the interval statistics of the slowest board,
+            the records lost and the triggers missed by all the boards, the
+            overflow of any board and the boards which overflowed.
+        """
+
+        statuses = [monitor.status() for monitor in monitors]
+        status   = dict(statuses[0])
+
+        # Bit b is set when the transfer of the board b + 1 overflowed
+        status['overflow_boards'] = float(sum(2**index for index, monitor
+                                              in enumerate(monitors)
+                                              if monitor.overflow))
+
+        for other in statuses[1:]:
+            for field in ('buffer_interval_mean', 'buffer_interval_std',
+                          'buffer_interval_max', 'overflow'):
+                status[field] = max(status[field], other[field])
+            for field in ('dropped_records', 'missed_triggers'):
+                if other[field] >= 0:
+                    status[field] += other[field]
+
+        return status
 
 
 class DataAcquisition(object):
@@ -33,6 +248,14 @@ class DataAcquisition(object):
 
 
 
+    def __init__(self):
+
+        # Windows of the on-FPGA FFT by (window, samplesPerRecord,
+        # fftLength_samples), see fft_window
+        self._fft_windows = {}
+
+
+
     def set_clock(self, board, parameters):
         '''Set the clock of the board.
             The method uses all clock attribut to set the clock.
@@ -168,10 +391,13 @@ class DataAcquisition(object):
 
 
 
-    def prepare_acquisition(self, board, parameters):
+    def prepare_acquisition(self, board, parameters, buffers=None):
         """
             Prepare the DMA buffers for the board.
             Return a list of buffers
+
+            If buffers is given, the DMA buffers of a previous acquisition
+            with the same geometry are reused instead of being allocated.
         """
 
         samplesPerSec         = parameters['samplerate']*1e6
@@ -180,6 +406,12 @@ class DataAcquisition(object):
         preTriggerSamples     = 0
         postTriggerSamples    = parameters['samplesPerRecord']
 
+        # The footer takes the last 16 bytes of each record, the records are
+        # lengthened so that the treatment receives the requested samples,
+        # see BufferMonitor.records
+        if parameters['footers']:
+            postTriggerSamples += BufferMonitor.footer_samples
+
         # Select the number of records per DMA buffer.
         recordsPerBuffer      = parameters['records_per_buffer']
 
@@ -225,23 +457,23 @@ class DataAcquisition(object):
             while fftLength_samples < samplesPerRecord :
                 fftLength_samples *= 2
 
-            # Sets the real part of the FFT windowing
-            fft_window_real=ats.dspGenerateWindowFunction(windowType, samplesPerRecord, fftLength_samples - samplesPerRecord)
-
-            # According to the documentation, the imaginary part of the FFT windowing should be filled with zeros
-            fft_window_imag=ats.dspGenerateWindowFunction(windowType, 0, fftLength_samples - samplesPerRecord)
+            fft_window_real, fft_window_imag = self.fft_window(parameters['fft_window'],
+                                                              samplesPerRecord,
+                                                              fftLength_samples)
 
             # Configures the FFT window
             fft_module.fftSetWindowFunction(samplesPerRecord,ctypes.c_void_p(fft_window_real.ctypes.data),ctypes.c_void_p(fft_window_imag.ctypes.data))
 
             # Compute the number of bytes per record and per buffer
 
-            # For now the output of the output of the on-FPGA FFT is set to 'FFT_OUTPUT_FORMAT_U16_AMP2',
-            # thus the number of bytes per sample is 2
+            # Whatever the output format of the on-FPGA FFT, the DMA buffers
+            # are transferred as 16 bits words, the treatment reads them in
+            # the output format, see DataTreatment.PowerSpectrum
             bytesPerSample = 2
 
             # Computes the number of bytes per record according to the settings of the on-FPGA FFT
-            bytesPerRecord=fft_module.fftSetup(channels, samplesPerRecord, fftLength_samples, ats.FFT_OUTPUT_FORMAT_U16_AMP2, ats.FFT_FOOTER_NONE,0)
+            outputFormat   = getattr(ats, 'FFT_OUTPUT_FORMAT_'+parameters['fft_format'])
+            bytesPerRecord = fft_module.fftSetup(channels, samplesPerRecord, fftLength_samples, outputFormat, ats.FFT_FOOTER_NONE,0)
 
             bytesPerBuffer   = bytesPerRecord * recordsPerBuffer
 
@@ -257,6 +489,11 @@ class DataAcquisition(object):
             memorySize_samples, bitsPerSample = board.getChannelInfo()
             bytesPerSample   = (bitsPerSample.value + 7) // 8
 
+            # With the on-board record averaging, the board transfers the sum
+            # of the sample codes of the averaged records in 32 bits
+            if parameters['hardware_averaging'] > 1:
+                bytesPerSample = 4
+
             bytesPerRecord   = bytesPerSample * samplesPerRecord
             bytesPerBuffer   = bytesPerRecord * recordsPerBuffer * channelCount
             # change made by Remy the 2018/06/21
@@ -264,6 +501,10 @@ class DataAcquisition(object):
             # before it was:
             # parameters['samplesPerRecord'] = bytesPerRecord/bytesPerSample
 
+            # The samples holding the footers are not given to the treatment
+            if parameters['footers']:
+                parameters['samplesPerRecord'] -= BufferMonitor.footer_samples
+
         # Select number of DMA buffers to allocate
         bufferCount = parameters['nb_buffer_allocated']
 
@@ -273,19 +514,45 @@ class DataAcquisition(object):
 
         # Allocate DMA buffers
         sample_type = ctypes.c_uint8
-        if bytesPerSample > 1:
+        if bytesPerSample > 2:
+            sample_type = ctypes.c_uint32
+        elif bytesPerSample > 1:
             sample_type = ctypes.c_uint16
 
-        buffers = []
-        for i in range(bufferCount):
-            buffers.append(ats.DMABuffer(sample_type, bytesPerBuffer))
+        if buffers is None:
+            buffers = []
+            for i in range(bufferCount):
+                buffers.append(ats.DMABuffer(sample_type, bytesPerBuffer))
 
 
         board.setRecordSize(preTriggerSamples, postTriggerSamples)
 
+        # The board co-adds hardware_averaging successive records before the
+        # transfer, the records per buffer and per acquisition are then the
+        # averaged ones.
+        if parameters['hardware_averaging'] > 1:
+            board.configureRecordAverage(ats.CRA_MODE_ENABLE_FPGA_AVE,
+                                         samplesPerRecord,
+                                         parameters['hardware_averaging'],
+                                         ats.CRA_OPTION_UNSIGNED)
+        elif parameters['mode'] != 'FFT':
+            try:
+                board.configureRecordAverage(ats.CRA_MODE_DISABLE,
+                                             samplesPerRecord, 1,
+                                             ats.CRA_OPTION_UNSIGNED)
+            except Exception:
+                # Boards without the averaging firmware never average
+                pass
+
         # Prepate the board to work in the asynchroneous mode of acquisition
         recordsPerAcquisition = recordsPerBuffer * buffersPerAcquisition
 
+        # The footers are written by the board at the end of each record
+        if parameters['footers']:
+            footerFlag = ats.ADMA_ENABLE_RECORD_FOOTERS
+        else:
+            footerFlag = 0
+
         if parameters['mode'] == 'FFT':
             admaFlags = ats.ADMA_EXTERNAL_STARTCAPTURE| ats.ADMA_NPT | ats.ADMA_DSP
             board.beforeAsyncRead(channels,
@@ -301,7 +568,8 @@ class DataAcquisition(object):
                                 recordsPerBuffer,
                                 recordsPerAcquisition,
                                 ats.ADMA_EXTERNAL_STARTCAPTURE \
-                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
+                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING \
+                                | footerFlag)
         elif parameters['mode'] == 'CHANNEL_A':
              board.beforeAsyncRead(channels,
                                 -preTriggerSamples,
@@ -309,7 +577,8 @@ class DataAcquisition(object):
                                 recordsPerBuffer,
                                 recordsPerAcquisition,
                                 ats.ADMA_EXTERNAL_STARTCAPTURE \
-                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
+                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING \
+                                | footerFlag)
         elif parameters['mode'] == 'CHANNEL_B':
              board.beforeAsyncRead(channels,
                                 -preTriggerSamples,
@@ -317,7 +586,8 @@ class DataAcquisition(object):
                                 recordsPerBuffer,
                                 recordsPerAcquisition,
                                 ats.ADMA_EXTERNAL_STARTCAPTURE \
-                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING)
+                                | ats.ADMA_NPT | ats.ADMA_FIFO_ONLY_STREAMING \
+                                | footerFlag)
 
 
         # Put the buffers previously created in the list of available buffers
@@ -328,77 +598,313 @@ class DataAcquisition(object):
 
 
 
-    def data_acquisition(self, board, queue_data, parameters, buffers):
+    def fft_window(self, window, samplesPerRecord, fftLength_samples):
+        """
+            Return the real and imaginary parts of the window of the on-FPGA
+            FFT. The windows are computed once for each record length and
+            kept, the FFT module reading them from their address.
+
+            Input:
+                - window (string): name of the window, "NONE", "HANNING",
+                  "HAMMING", "BLACKMAN", "BLACKMAN_HARRIS" or "BARTLETT"
+                - samplesPerRecord (int): number of samples of a record
+                - fftLength_samples (int): length of the FFT, the window is
+                  padded with zeros up to it.
+
+            Output:
+                - real, imag (array): float32 arrays of fftLength_samples
+        """
+
+        key = (window, samplesPerRecord, fftLength_samples)
+
+        if key not in self._fft_windows:
+
+            windowType = getattr(ats, 'DSP_WINDOW_'+window)
+
+            # Sets the real part of the FFT windowing
+            real = ats.dspGenerateWindowFunction(windowType, samplesPerRecord,
+                                                 fftLength_samples - samplesPerRecord)
+
+            # According to the documentation, the imaginary part of the FFT
+            # windowing should be filled with zeros
+            imag = ats.dspGenerateWindowFunction(windowType, 0,
+                                                 fftLength_samples)
+
+            self._fft_windows[key] = (real, imag)
+
+        return self._fft_windows[key]
+
+
+
+    def data_acquisition(self, boards, queue_data, parameters, control, buffers):
         """
             Acquire data and put them in the FIFO queue_data buffer memory.
+            The boards of a system are serviced in lockstep: the master board
+            starts the capture of all of them and each buffer is waited for
+            on every board before the next one, so that the buffers of the
+            same index hold the same triggers.
+            The acquisition stops when all the buffers have been acquired,
+            when the stop event of the control block is set or when the
+            transfer of a board overflows. The buffer then being acquired
+            is dropped for all the boards.
+            The timing of the buffers and, if parameters['footers'] is True,
+            the record numbers and trigger timestamps of the footers are
+            reported in the acquisition status of the control block, see
+            BufferMonitor.
+
+            With the on-board record averaging, the accumulated records are
+            converted in averaged 16-bit sample values, see average_codes, so
+            that the treatment receives them as acquired records.
+
+            Input:
+                - boards (list): boards of the system, the master first
+                - queue_data (list): memory buffer(s) of each board
+                - parameters (dict): parameters of the acquisition
+                - control: ControlBlock instance
+                - buffers (list): DMA buffers of each board
 
-            Output buffersCompleted (int): Number of emptied buffer.
+            Output buffersCompleted (int): Number of emptied buffer per board.
         """
 
         buffersPerAcquisition = parameters['buffers_per_acquisition']
-        recordsPerBuffer      = parameters['records_per_buffer']
-        preTriggerSamples     = 0 # NPT mode
-        postTriggerSamples    = parameters['samplesPerRecord']
-        samplesPerRecord      = preTriggerSamples + postTriggerSamples
+        mode                  = parameters['mode']
+        hardware_averaging    = parameters['hardware_averaging']
+
+        if hardware_averaging > 1:
+            codes = np.empty(len(buffers[0][0].buffer), dtype=np.uint16)
+            work  = np.empty(len(buffers[0][0].buffer), dtype=np.float32)
+
+        monitors = [BufferMonitor(board, board_buffers, parameters)
+                    for board, board_buffers in zip(boards, buffers)]
 
         start = time.clock() # Keep track of when acquisition started
-        board.startCapture() # Start the acquisition
+        boards[0].startCapture() # Start the acquisition of all the boards
 
-        message = 'Attempt to capture %d buffers\n' % buffersPerAcquisition
         buffersCompleted = 0
         bytesTransferred = 0
+        wait_time        = 0.
+
+        # A queue pickles the data asynchronously, we send it a copy of the
+        # DMA buffer before giving the buffer back to the board.
+        # The shared memory ring copies the data in one of its slots.
+        if parameters['transfer'] == 'queue':
+            copy = np.copy
+        else:
+            copy = lambda data: data
 
         # We measure up to have empty all the buffers set by the user or
         # if the user stop the measurement
-        while buffersCompleted < buffersPerAcquisition and parameters['measuring']:
-
-            buff = buffers[buffersCompleted % len(buffers)]
-            if parameters['mode'] == 'FFT':
-                board.dspGetBuffer(buff.addr, timeout_ms=5000)
-            else:
-                board.waitAsyncBufferComplete(buff.addr, timeout_ms=5000)
+        while buffersCompleted < buffersPerAcquisition and not control.stop.is_set():
+
+            # The buffer of this index is waited for on every board before
+            # it is sent for any of them: on an overflow it is dropped for
+            # all the boards, whose treatments receive the same buffers.
+            completed = []
+            for board, board_buffers, monitor\
+                in zip(boards, buffers, monitors):
+
+                buff = board_buffers[buffersCompleted % len(board_buffers)]
+                wait_start = time.time()
+                try:
+                    if mode == 'FFT':
+                        board.dspGetBuffer(buff.addr, timeout_ms=5000)
+                    else:
+                        board.waitAsyncBufferComplete(buff.addr, timeout_ms=5000)
+                except Exception as error:
+                    # The board stops the acquisition when the buffers are not
+                    # posted back fast enough, the acquired buffers are kept.
+                    # The other boards are still waited for to know which
+                    # ones overflowed.
+                    if 'Overflow' in str(error):
+                        monitor.overflow = True
+                        continue
+                    raise
+
+                wait_time += time.time() - wait_start
+                monitor.buffer_completed(buff)
+                completed.append(buff)
+
+            if any(monitor.overflow for monitor in monitors):
+                break
+
+            for board, buff, board_queue, monitor\
+                in zip(boards, completed, queue_data, monitors):
+
+                bytesTransferred += buff.size_bytes
+
+                if hardware_averaging > 1:
+                    data = self.average_codes(buff.buffer, hardware_averaging,
+                                              codes, work)
+                else:
+                    data = monitor.records(buff.buffer)
+
+                if mode == 'FFT':
+                    board_queue.put(copy(data))
+                elif mode == 'CHANNEL_AB':
+                    # The samples of the channels alternate in each record
+                    board_queue[0].put(copy(data[...,0::2]))
+                    board_queue[1].put(copy(data[...,1::2]))
+                elif mode == 'CHANNEL_A':
+                    board_queue.put(copy(data))
+                elif mode == 'CHANNEL_B':
+                    board_queue.put(copy(data))
+
+                # Add the buffer to the end of the list of available buffers.
+                board.postAsyncBuffer(buff.addr, buff.size_bytes)
 
             buffersCompleted += 1
-            bytesTransferred += buff.size_bytes
-
-            if parameters['mode'] == 'FFT':
-                queue_data.put(np.copy(buff.buffer))
-            elif parameters['mode'] == 'CHANNEL_AB':
-                queue_data[0].put(np.copy(buff.buffer[0::2]))
-                queue_data[1].put(np.copy(buff.buffer[1::2]))
-            elif parameters['mode'] == 'CHANNEL_A':
-                queue_data.put(np.copy(buff.buffer))
-            elif parameters['mode'] == 'CHANNEL_B':
-                queue_data.put(np.copy(buff.buffer))
-
-            # Add the buffer to the end of the list of available buffers.
-            board.postAsyncBuffer(buff.addr, buff.size_bytes)
 
-        # Compute the total transfer time, and display performance information.
-        transferTime_sec = time.clock() - start
-        message += 'Capture completed in %f sec\n' % transferTime_sec
-        buffersPerSec      = 0
-        bytesPerSec        = 0
-        recordsPerSec      = 0
-        samplesTransferred = samplesPerRecord*recordsPerBuffer*buffersCompleted*2
-        if transferTime_sec > 0:
-            buffersPerSec = buffersCompleted / transferTime_sec
-            bytesPerSec   = bytesTransferred / transferTime_sec
-            recordsPerSec = recordsPerBuffer * buffersCompleted / transferTime_sec
-            samplePerSec  = samplesTransferred / transferTime_sec
-
-        message += 'Captured %d buffers (%f buffers per sec)\n' % (buffersCompleted, buffersPerSec)
-        message += 'Captured %d records (%f records per sec)\n' % (recordsPerBuffer * buffersCompleted, recordsPerSec)
-        message += 'Transferred %d bytes (%f Mbytes per sec)\n' % (bytesTransferred, bytesPerSec/1024**2.)
-        message += 'Transferred %d samples (%f MS per sec)\n' % (samplesTransferred, samplePerSec/1e6)
-
-        parameters['message'] = message
+            # Live counters read by the instrument
+            control.set_acquisition(measured_buffers = buffersCompleted,
+                                    wait_time        = wait_time)
+
+        # The performance information are sent to the parent process which
+        # builds the transfer message.
+        control.set_acquisition(measured_buffers  = buffersCompleted,
+                                samplesPerRecord  = parameters['samplesPerRecord'],
+                                capture_time      = time.clock() - start,
+                                transferred_bytes = bytesTransferred,
+                                **BufferMonitor.merge(monitors))
 
         return buffersCompleted
 
 
 
-    def get_data(self, queue_data, parameters):
+    @staticmethod
+    def average_codes(accumulated, nb_records, codes, work):
+        """
+            Convert the records accumulated by the on-board averaging, sums
+            of the 12-bit sample codes of nb_records records, in the 16-bit
+            sample values of the averaged records.
+            The 4 low bits, left at zero by the board, keep the first 4 bits
+            of the fraction of the averaged code.
+
+            Input:
+                - accumulated (array): uint32 DMA buffer
+                - nb_records (int): number of records averaged by the board
+                - codes (array): uint16 array of the size of accumulated
+                  receiving the 16-bit sample values.
+                - work (array): float32 array of the size of accumulated
+
+            Output:
+                - codes (array)
+        """
+
+        np.multiply(accumulated, 16./nb_records, out=work)
+        np.rint(work, out=work)
+        codes[:] = work
+
+        return codes
+
+
+
+    def open_board(self, parameters, boardId=1):
+        """
+            Instance the board and set its inputs.
+            If parameters['simulation'] is a dictionnary, a
+            SimulatedBoard.Board built with these keyword arguments replaces
+            the ATS9360.
+        """
+
+        # We instance a board object
+        # All the parameters of the measurement will be set on this instance
+        if parameters['simulation'] is None:
+            board = ats.Board(systemId = 1, boardId = boardId)
+        else:
+            board = SimulatedBoard.Board(systemId = 1, boardId = boardId,
+                                         **parameters['simulation'])
+
+        # We set the two inputs (chanel A and B)
+        self.set_input_control(board)
+
+        return board
+
+
+
+    def open_boards(self, parameters):
+        """
+            Instance the parameters['nb_boards'] boards of the system, the
+            master board first, and set their inputs.
+            The boards share the clock and the trigger through their
+            synchronization cable, they are all set with the same
+            parameters.
+        """
+
+        return [self.open_board(parameters, boardId)
+                for boardId in range(1, parameters['nb_boards'] + 1)]
+
+
+
+    def prepare_boards(self, boards, parameters, buffers=None):
+        """
+            Prepare the DMA buffers of each board, see prepare_acquisition.
+            Return the list of the buffers of each board.
+        """
+
+        if buffers is None:
+            buffers = [None]*len(boards)
+
+        # prepare_acquisition modifies samplesPerRecord in FFT mode, each
+        # board starts from the received parameters
+        board_parameters = [dict(parameters) for board in boards]
+
+        buffers = [self.prepare_acquisition(board, board_parameter, board_buffers)
+                   for board, board_parameter, board_buffers
+                   in zip(boards, board_parameters, buffers)]
+
+        parameters['samplesPerRecord'] = board_parameters[0]['samplesPerRecord']
+
+        return buffers
+
+
+
+    def acquire(self, boards, queue_data, parameters, control, buffers):
+        """
+            Launch the data acquisition on prepared boards, stop the transfer
+            at the end and inform the treatment processes that there is no
+            more data by sending them None.
+            With a single board, queue_data holds its memory buffer(s),
+            otherwise a list of the memory buffer(s) of each board.
+        """
+
+        if parameters['nb_boards'] == 1:
+            queue_data = [queue_data]
+
+        # We launch the data acquisition
+        self.data_acquisition(boards, queue_data, parameters, control, buffers)
+
+        for board, board_queue in zip(boards, queue_data):
+
+            # We stop the transfer.
+            if parameters['mode'] == 'FFT' :
+                board.dspAbortCapture()
+            else:
+                board.abortAsyncRead()
+
+            # We inform the treatment processes that there is no more data
+            if parameters['mode'] == 'CHANNEL_AB' :
+                board_queue[0].put(None)
+                board_queue[1].put(None)
+            else:
+                board_queue.put(None)
+
+
+
+    def close_queues(self, queue_data):
+        """
+            Close the memory buffer(s) of queue_data, nested in lists for
+            several channels or several boards.
+        """
+
+        if isinstance(queue_data, list):
+            for queue in queue_data:
+                self.close_queues(queue)
+        else:
+            queue_data.close()
+
+
+
+    def get_data(self, queue_data, parameters, control):
         """
             Method allowing the transfert of data from the board to the computer.
             The board is instanced following the parameters input and data are
@@ -406,53 +912,120 @@ class DataAcquisition(object):
 
             Input:
                 - queue_data_cha: FIFO memory buffer instance from the
-                               multiprocess library.
+                               multiprocess library or RingBuffer instance
+                               from the SharedMemory module.
                 - queue_data_chb: FIFO memory buffer instance from the
-                               multiprocess library.
-                - parameters: Dictionnary with all board parameters instance
-                              from multiprocess library
+                               multiprocess library or RingBuffer instance
+                               from the SharedMemory module.
+                               With several boards, the memory buffer(s)
+                               of each board, see acquire.
+                - parameters: Dictionnary with all board parameters, copied
+                              in the process when it starts.
+                              If parameters['simulation'] is a dictionnary,
+                              a SimulatedBoard.Board built with these keyword
+                              arguments replaces the ATS9360.
+                - control: ControlBlock instance from the SharedMemory
+                           module used to stop the acquisition and to report
+                           its status.
         """
 
-        # We instance a board object
-        # All the parameters of the measurement will be set on this instance
-        board = ats.Board(systemId = 1, boardId = 1)
+        # We instance the boards and set their two inputs (chanel A and B)
+        boards = self.open_boards(parameters)
 
-        # We set the clock
-        self.set_clock(board, parameters)
+        for board in boards:
 
-        # We set the two inputs (chanel A and B)
-        self.set_input_control(board)
+            # We set the clock
+            self.set_clock(board, parameters)
 
-        # We set the trigger
-        self.set_trigger(board, parameters)
+            # We set the trigger
+            self.set_trigger(board, parameters)
 
         # We prepare the acquisition
-        buffers = self.prepare_acquisition(board, parameters)
+        buffers = self.prepare_boards(boards, parameters)
 
         # We wait a little to let the time to the board to initialize itself
         time.sleep(0.5)
 
         # We launch the data acquisition
-        parameters['measured_buffers'] = self.data_acquisition(board,
-                                                               queue_data,
-                                                               parameters, buffers)
+        self.acquire(boards, queue_data, parameters, control, buffers)
 
-        # We stop the transfer.
-        if parameters['mode'] == 'FFT' :
-            board.dspAbortCapture()
-        else:
-            board.abortAsyncRead()
+        # We close the FIFO memory
+        self.close_queues(queue_data)
 
         # We inform the parent process that the board is properly "closed"
-        parameters['safe_acquisition'] = True
+        control.acquisition_finished.set()
 
-        # Once the board is "close" properly, we close the FIFO memory
-        if parameters['mode'] == 'FFT' :
-            queue_data.close()
-        if parameters['mode'] == 'CHANNEL_AB' :
-            queue_data[0].close()
-            queue_data[1].close()
-        if parameters['mode'] == 'CHANNEL_A' :
-            queue_data.close()
-        if parameters['mode'] == 'CHANNEL_B' :
-            queue_data.close()
+
+
+    def run_session(self, queue_data, queue_command, control):
+        """
+            Keep the board configured between successive acquisitions.
+            Each parameters dictionnary received in queue_command launches an
+            acquisition as get_data does, but only the changed parameters are
+            applied to the board and the DMA buffers are reused as long as
+            the geometry of the acquisition does not change.
+            The session ends when None is received.
+
+            Input:
+                - queue_data: FIFO memory buffer(s) or RingBuffer(s), see
+                              get_data.
+                - queue_command: FIFO memory buffer instance from the
+                                 multiprocess library.
+                - control: ControlBlock instance from the SharedMemory
+                           module. Its events must be cleared by the parent
+                           process before each command.
+        """
+
+        boards   = None
+        buffers  = None
+        previous = {}
+
+        while True:
+
+            parameters = queue_command.get()
+            if parameters is None:
+                break
+
+            changed = set(key for key in parameters
+                          if key not in previous
+                          or previous[key] != parameters[key])
+
+            # New boards are instanced if the boards themselves change and
+            # everything is then applied again
+            if boards is None or changed & set(BOARD_PARAMETERS):
+                boards  = self.open_boards(parameters)
+                buffers = None
+                changed = set(parameters)
+
+            # prepare_acquisition modifies samplesPerRecord in FFT mode, we
+            # keep the parameters as they have been received.
+            previous = dict(parameters)
+
+            for board in boards:
+
+                if changed & set(CLOCK_PARAMETERS):
+                    self.set_clock(board, parameters)
+
+                if changed & set(TRIGGER_PARAMETERS):
+                    self.set_trigger(board, parameters)
+
+            if changed & set(GEOMETRY_PARAMETERS):
+                buffers = None
+
+            # The boards have to be armed again for each acquisition
+            buffers = self.prepare_boards(boards, parameters, buffers)
+
+            # We wait a little to let the time to the board to initialize
+            # itself when its clock has changed
+            if changed & set(CLOCK_PARAMETERS):
+                time.sleep(0.5)
+
+            self.acquire(boards, queue_data, parameters, control, buffers)
+
+            # We inform the parent process that the acquisition is finished
+            control.acquisition_finished.set()
+
+        # Once the session is finished, we close the FIFO memory
+        self.close_queues(queue_data)
+
+        queue_command.close()
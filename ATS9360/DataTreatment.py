@@ -17,21 +17,61 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import numpy as np
+import os
+import tempfile
 import time
 import multiprocessing as mp
 import scipy.signal as scisig
 
+from Demodulation import Demodulator, MultiToneDemodulator
+from Filtering import Decimator
+
 class DataTreatment(object):
     """
         Canvas for data treatment class.
         Should only be used as parent class
     """
 
+    # How the results of several treatment processes are merged, see the
+    # TreatmentPool module. For each element of the result tuple:
+    #   'mean': averaged with the number of sequences of each process,
+    #   'std' : quadratic average with the number of sequences of each process,
+    #   'last': taken from the last result, for results depending only on the
+    #           last sequence,
+    #   'sum' : summed over the last results of the processes, for counts.
+    # A string if the result is not a tuple.
+    # None if the processor cannot be used by several processes.
+    reduction = None
+
+    # Set by the process method once the results are precise enough, the
+    # acquisition is then stopped, see treat_buffers.
+    converged = False
+
+    # True for the processors whose results are too large to be sent for
+    # every sequence: the process method only accumulates the sequences and
+    # the publish method sends one result per buffer, see treat_buffers.
+    publish_per_buffer = False
+
+    # Type of the data in V given by data_in_volt to the process method.
+    # float32 halves the memory used by the treatment of a buffer, the
+    # voltages of the 12-bit sample codes being given to 7 digits, at the
+    # cost of the precision of the means of long records.
+    # Set it on the processor instance, it is sent with it to the treatment
+    # processes.
+    dtype = np.float64
+
 
     @staticmethod
-    def data_in_volt(data):
+    def data_in_volt(data, dtype=np.float64):
         """
             Get raw data coming from the board and transform them in V.
+
+            Input:
+                - data (array): raw data coming from the board
+                - dtype (numpy dtype): type of the data in V
+
+            Output:
+                - data (array): data in V
         """
 
         # Parameters of the board (are fixed).
@@ -39,16 +79,46 @@ class DataTreatment(object):
         # bits_per_sample  = 12 # Sould be int
         # inputRange_volts = 400e-3 # Fixed for the ats9360
 
-        # Right-shift 16-bit sample value by 4 to get 12-bit sample code
-        data = data >> 4
-
         # AlazarTech digitizers are calibrated as follows
         # codeZero  = (1 << (bits_per_sample - 1)) - 0.5
         # codeRange = (1 << (bits_per_sample - 1)) - 0.5
         # Following this a proportionality of 2047.5 is applied
         # The calcul is inputRange_volts*(data - codeZero) / codeRange
 
-        return 0.4*(data - 2047.5)/2047.5
+        # The 12-bit sample code is the 16-bit sample value right-shifted by
+        # 4, the shift is folded in the zero volt value 16*2047.5 = 32760 and
+        # in the scale. The data are converted once while they are centred,
+        # then scaled in place.
+        data  = np.subtract(data, 32760, dtype=dtype)
+        data *= 0.4/2047.5/16.
+
+        return data
+
+
+
+    @staticmethod
+    def sum_in_volt(data_sum, nb_data):
+        """
+            Get the sum of nb_data raw data coming from the board and return
+            their mean in V.
+            The sum is made on the 16-bit sample values so that the
+            accumulation is exact in int64 and the conversion is done once.
+        """
+
+        # The 12-bit sample code is the 16-bit sample value divided by 16
+        return 0.4*(data_sum/(16.*nb_data) - 2047.5)/2047.5
+
+
+
+    @staticmethod
+    def data_in_code(data):
+        """
+            Return the raw data coming from the board as 16-bit sample values.
+            The data are given as they are, without copy, when they are
+            already uint16, as the sequences rebuilt by reassemble_sequences.
+        """
+
+        return np.asarray(data, dtype=np.uint16)
 
 
 
@@ -60,13 +130,51 @@ class DataTreatment(object):
         """
 
         # We reshape them in 2D-array to enhance the averaging
-        # print type(parameters['records_per_buffer'])
-        # print type(parameters['samplesPerRecord'])
-        # print parameters['records_per_buffer']
-        # print parameters['samplesPerRecord']
+        # The number of samples per record is deduced from the size of the
+        # buffer since, in FFT mode, it is only known by the acquisition
+        # process once the FFT module is configured.
+        return np.reshape(data, (parameters['records_per_buffer'], -1))
+
 
 
-        return np.reshape(data, (parameters['records_per_buffer'],parameters['samplesPerRecord']))
+    def result_bytes(self, parameters):
+        """
+            Size in bytes of a pickled result of the process method, used to
+            size the mailboxes of the "latest" results, see
+            ATS9360_NPT.measurement_initialization.
+            None when the results are not larger than two float64 arrays of
+            the size of a sequence, the default size of the mailboxes.
+            Processors with larger results must override it.
+        """
+
+        return None
+
+
+
+    def publish(self, queue_treatment, parameters):
+        """
+            Send the result of the sequences treated so far.
+            Called after each buffer by treat_buffers, for the processors
+            with publish_per_buffer only, which must override it.
+        """
+
+        raise NotImplementedError('The processors publishing per buffer '\
+                                  'must define their publish method')
+
+
+
+    def final_result(self, result):
+        """
+            Return the result given by the instrument from the last result
+            sent by the process method, merged if several treatment
+            processes are used.
+            It is called by the instrument, in its process, on the results it
+            returns only: processors sending raw sums convert them there
+            rather than for every sequence.
+            By default the result itself.
+        """
+
+        return result
 
 
 
@@ -94,95 +202,164 @@ class DataTreatment(object):
 
 
 
-    def many_sequences_per_buffer(self, data, queue_treatment, parameters):
+    def reassemble_sequences(self, data, queue_treatment, parameters):
         """
-            Organise data when the number of acquired sequences are smaller
-            than the number of records per buffer.
+            Organise data when the number of acquired sequences differs from
+            the number of records per buffer.
+            The whole sequences of the buffer are processed where they are.
+            The records of a sequence shared between buffers are copied once
+            in the data_stored array, allocated for the first buffer, and
+            processed once the sequence is complete.
         """
 
-        # For the first buffer, we initialize the data stored attribute
-        # witht the correct shape
+        nb_sequence = parameters['nb_sequence']
+
+        # For the first buffer, we allocate the data stored attribute with
+        # the correct shape
         if self.treated_buffer == 0:
-            self.data_stored = np.array([]).reshape(parameters['nb_sequence'], 0)
-        # If there are data stored from previous buffer
-        elif self.data_stored.shape[0] != parameters['nb_sequence']:
+            self.data_stored = np.empty((nb_sequence, data.shape[1]),
+                                        dtype=data.dtype)
+            self.nb_stored   = 0
+
+        start = 0
 
-            # Data used correspond to the data saved previously and
-            # data coming from the new buffer. We build an array combining
-            # these two sources of data.
-            self.process(np.vstack((self.data_stored,\
-                                   data[:parameters['nb_sequence'] - self.data_stored.shape[0]])),\
-                        queue_treatment, parameters)
+        # If there are data stored from previous buffers, we complete the
+        # sequence with the beginning of the new buffer
+        if self.nb_stored > 0:
+
+            start = min(nb_sequence - self.nb_stored, data.shape[0])
+            self.data_stored[self.nb_stored:self.nb_stored + start] = data[:start]
+            self.nb_stored += start
+
+            if self.nb_stored == nb_sequence:
+                self.process(self.data_stored, queue_treatment, parameters)
+                self.treated_sequance += 1
+                self.nb_stored = 0
 
         # We iterate to empty the buffer by sending data in package
         # corresponding to a whole sequence.
-        i = 0
-        while (i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0] <= parameters['records_per_buffer']:
+        while start + nb_sequence <= data.shape[0]:
 
-            self.process(data[(i + 1)*parameters['nb_sequence'] - self.data_stored.shape[0]\
-                            :(i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0]],\
-                        queue_treatment, parameters)
-            i += 1
+            self.process(data[start:start + nb_sequence], queue_treatment,
+                         parameters)
+            self.treated_sequance += 1
+            start += nb_sequence
 
         # If there is data left but not enough to send a package, we store
         # them for the next buffer.
-        i -= 1
-        if (i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0] != data.shape[0]:
+        # The data are copied since the buffer may be given back to the
+        # acquisition process (shared memory transfer).
+        if start < data.shape[0]:
 
-            self.data_stored = data[(i + 2)*parameters['nb_sequence'] - self.data_stored.shape[0]:]
-        # If not, we reinitialize the data stored attribute with an empty
-        # array
-        else:
-            self.data_stored = np.array([]).reshape(parameters['nb_sequence'], 0)
+            self.nb_stored = data.shape[0] - start
+            self.data_stored[:self.nb_stored] = data[start:]
 
 
 
-    def less_sequence_per_buffer(self, data, queue_treatment, parameters):
+    def treat_data(self, queue_data, queue_treatment, parameters, control,
+                   channel=0):
         """
-            Organise data when the number of acquired sequences are greater
-            than the number of records per buffer.
+            Treat all the buffers acquired by the board, see treat_buffers,
+            then close the memory buffers and inform the parent process that
+            the treatment is finished.
         """
 
-        # For the first buffer, we initialize the data stored attribute
-        if self.treated_buffer == 0:
-            self.data_stored = data
-        else:
+        self.treat_buffers(queue_data, queue_treatment, parameters, control,
+                           channel)
+
+        # Once the data are finished to be processed, we close the shared memory
+        queue_data.close()
+        queue_treatment.close()
 
-            # If the new data are not enough to reach the number of sequence
-            # we store the whole measured buffer
-            if self.data_stored.shape[0] + data.shape[0] < parameters['nb_sequence']:
+        # Inform the parent process that the data treatment is finished
+        control.treatment_finished[channel].set()
 
-                self.data_stored  = np.vstack((self.data_stored, data))
-            # Otherwise, only a part of the buffer is use to store.
-            # The other part is stored for the next buffer
-            else:
-                self.process(np.vstack((self.data_stored,\
-                                        data[:parameters['nb_sequence']\
-                                        - self.data_stored.shape[0]])),\
-                            queue_treatment, parameters)
 
-                self.data_stored = data[parameters['nb_sequence'] - self.data_stored.shape[0]:]
-                self.treated_sequance += 1
 
+    @staticmethod
+    def run_session(queue_data, queue_treatment, queue_command, control,
+                    channel=0):
+        """
+            Treat the buffers of successive acquisitions of a session, see
+            DataAcquisition.run_session.
+            For each acquisition, a (processor, parameters) tuple is received
+            in queue_command and the buffers are treated by the treat_buffers
+            method of the processor.
+            None is put in queue_treatment after the results of each
+            acquisition so that the parent process can empty the queue.
+            The session ends when None is received in queue_command.
+        """
+
+        while True:
+
+            command = queue_command.get()
+            if command is None:
+                break
+
+            processor, parameters = command
+            processor.treat_buffers(queue_data, queue_treatment, parameters,
+                                    control, channel)
+            queue_treatment.put(None)
 
+            # Inform the parent process that the data treatment is finished
+            control.treatment_finished[channel].set()
+
+        queue_data.close()
+        queue_treatment.close()
+        queue_command.close()
 
-    def treat_data(self, queue_data, queue_treatment, parameters):
+
+
+    def treat_buffers(self, queue_data, queue_treatment, parameters, control,
+                      channel=0):
         """
             Launch a loop to treat all the buffers acquired by the board.
             At each iteration, the method call "process" which should be
-            defined in a child class.
+            defined in a child class, and then "publish" for the processors
+            sending one result per buffer.
+            The loop ends when the acquisition process sends None.
+            Once the processor sets its converged attribute, the control
+            block is informed and stops the acquisition when all the
+            treatment processes converged.
+
+            Input:
+                - queue_data: FIFO memory buffer or RingBuffer instance
+                  containing the acquired buffers.
+                - queue_treatment: FIFO memory buffer receiving the treated
+                  data.
+                - parameters (dict): board parameters, copied in the process
+                  when it starts.
+                - control: ControlBlock instance from the SharedMemory module
+                  in which the status of the treatment is reported.
+                - channel (int): index of the treatment process in the
+                  control block.
         """
 
         start_time = time.time()
         self.treated_buffer = 0
         self.treated_sequance = 0
 
-        # We acquire as many buffer as the board has acquired
-        while parameters['measured_buffers'] is None or \
-              self.treated_buffer < parameters['measured_buffers']:
+        # Index of this treatment process among the nb_treatments ones of
+        # the measurement, for the processors writing files
+        self.treatment_index = channel
+        self.nb_treatments   = control.nb_treatments
+        treated_samples = 0
+        process_time = 0.
+        reported = False
+
+        # We treat buffers until the acquisition process informs us that the
+        # acquisition is finished
+        while True:
+
+            data = queue_data.get()
+            if data is None:
+                break
+
+            treated_samples += data.size
+            process_start = time.time()
 
             # We obtain the data in a 2D array (acquired_sample, records)
-            data = self.data_2D(queue_data.get(), parameters)
+            data = self.data_2D(data, parameters)
 
             # If the number of sequence is equal to the number of records per buffer
             # Then we can treat data immediately
@@ -190,69 +367,157 @@ class DataTreatment(object):
 
                 self.process(data, queue_treatment, parameters)
                 self.treated_sequance += 1
-            # If the number of sequence is smaller than the  number of acquired buffer
-            # We have to treat data per package, each package corresponding to
-            # a sequence.
-            elif data.shape[0] > parameters['nb_sequence']:
-
-                self.many_sequences_per_buffer(data, queue_treatment, parameters)
-                self.treated_sequance += 1
-            # If the number of sequence is larger than the number of records per
-            # buffer
+            # Otherwise, we have to treat data per package, each package
+            # corresponding to a sequence.
             else:
-                self.less_sequence_per_buffer(data, queue_treatment, parameters)
+                self.reassemble_sequences(data, queue_treatment, parameters)
 
+            if self.publish_per_buffer:
+                self.publish(queue_treatment, parameters)
 
             # Each loop implies a treatment of one buffer
             self.treated_buffer += 1
+            process_time += time.time() - process_start
 
-        # Return information about the data treatment
-        elapsed_time = time.time() - start_time
-        acquired_samples = parameters['samplesPerRecord']*parameters['records_per_buffer']\
-                          *parameters['measured_buffers']
-        acquired_bytes   = acquired_samples*2 # 2 bytes per sample
+            # Live counters read by the instrument
+            control.set_treatment(channel,
+                                  treated_buffers = self.treated_buffer,
+                                  process_time    = process_time)
 
-        parameters['message'] += 'Treatment completed in %f sec\n' % elapsed_time
-        parameters['message'] += 'Treated %d bytes (%f Mbytes per sec)\n' %\
-                                 (acquired_bytes, acquired_bytes/elapsed_time/1024**2)
-        parameters['message'] += 'Treated %d samples (%f Ms per sec)\n' %\
-                                 (acquired_samples, acquired_samples/elapsed_time/1e6)
+            if self.converged and not reported:
+                control.converge(channel)
+                reported = True
 
-        # Once the data are finished to be processed, we close the shared memory
-        queue_data.close()
-        queue_treatment.close()
-
-        # Inform the parent process that the data treatment is finished
-        if parameters['safe_treatment'][0]:
-            parameters['safe_treatment'][1] = True
-        else:
-            parameters['safe_treatment'][0] = True
+        # Return information about the data treatment
+        control.set_treatment(channel,
+                              treated_buffers   = self.treated_buffer,
+                              treated_sequences = self.treated_sequance,
+                              treated_samples   = treated_samples,
+                              treatment_time    = time.time() - start_time)
 
 
 class Raw(DataTreatment):
     """
-        Return the raw data without any treatment except the bitwise of 4 bits.
+        Store the raw data, as 16-bit sample values, in a file mapped in
+        memory with the shape (records, samplesPerRecord).
+        The file is sized for the whole acquisition from the parameters:
+        buffers_per_acquisition*records_per_buffer records. Only the pages
+        being written are held in memory so captures of millions of records
+        do not exhaust the RAM.
+        Each treatment process, one per channel, board and worker, writes its
+        own file, created when it receives its first sequence.
+        For each sequence a small handle is sent:
+        (filename, nb_records, samplesPerRecord), nb_records being the number
+        of records written so far. The data are obtained from it by the load
+        method. The records of the handle are flushed to the file before it
+        is sent but the file is only complete once the measurement is
+        closed.
+        The files are not removed by the driver: they belong to the caller,
+        which removes them with the remove method once the data are read.
     """
 
-    def __init__(self):
+    def __init__(self, filename=None):
+        """
+            Input:
+                - filename (string): file in which the raw data are stored.
+                  When several treatment processes are used, the index of
+                  the process is added before the extension:
+                  "data_0.raw", "data_1.raw"...
+                  By default a new temporary file per treatment process.
+        """
 
-        self.data = np.array([])
+        self.filename   = filename
+        self.data       = None
+        self.nb_records = 0
+
+    def _create_file(self):
+        """
+            Return the name of the file of this treatment process.
+        """
+
+        if self.filename is None:
+            descriptor, filename = tempfile.mkstemp(prefix='ATS9360_',
+                                                    suffix='.raw')
+            os.close(descriptor)
+
+            return filename
+
+        if getattr(self, 'nb_treatments', 1) > 1:
+            root, extension = os.path.splitext(self.filename)
+
+            return '%s_%d%s' % (root, self.treatment_index, extension)
+
+        return self.filename
 
     def process(self, data, queue_treatment, parameters):
 
-        self.data = np.append(self.data, data)
-        queue_treatment.put(self.data)
+        # For the first sequence, we create the file with the size of the
+        # whole acquisition
+        if self.data is None:
+            self.filename = self._create_file()
+            self.data = np.memmap(self.filename, dtype=np.uint16, mode='w+',
+                                  shape=(parameters['buffers_per_acquisition']\
+                                         *parameters['records_per_buffer'],
+                                         data.shape[1]))
+
+        self.data[self.nb_records:self.nb_records + data.shape[0]] = data
+        self.nb_records += data.shape[0]
+
+        # The records of the handle are written in the file before it is
+        # sent
+        self.data.flush()
+
+        queue_treatment.put((self.filename, self.nb_records, data.shape[1]))
+
+    @staticmethod
+    def load(handle):
+        """
+            Return the raw data written when the handle has been sent, as a
+            read only array mapped on the file.
+            During the measurement, the file is still written after these
+            records, it is complete once the measurement is closed.
+
+            Input:
+                - handle (tuple): (filename, nb_records, samplesPerRecord)
+                  sent by the process method.
+            Output:
+                - data (np.memmap): array of shape
+                  (nb_records, samplesPerRecord) of 16-bit sample values.
+        """
+
+        filename, nb_records, samplesPerRecord = handle
+
+        return np.memmap(filename, dtype=np.uint16, mode='r',
+                         shape=(nb_records, samplesPerRecord))
+
+    @staticmethod
+    def remove(handle):
+        """
+            Remove the file of a handle sent by the process method, once the
+            measurement is closed and the arrays given by load are deleted.
+
+            Input:
+                - handle (tuple): (filename, nb_records, samplesPerRecord)
+        """
+
+        os.remove(handle[0])
 
 
 class Average(DataTreatment):
     """
         Class performing the average of the acquired data.
+        The raw data are accumulated in int64 and converted in V only when a
+        result is sent.
     """
 
+    reduction = ('mean', 'std')
+
     def __init__(self):
 
-        self.mean = 0.
-        self.std  = 0.
+        self.data_sum     = 0
+        self.variance_sum = 0.
+        self.nb_records   = 0
+        self.nb_chunks    = 0
 
     def process(self, data, queue_treatment, parameters):
         """
@@ -262,61 +527,160 @@ class Average(DataTreatment):
             (data, std)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
+        data = self.data_in_code(data)
+        nb_records = data.shape[0]
 
-        # We obtain the current averaging for both and save them for
-        # the next iteration
+        # Sums over the records of the 16-bit sample values and of their
+        # square, exact in int64
+        data_sum    = np.sum(data, axis=0, dtype=np.int64)
+        square_sum  = np.sum(np.square(data, dtype=np.uint32), axis=0,
+                             dtype=np.int64)
+
+        # The variance of the current buffer, its numerator is exact
+        self.variance_sum += (nb_records*square_sum - data_sum**2)\
+                             /(nb_records**2.)
 
-        # self.mean = self.mean_averaging(self.mean, data)
-        # self.std  = self.std_averaging(self.std, data)
-        self.mean = self.mean_averaging(self.mean, np.mean(data, axis=0))
-        self.std  = self.std_averaging(self.std, np.std(data, axis=0))
+        self.data_sum   = self.data_sum + data_sum
+        self.nb_records += nb_records
+        self.nb_chunks  += 1
+
+        # We convert in V the mean over all the records and the quadratic
+        # mean of the std of the buffers
+        mean = self.sum_in_volt(self.data_sum, self.nb_records)
+        std  = 0.4/2047.5/16.*np.sqrt(self.variance_sum/float(self.nb_chunks))
 
-        # print 'data', np.shape(data)
         # Send the result with the amplitude in V
-        queue_treatment.put((self.mean, self.std))
+        queue_treatment.put((mean, std))
 
 
 class Average_time(DataTreatment):
     """
         Class performing the average of the acquired data.
+        The raw data are accumulated in int64 by the treatment process, which
+        sends their sums. They are converted in V by the instrument when it
+        returns the result, see final_result.
+
+        In the adaptive mode, given by target_error or noise_floor, the
+        standard error of the running mean is tracked for each point of the
+        sequence and the acquisition is stopped once it is reached
+        everywhere. The averaging set on the instrument is then a maximum and
+        the number of averages actually used is added to the result.
     """
 
-    def __init__(self):
-    # __init__(self,acquisition_time, samplerate):
+    # The sums of the treatment processes are added
+    reduction = ('sum', 'sum', 'sum')
+
+    def __init__(self, target_error=None, noise_floor=None, min_averaging=10):
         """
+            The sums have the shape of the processed data and are
+            initialized by the first one.
+
             Input:
-                - acquisition_time (float): in second
-                - samplerate (float): in sample per second
+                - target_error (float): relative standard error of the mean,
+                  with respect to the maximum of its absolute value, at which
+                  the acquisition is stopped.
+                - noise_floor (float): standard error of the mean in V at
+                  which the acquisition is stopped.
+                - min_averaging (int): number of averages before which the
+                  standard error is not trusted.
+            If both are given, the first reached stops the acquisition.
         """
-        # length=int(acquisition_time*samplerate)
 
-        # We initialize np.array with the right dimension
-        # self.mean = np.zeros(length)
-        # self.std  = np.zeros(length)
-        self.mean = 0.
-        self.std  = 0.
+        self.data_sum   = 0
+        self.square_sum = 0
+        self.nb_chunks  = 0
+
+        self.target_error  = target_error
+        self.noise_floor   = noise_floor
+        self.min_averaging = min_averaging
+
+        self.adaptive = target_error is not None or noise_floor is not None
 
     def process(self, data, queue_treatment, parameters):
         """
-            Calculate the average of the current buffer and average it with
-            the previous measured data.
-            Return the data in the memory buffer as the following:
-            (data, std)
+            Add the current sequence to the sums of the previous ones.
+            Send the sums of the 16-bit sample values and of their square
+            with the number of sequences: (data_sum, square_sum, nb_chunks).
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
+        data = self.data_in_code(data)
 
-        # We obtain the current averaging for both and save them for
-        # the next iteration
-        self.mean = self.mean_averaging(self.mean, data)
-        self.std  = self.std_averaging(self.std, data)
+        if self.nb_chunks == 0:
+            self.data_sum   = np.zeros(data.shape, dtype=np.int64)
+            self.square_sum = np.zeros(data.shape, dtype=np.int64)
+            self.square     = np.empty(data.shape, dtype=np.uint32)
 
-        # Send the result with the amplitude in V
-        queue_treatment.put((self.mean, self.std))
-        # queue_treatment.put((self.mean))
+        # Sums of the 16-bit sample values and of their square, exact in
+        # int64. The square is computed in an array allocated once.
+        self.data_sum   += data
+        np.multiply(data, data, out=self.square, dtype=np.uint32)
+        self.square_sum += self.square
+        self.nb_chunks  += 1
+
+        if self.adaptive:
+
+            # The acquisition checks the stop event once per buffer, the
+            # error is only evaluated with the last sequence of a buffer
+            sequences_per_buffer = max(parameters['records_per_buffer']\
+                                       //parameters['nb_sequence'], 1)
+
+            if not self.converged and self.nb_chunks >= self.min_averaging\
+               and self.nb_chunks % sequences_per_buffer == 0:
+                self.converged = self.error_reached(parameters)
+
+        # The sums are copied since a multiprocessing queue pickles them
+        # after put returns
+        queue_treatment.put((self.data_sum.copy(), self.square_sum.copy(),
+                             self.nb_chunks))
+
+    def final_result(self, result):
+        """
+            Return the mean and the standard deviation in V from the sums:
+            (data, std) or, in the adaptive mode, (data, std, nb_averaging)
+        """
+
+        data_sum, square_sum, nb_chunks = result
+
+        # The quadratic mean in V is obtained from the sum of the square of
+        # the 16-bit sample values centred on the zero volt value
+        # 16*2047.5 = 32760
+        centred_square_sum = square_sum\
+                           - 2*32760*data_sum\
+                           + nb_chunks*32760**2
+
+        mean = self.sum_in_volt(data_sum, nb_chunks)
+        std  = 0.4/2047.5/16.*np.sqrt(centred_square_sum/float(nb_chunks))
+
+        if self.adaptive:
+            return mean, std, nb_chunks
+        else:
+            return mean, std
+
+    def error_reached(self, parameters):
+        """
+            Return True when the standard error of the mean reached the
+            target error or the noise floor on all the points.
+            With several treatment processes, each one averages its share of
+            the buffers: the error of the merged mean is the one of a
+            process divided by the square root of their number.
+        """
+
+        code_mean = self.data_sum/float(self.nb_chunks)
+        variance  = self.square_sum/float(self.nb_chunks) - code_mean**2
+
+        error = 0.4/2047.5/16.\
+                *np.sqrt(np.max(variance)/(self.nb_chunks\
+                                           *parameters['nb_workers']))
+
+        if self.noise_floor is not None and error <= self.noise_floor:
+            return True
+
+        if self.target_error is not None\
+           and error <= self.target_error*0.4/2047.5/16.\
+                        *np.max(np.abs(code_mean - 32760)):
+            return True
+
+        return False
 
 
 class AmplitudePhase(DataTreatment):
@@ -326,6 +690,8 @@ class AmplitudePhase(DataTreatment):
         Return the amplitude in V and the phase in rad
     """
 
+    reduction = ('mean', 'std', 'mean', 'std')
+
 
 
     def __init__(self, acquisition_time, samplerate, frequency):
@@ -345,11 +711,8 @@ class AmplitudePhase(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         # Data save
         self.amp_mean = 0.
@@ -367,16 +730,12 @@ class AmplitudePhase(DataTreatment):
             (amp_mean, amp_std, phase_mean, phase_std)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        real, imag = self.demodulator.demodulate(data)
 
         # Obtain amplitude and phase
-        amp   = 2.*np.sqrt(cos**2. + sin**2.)
-        phase = np.angle(cos + 1j*sin)
+        amp   = np.sqrt(real**2. + imag**2.)
+        phase = np.arctan2(imag, real)
 
         # We obtain the current averaging for both and save them for
         # the next iteration
@@ -420,11 +779,8 @@ class DBPhase(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         # Data save
         self.amp_mean = 0.
@@ -460,16 +816,12 @@ class DBPhase(DataTreatment):
             (amp_mean, amp_std, phase_mean, phase_std)
         """
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        real, imag = self.demodulator.demodulate(data)
 
         # Obtain amplitude and phase
-        amp   = 2.*np.sqrt(cos**2. + sin**2.)
-        phase = np.angle(cos + 1j*sin)
+        amp   = np.sqrt(real**2. + imag**2.)
+        phase = np.arctan2(imag, real)
 
         # We obtain the current averaging for both and save them for
         # the next iteration
@@ -491,6 +843,8 @@ class RealImag(DataTreatment):
         Return the real and imaginary part.
     """
 
+    reduction = ('mean', 'mean')
+
 
 
     def __init__(self, acquisition_time, samplerate, frequency):
@@ -510,11 +864,8 @@ class RealImag(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         # Data save
         self.real_mean = 0.
@@ -532,12 +883,8 @@ class RealImag(DataTreatment):
             (real_mean, real_std, imag_mean, imag_std)
         """
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        real, imag = self.demodulator.demodulate(data)
 
         # We obtain the current averaging for both and save them for
         # the next iteration
@@ -562,6 +909,8 @@ class AmplitudePhasePerSequence(DataTreatment):
         Return the amplitude in V and the phase in rad
     """
 
+    reduction = ('mean', 'std', 'mean', 'std')
+
 
     def __init__(self, acquisition_time, samplerate, frequency,nb_sequence):
         """
@@ -580,11 +929,8 @@ class AmplitudePhasePerSequence(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         # We initialize np.array with the right dimension
         self.amp_mean = np.zeros(nb_sequence)
@@ -603,17 +949,13 @@ class AmplitudePhasePerSequence(DataTreatment):
 
     def process(self, data, queue_treatment, parameters):
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        real, imag = self.demodulator.demodulate(data)
 
-        amp      = 2.*np.sqrt(cos**2. + sin**2.)
+        amp      = np.sqrt(real**2. + imag**2.)
         amp_mean = self.mean_averaging(self.amp_mean, amp)
 
-        phase      = np.angle(cos + 1j*sin)
+        phase      = np.arctan2(imag, real)
         phase_mean = self.mean_averaging(self.phase_mean, phase)
 
         if self.treated_buffer < 2:
@@ -667,11 +1009,8 @@ class AmplitudePhasePerSequencedB(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         # Data save
         self.amp_mean = 0.
@@ -699,17 +1038,13 @@ class AmplitudePhasePerSequencedB(DataTreatment):
 
     def process(self, data, queue_treatment, parameters):
 
-        # Data in volt
-        data = self.data_in_volt(data)
-
         # Build cos and sin
-        cos = np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        sin = np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        real, imag = self.demodulator.demodulate(data)
 
-        amp      = 2.*np.sqrt(cos**2. + sin**2.)
+        amp      = np.sqrt(real**2. + imag**2.)
         amp_mean = self.mean_averaging(self.amp_mean, amp)
 
-        phase      = np.angle(cos + 1j*sin)
+        phase      = np.arctan2(imag, real)
         phase_mean = self.mean_averaging(self.phase_mean, phase)
 
         if self.treated_buffer < 2:
@@ -744,6 +1079,8 @@ class RealImagPerSequence(DataTreatment):
         Return the real part and the imaginary part in rad
     """
 
+    reduction = ('mean', 'mean')
+
 
     def __init__(self, acquisition_time, samplerate, frequency, t_ro = None):
         """
@@ -768,36 +1105,107 @@ class RealImagPerSequence(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        self.real_sum  = 0.
+        self.imag_sum  = 0.
+        self.nb_chunks = 0
 
-        self.real_mean = 0.
-        self.real_std  = 0.
-        self.imag_mean = 0.
-        self.imag_std  = 0.
+
+    def process(self, data, queue_treatment, parameters):
+
+            # The demodulation being linear, each sequence is demodulated and
+            # the few demodulated records are summed in float64, normalised
+            # only when the result is sent
+            real, imag = self.demodulator.demodulate(data)
+
+            self.real_sum   = self.real_sum + real
+            self.imag_sum   = self.imag_sum + imag
+            self.nb_chunks += 1
+
+            self.real_mean = self.real_sum/self.nb_chunks
+            self.imag_mean = self.imag_sum/self.nb_chunks
+
+            queue_treatment.put((self.real_mean, self.imag_mean))
+
+
+class SweepRealImag(DataTreatment):
+    """
+        By using the cos, sin method.
+        Return the real part and the imaginary part in V of each point of a
+        sweep stepped by the triggers, see ATS9360_NPT.sweep_initialization.
+        A sequence holds the nb_points points of the sweep one after the
+        other, each one acquired on records_per_point consecutive records:
+        record r of a sequence belongs to the point r//records_per_point.
+    """
+
+    reduction = ('mean', 'mean')
+
+
+    def __init__(self, acquisition_time, samplerate, frequency, nb_points,
+                 t_ro=None):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequency (float): in hertz
+                - nb_points (int): number of points of the sweep
+                - t_ro (float): in second
+        """
+
+        # We need an integer number of oscillations
+        if t_ro == None:
+            # here there is relevant signal on all the acquired data set
+            nb_oscillations = int(frequency*acquisition_time)
+        else:
+            # here there is relevant signal on only the t_ro part of the acquired data set
+            nb_oscillations = int(frequency*t_ro)
+
+        if nb_oscillations < 1:
+            raise ValueError('The number of acquired oscillations must be larger than 1')
+
+        if int(nb_points) < 1:
+            raise ValueError('The number of points must be larger than 1')
+
+        # We obtain the number of point in these oscillations
+        self.nb_points  = int(nb_oscillations/frequency*samplerate)
+        self.nb_sweep   = int(nb_points)
+
+        # Demodulation by the cos and sin of the sums of the raw data
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency,
+                                       dtype=np.float64)
+
+        self.data_sum  = 0
+        self.nb_chunks = 0
 
 
     def process(self, data, queue_treatment, parameters):
 
-            # Data in volt
-            data = self.data_in_volt(data)
+            if len(data) % self.nb_sweep:
+                raise ValueError('The number of sequence must be a multiple '\
+                                 'of the number of points')
 
-            # Build cos and sin
-            real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-            imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+            records_per_point = len(data)//self.nb_sweep
 
-            # We obtain the current averaging for both
-            real_mean = self.mean_averaging(self.real_mean, real)
-            imag_mean = self.mean_averaging(self.imag_mean, imag)
+            data = self.data_in_code(data)[:,:self.nb_points]
 
+            # The records of each point are summed exactly in int64 so that
+            # the demodulation, being linear, is done once per point
+            data = np.sum(np.reshape(data, (self.nb_sweep, records_per_point,
+                                            self.nb_points)),
+                          axis=1, dtype=np.int64)
 
-            self.real_mean = real_mean
-            self.imag_mean = imag_mean
+            if self.nb_chunks == 0:
+                self.data_sum = np.zeros(data.shape, dtype=np.int64)
+
+            self.data_sum  += data
+            self.nb_chunks += 1
+
+            # Demodulation of the mean of each point in V
+            self.real_mean, self.imag_mean = self.demodulator.demodulate(
+                            self.data_sum, self.nb_chunks*records_per_point)
 
-            #queue_treatment.put((self.real_mean, self.real_std, self.imag_mean, self.imag_std))
             queue_treatment.put((self.real_mean, self.imag_mean))
 
 
@@ -807,6 +1215,8 @@ class RealImag_raw(DataTreatment):
         using the cos, sin method.
     """
 
+    reduction = ('last', 'last')
+
     def __init__(self, acquisition_time, samplerate, frequency):
         """
             Input:
@@ -824,11 +1234,8 @@ class RealImag_raw(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         # Data save
         self.real_raw = []
@@ -844,11 +1251,8 @@ class RealImag_raw(DataTreatment):
             Real and imaginary parts will be array of length=averaging
         """
 
-        # Data in volt
-        data = self.data_in_volt(data)
         # Build cos and sin
-        real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-        imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+        real, imag = self.demodulator.demodulate(data)
 
         # We obtain the current averaging for both and save them for
         # the next iteration
@@ -868,46 +1272,297 @@ class RealImag_raw(DataTreatment):
         queue_treatment.put((self.real_raw, self.imag_raw))
 
 
+class MultiTone(DataTreatment):
+    """
+        Demodulate the records at several frequencies by the cos, sin
+        method, for the frequency multiplexed readout of several resonators
+        through the same channel.
+        All the tones are demodulated by a single matrix product.
+        Return the real and imaginary parts in V of each tone, shape
+        (nb_sequence, nb_tones):
+            - averaged over the buffers if raw is False,
+            - of the last buffer if raw is True.
+    """
+
+
+
+    def __init__(self, acquisition_time, samplerate, frequencies,
+                 windows=None, raw=False):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequencies (list): frequency of each tone in hertz
+                - windows (list): integration window (start, stop) of each
+                  tone in second. By default the whole acquisition time.
+                - raw (bool): return the real and imaginary parts of the
+                  records of the last buffer instead of their average.
+        """
+
+        if windows is None:
+            windows = [(0., acquisition_time)]*len(frequencies)
+
+        for start, stop in windows:
+            if start < 0. or stop > acquisition_time:
+                raise ValueError('The integration windows must be in the acquisition time')
+
+        self.raw = raw
+
+        if raw:
+            self.reduction = ('last', 'last')
+        else:
+            self.reduction = ('mean', 'mean')
+
+        self.demodulator = MultiToneDemodulator(samplerate, frequencies,
+                                                windows)
+
+        self.real_sum  = 0.
+        self.imag_sum  = 0.
+        self.nb_chunks = 0
+
+
+
+    def process(self, data, queue_treatment, parameters):
+
+        real, imag = self.demodulator.demodulate(data)
+
+        if self.raw:
+
+            queue_treatment.put((real, imag))
+
+        else:
+
+            # The demodulated records are few, their sums are kept in float64
+            # and normalised only when the result is sent
+            self.real_sum   = self.real_sum + real
+            self.imag_sum   = self.imag_sum + imag
+            self.nb_chunks += 1
+
+            queue_treatment.put((self.real_sum/self.nb_chunks,
+                                 self.imag_sum/self.nb_chunks))
+
+
+class IQHistogram(DataTreatment):
+    """
+        Demodulate each record by the cos, sin method and build, for each
+        record of the sequence, the 2D histogram of the real and imaginary
+        parts of the single shots, to discriminate the states of a qubit.
+        Only the histograms, and the populations if a discrimination line
+        is given, are sent, instead of the real and imaginary parts of every
+        shot.
+        The treatment process counts the shots in integers and sends the
+        counts once per buffer. The instrument returns the fraction of the
+        shots in each bin, shape (nb_sequence, nb_bins, nb_bins) with the
+        real part along the second axis, and the fraction of the shots
+        beyond the discrimination line, shape (nb_sequence,).
+        The shots out of the ranges are not counted in the histograms.
+    """
+
+    # The histograms are sent once per buffer
+    publish_per_buffer = True
+
+
+
+    def __init__(self, acquisition_time, samplerate, frequency, real_range,
+                 imag_range, nb_bins=100, discrimination=None, t_ro=None):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequency (float): in hertz
+                - real_range (tuple): (min, max) of the real part in V
+                - imag_range (tuple): (min, max) of the imaginary part in V
+                - nb_bins (int): number of bins along each axis
+                - discrimination (tuple): (angle, threshold) in rad and V.
+                  A shot is beyond the discrimination line when
+                  real*cos(angle) + imag*sin(angle) > threshold.
+                  If None, only the histograms are returned.
+                - t_ro (float): in second
+        """
+
+        # We need an integer number of oscillations
+        if t_ro == None:
+            # here there is relevant signal on all the acquired data set
+            nb_oscillations = int(frequency*acquisition_time)
+        else:
+            # here there is relevant signal on only the t_ro part of the acquired data set
+            nb_oscillations = int(frequency*t_ro)
+
+        if nb_oscillations < 1:
+            raise ValueError('The number of acquired oscillations must be larger than 1')
+
+        if real_range[1] <= real_range[0] or imag_range[1] <= imag_range[0]:
+            raise ValueError('The ranges must be given as (min, max)')
+
+        # We obtain the number of point in these oscillations
+        self.nb_points  = int(nb_oscillations/frequency*samplerate)
+
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
+
+        # Edges of the bins, for the display
+        self.nb_bins    = int(nb_bins)
+        self.real_edges = np.linspace(real_range[0], real_range[1], self.nb_bins + 1)
+        self.imag_edges = np.linspace(imag_range[0], imag_range[1], self.nb_bins + 1)
+
+        self.discrimination = discrimination
+
+        # The counts of the treatment processes are added
+        if discrimination is None:
+            self.reduction = ('sum', 'sum')
+        else:
+            self.reduction = ('sum', 'sum', 'sum')
+
+        # Number of shots in each bin and beyond the discrimination line,
+        # allocated for the first buffer, and bins of the shots of the
+        # current buffer, counted when the buffer is published.
+        self.counts   = None
+        self.beyond   = None
+        self.nb_shots = 0
+        self.bins     = []
+
+
+
+    def result_bytes(self, parameters):
+        """
+            The int64 counts of the sequence, with room for the pickling.
+        """
+
+        return 8*parameters['nb_sequence']*(self.nb_bins**2 + 1) + 4096
+
+
+
+    def process(self, data, queue_treatment, parameters):
+
+        real, imag = self.demodulator.demodulate(data)
+
+        nb_records = real.shape[0]
+
+        # Bin of each shot, the bins of the records of the sequence following
+        # each other in the flattened histograms
+        real_bin = np.floor((real - self.real_edges[0])\
+                            /(self.real_edges[-1] - self.real_edges[0])\
+                            *self.nb_bins).astype(np.int64)
+        imag_bin = np.floor((imag - self.imag_edges[0])\
+                            /(self.imag_edges[-1] - self.imag_edges[0])\
+                            *self.nb_bins).astype(np.int64)
+
+        inside = (real_bin >= 0) & (real_bin < self.nb_bins)\
+                 & (imag_bin >= 0) & (imag_bin < self.nb_bins)
+
+        index = (np.arange(nb_records)*self.nb_bins + real_bin)*self.nb_bins\
+                + imag_bin
+
+        self.bins.append(index[inside])
+        self.nb_shots += 1
+
+        if self.discrimination is not None:
+
+            if self.beyond is None:
+                self.beyond = np.zeros(nb_records, dtype=np.int64)
+
+            angle, threshold = self.discrimination
+            self.beyond += real*np.cos(angle) + imag*np.sin(angle) > threshold
+
+
+
+    def publish(self, queue_treatment, parameters):
+        """
+            Count the shots of the buffer in the histograms and send the
+            counts: (counts, nb_shots) or (counts, beyond, nb_shots).
+        """
+
+        nb_records = parameters['nb_sequence']
+
+        if self.counts is None:
+            self.counts = np.zeros(nb_records*self.nb_bins**2, dtype=np.int64)
+
+        # The counts are a new array rather than added in place: a
+        # multiprocessing queue pickles the sent arrays after put returns,
+        # they must not be modified afterwards
+        if self.bins:
+            self.counts = self.counts + np.bincount(np.concatenate(self.bins),
+                                                    minlength=self.counts.size)
+            self.bins = []
+
+        counts = self.counts.reshape(nb_records, self.nb_bins, self.nb_bins)
+
+        if self.discrimination is None:
+
+            queue_treatment.put((counts, self.nb_shots))
+
+        else:
+
+            if self.beyond is None:
+                self.beyond = np.zeros(nb_records, dtype=np.int64)
+
+            queue_treatment.put((counts, self.beyond.copy(), self.nb_shots))
+
+
+
+    def final_result(self, result):
+        """
+            Return the fraction of the shots in each bin and, with a
+            discrimination line, the fraction of the shots beyond it.
+        """
+
+        # No shot before the first complete sequence
+        nb_shots = max(result[-1], 1)
+
+        if self.discrimination is None:
+            return result[0]/float(nb_shots)
+        else:
+            return result[0]/float(nb_shots), result[1]/float(nb_shots)
+
+
 class Average_IQ(DataTreatment):
     """
         Class performing the average of the acquired data.
+        The records are demodulated sample by sample, the 2 omega component
+        is filtered out and the real and imaginary parts are decimated by the
+        decimation factor before being averaged.
     """
 
-    def __init__(self, acquisition_time, samplerate, frequency, f_cutoff, order=1):
+    reduction = ('mean', 'mean')
+
+    def __init__(self, acquisition_time, samplerate, frequency, f_cutoff,
+                 order=1, decimation=1):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - frequency (float): in hertz
+                - f_cutoff (float): cutoff of the Butterworth low-pass filter
+                  in hertz
+                - order (int): order of the filter
+                - decimation (int): one sample every decimation is kept after
+                  the filtering
+        """
 
         # We obtain the number of point in these oscillations
         self.nb_points = int(samplerate*acquisition_time)
 
-        # print 'size:', self.nb_points
         # We calculate the sin and cos
         time = np.arange(self.nb_points)/samplerate
 
         self.cos = np.cos(2.*np.pi*frequency*time)
         self.sin = np.sin(2.*np.pi*frequency*time)
 
-        # self.mat = np.zeros((self.nb_points, self.nb_points))
-
+        # The volt per 16-bit sample value and the factor 2 of the
+        # demodulation are folded in the float32 local oscillators
+        self.lo_cos = (2.*0.4/2047.5/16.*self.cos).astype(np.float32)
+        self.lo_sin = (2.*0.4/2047.5/16.*self.sin).astype(np.float32)
 
         beta = f_cutoff/samplerate
-        # alpha = 1. - beta
 
-        # for i in np.arange(self.nb_points):
-                # for j in np.arange(self.nb_points):
-                #     if j<i or j==i:
-                #         self.mat[i,j] = alpha**(i-j)
+        self.decimator = Decimator(scisig.butter(order, beta, btype='low',
+                                                 output='sos'),
+                                   decimation)
 
-        # self.mat = self.mat*beta
-        # for i in np.arange(order-1):
-        #     print i
-        #     self.mat = np.dot(self.mat, self.mat)
-
-        # if order == 0:
-        #     self.mat = np.identity(self.nb_points)
-        self.B, self.A = scisig.butter(order, beta, btype='low' )
-        # Data save
-        self.real = np.zeros(self.nb_points)
-
-        self.imag = np.zeros(self.nb_points)
+        # Sums of the filtered real and imaginary parts
+        self.real_sum  = 0.
+        self.imag_sum  = 0.
+        self.nb_chunks = 0
 
 
     def process(self, data, queue_treatment, parameters):
@@ -915,37 +1570,25 @@ class Average_IQ(DataTreatment):
             Calculate the average of the current buffer and average it with
             the previous measured data.
             Return the data in the memory buffer as the following:
-            (data, std)
+            (real, imag)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
-
-        real = 2.*data*self.cos
-        imag = 2.*data*self.sin
-        # print 'dt real',np.shape(real)
+        # The 16-bit sample values are centred on the zero volt value
+        # 16*2047.5 = 32760
+        data = np.subtract(data, 32760, dtype=np.float32)
 
         # we filter the 2 omega
-        # real_filtered = np.dot(self.mat, real)
-        # imag_filtered = np.dot(self.mat, imag)
-        # real_filtered = scisig.filtfilt(self.B, self.A, real)
-        # imag_filtered = scisig.filtfilt(self.B, self.A, imag)
+        real_filtered = self.decimator.filter(data*self.lo_cos)
+        imag_filtered = self.decimator.filter(data*self.lo_sin)
 
-        real_filtered = scisig.lfilter(self.B, self.A, real)
-        imag_filtered = scisig.lfilter(self.B, self.A, imag)
-        # print 'dt real filtered',np.shape(real_filtered)
-
-        # # We obtain the current averaging for both
-        real = self.mean_averaging(self.real, real_filtered)
-        imag = self.mean_averaging(self.imag, imag_filtered)
-
-        # print np.shape(real)
-        # print type(real)
-        self.real = real
-        self.imag = imag
+        # We obtain the current averaging for both at the decimated rate
+        self.real_sum   = np.add(self.real_sum, real_filtered, dtype=np.float64)
+        self.imag_sum   = np.add(self.imag_sum, imag_filtered, dtype=np.float64)
+        self.nb_chunks += 1
 
         # Send the result with the real and imaginary parts in V
-        queue_treatment.put((self.real, self.imag))
+        queue_treatment.put((self.real_sum/self.nb_chunks,
+                             self.imag_sum/self.nb_chunks))
 
 ################################################################################
 # Test Remy 2017_11_21
@@ -959,6 +1602,8 @@ class SeveralRealImagPerSequence(DataTreatment):
         Return the real part and the imaginary part in V
     """
 
+    reduction = ('mean', 'mean')
+
 
     def __init__(self, acquisition_time, samplerate, frequency, N, *args):
         """
@@ -1009,12 +1654,16 @@ class SeveralRealImagPerSequence(DataTreatment):
     def process(self, data, queue_treatment, parameters):
 
             # Data in volt
-            data = self.data_in_volt(data)
+            data = self.data_in_volt(data, self.dtype)
+
+            # cos and sin in the type of the data
+            cos = self.cos.astype(self.dtype, copy=False)
+            sin = self.sin.astype(self.dtype, copy=False)
 
             # Build cos and sin
             for i in np.arange(self.N):
-                self.real[i] = 2.*np.mean(data[:,self.nb_points[i,0]:self.nb_points[i,1]]*self.cos, axis=1)
-                self.imag[i] = 2.*np.mean(data[:,self.nb_points[i,0]:self.nb_points[i,1]]*self.sin, axis=1)
+                self.real[i] = 2.*np.mean(data[:,self.nb_points[i,0]:self.nb_points[i,1]]*cos, axis=1)
+                self.imag[i] = 2.*np.mean(data[:,self.nb_points[i,0]:self.nb_points[i,1]]*sin, axis=1)
 
             # We obtain the current averaging for both
             self.real_mean  = self.mean_averaging(self.real_mean, self.real)
@@ -1036,6 +1685,8 @@ class RealImagPerSequence_reset(DataTreatment):
         Return the real part and the imaginary part in rad
     """
 
+    reduction = ('last', 'last')
+
 
     def __init__(self, acquisition_time, samplerate, frequency, t_ro = None):
         """
@@ -1060,11 +1711,8 @@ class RealImagPerSequence_reset(DataTreatment):
         # We obtain the number of point in these oscillations
         self.nb_points  = int(nb_oscillations/frequency*samplerate)
 
-        # We calculate the sin and cos
-        time = np.arange(self.nb_points)/samplerate
-
-        self.cos = np.cos(2.*np.pi*frequency*time)
-        self.sin = np.sin(2.*np.pi*frequency*time)
+        # Demodulation by the cos and sin
+        self.demodulator = Demodulator(self.nb_points, samplerate, frequency)
 
         self.real= 0.
         self.imag = 0.
@@ -1072,12 +1720,8 @@ class RealImagPerSequence_reset(DataTreatment):
 
     def process(self, data, queue_treatment, parameters):
 
-            # Data in volt
-            data = self.data_in_volt(data)
-
             # Build cos and sin
-            self.real = 2.*np.mean(data[:,:self.nb_points]*self.cos, axis=1)
-            self.imag = 2.*np.mean(data[:,:self.nb_points]*self.sin, axis=1)
+            self.real, self.imag = self.demodulator.demodulate(data)
 
 
             queue_treatment.put((self.real, self.imag))
@@ -1091,6 +1735,8 @@ class HomodyneRealImagPerSequence(DataTreatment):
         Return the real part and the imaginary part in V
     """
 
+    reduction = ('mean', 'mean')
+
 
     def __init__(self, pulse_time, samplerate, delta_t):
         """
@@ -1116,7 +1762,7 @@ class HomodyneRealImagPerSequence(DataTreatment):
     def process(self, data, queue_treatment, parameters):
 
             # Data in volt
-            data = self.data_in_volt(data)
+            data = self.data_in_volt(data, self.dtype)
             # print np.shape(data)
             # print self.nb_points
 
@@ -1140,6 +1786,8 @@ class HomodyneRealImag_raw(DataTreatment):
         using the cos, sin method.
     """
 
+    reduction = ('last', 'last')
+
     def __init__(self, pulse_time, samplerate, delta_t):
         """
             Input:
@@ -1168,7 +1816,7 @@ class HomodyneRealImag_raw(DataTreatment):
         """
 
         # Data in volt
-        data = self.data_in_volt(data)
+        data = self.data_in_volt(data, self.dtype)
 
         self.data_pulse_raw = np.mean(data[:,:self.nb_points], axis=1)
         self.data_nopulse_raw = np.mean(data[:,self.nb_points2:], axis=1)
@@ -1182,6 +1830,8 @@ class HomodyneRealImag_raw_sevRO(DataTreatment):
         using the cos, sin method.
     """
 
+    reduction = ('last', 'last', 'last')
+
     def __init__(self, pulse_time1, t1_start, pulse_time2, t2_start, samplerate, delta_t):
         """
             Input:
@@ -1215,7 +1865,7 @@ class HomodyneRealImag_raw_sevRO(DataTreatment):
         """
 
         # Data in volt
-        data = self.data_in_volt(data)
+        data = self.data_in_volt(data, self.dtype)
 
         self.data_pulse_raw1 = np.mean(data[:,self.nb_points_start1:self.nb_points_end1], axis=1)
         self.data_pulse_raw2 = np.mean(data[:,self.nb_points_start2:self.nb_points_end2], axis=1)
@@ -1232,6 +1882,8 @@ class HomodyneRealImag_Nraw(DataTreatment):
         Return the real part and the imaginary part in V
     """
 
+    reduction = ('last', 'last')
+
 
     def __init__(self, pulse_time, samplerate, delta_t, N):
         """
@@ -1255,7 +1907,7 @@ class HomodyneRealImag_Nraw(DataTreatment):
     def process(self, data, queue_treatment, parameters):
 
             # Data in volt
-            data = self.data_in_volt(data)
+            data = self.data_in_volt(data, self.dtype)
 
             for i in np.arange(self.N):
                 self.data_pulse_raw[i][:] = np.mean(data[:,i*self.nb_points:(i+1)*self.nb_points], axis=1)
@@ -1311,18 +1963,42 @@ class HomodyneRealImag_Nraw(DataTreatment):
 class Homodyne_Tchebytchev(DataTreatment):
     """
         Class performing the Tchebytchev data.
+        The records are filtered by a Chebyshev type II low-pass filter and
+        decimated by the decimation factor before being averaged.
     """
 
-    def __init__(self, acquisition_time, samplerate, f_cutoff, r_dB, order, doweaverage):
+    def __init__(self, acquisition_time, samplerate, f_cutoff, r_dB, order,
+                 doweaverage, decimation=1):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - f_cutoff (float): cutoff of the low-pass filter in hertz
+                - r_dB (float): minimum attenuation of the stop band in dB
+                - order (int): order of the filter
+                - doweaverage (bool): average the filtered records over the
+                  buffers
+                - decimation (int): one sample every decimation is kept after
+                  the filtering
+        """
 
         # We obtain the number of point
         self.nb_points = int(samplerate*acquisition_time)
         self.doweaverage = doweaverage
         beta = f_cutoff/samplerate
 
-        self.B, self.A = scisig.cheby2(order, r_dB, beta, btype='low' )
+        self.decimator = Decimator(scisig.cheby2(order, r_dB, beta,
+                                                 btype='low', output='sos'),
+                                   decimation)
+
+        if doweaverage:
+            self.reduction = 'mean'
+        else:
+            self.reduction = 'last'
+
         # Data save
-        self.data = np.zeros(self.nb_points)
+        self.data_sum  = 0.
+        self.nb_chunks = 0
 
     def process(self, data, queue_treatment, parameters):
         """
@@ -1332,18 +2008,20 @@ class Homodyne_Tchebytchev(DataTreatment):
             (data, std)
         """
 
-        # We obtain the data in volt
-        data = self.data_in_volt(data)
-        # print np.shape(data)
-        data_filtered = scisig.lfilter(self.B, self.A, data,  axis=1)
-        # print np.shape(data_filtered)
+        # The filter being linear, the 16-bit sample values centred on the
+        # zero volt value 16*2047.5 = 32760 are filtered and converted in V
+        # at the decimated rate
+        data = np.subtract(data, 32760, dtype=np.float32)
+        data_filtered = np.multiply(self.decimator.filter(data),
+                                    0.4/2047.5/16., dtype=np.float64)
 
         if self.doweaverage:
-            self.data = self.mean_averaging(self.data, data_filtered)
-        else:
-            self.data = data_filtered
+            self.data_sum   = self.data_sum + data_filtered
+            self.nb_chunks += 1
 
-        queue_treatment.put((self.data))
+            queue_treatment.put((self.data_sum/self.nb_chunks))
+        else:
+            queue_treatment.put((data_filtered))
 
 
 class HomodyneRealImagPerSequenceWeighted(DataTreatment):
@@ -1352,6 +2030,8 @@ class HomodyneRealImagPerSequenceWeighted(DataTreatment):
         Return the real part and the imaginary part in V
     """
 
+    reduction = ('mean', 'mean')
+
 
     def __init__(self, acquisition_time, pulse_time, samplerate, delta_t, tau, t_start=0.):
         """
@@ -1389,10 +2069,13 @@ class HomodyneRealImagPerSequenceWeighted(DataTreatment):
     def process(self, data, queue_treatment, parameters):
 
             # Data in volt
-            data = self.data_in_volt(data)
+            data = self.data_in_volt(data, self.dtype)
+
+            # Ideal pulse in the type of the data
+            ideal_pulse = self.ideal_pulse.astype(self.dtype, copy=False)
 
             # Build cos and sin
-            data_sig = np.mean(self.ideal_pulse[:self.nb_points]*data[:,:self.nb_points], axis=1)#/np.mean(self.ideal_pulse)
+            data_sig = np.mean(ideal_pulse[:self.nb_points]*data[:,:self.nb_points], axis=1)#/np.mean(self.ideal_pulse)
             data_no_sig = np.mean(data[:,self.nb_points2:], axis=1)
             # print np.shape(data)
             # We obtain the current averaging for both
@@ -1411,6 +2094,8 @@ class HomodyneRealImag_rawWeighted(DataTreatment):
         using the cos, sin method.
     """
 
+    reduction = ('last', 'last')
+
     def __init__(self, acquisition_time, pulse_time, samplerate, delta_t, tau, t_start=0.):
         """
             Input:
@@ -1449,10 +2134,13 @@ class HomodyneRealImag_rawWeighted(DataTreatment):
         """
 
         # Data in volt
-        data = self.data_in_volt(data)
+        data = self.data_in_volt(data, self.dtype)
+
+        # Ideal pulse in the type of the data
+        ideal_pulse = self.ideal_pulse.astype(self.dtype, copy=False)
 
         # self.data_pulse_raw = np.mean(data[:,:self.nb_points], axis=1)
-        self.data_pulse_raw = np.mean(self.ideal_pulse[None, :self.nb_points]*data[:,:self.nb_points], axis=1)#\
+        self.data_pulse_raw = np.mean(ideal_pulse[None, :self.nb_points]*data[:,:self.nb_points], axis=1)#\
                             #/np.mean(self.ideal_pulse)
         self.data_nopulse_raw = np.mean(data[:,self.nb_points2:], axis=1)
 
@@ -1466,6 +2154,8 @@ class HomodyneRealImag_raw_sevROWeighted(DataTreatment):
         using the cos, sin method.
     """
 
+    reduction = ('last', 'last', 'last')
+
     def __init__(self, acquisition_time, pulse_time1, t1_start, pulse_time2,
                                 t2_start, samplerate, delta_t, tau):
         """
@@ -1522,15 +2212,19 @@ class HomodyneRealImag_raw_sevROWeighted(DataTreatment):
         """
 
         # Data in volt
-        data = self.data_in_volt(data)
+        data = self.data_in_volt(data, self.dtype)
+
+        # Ideal pulses in the type of the data
+        ideal_pulse1 = self.ideal_pulse1.astype(self.dtype, copy=False)
+        ideal_pulse2 = self.ideal_pulse2.astype(self.dtype, copy=False)
 
         # self.data_pulse_raw1 = np.mean(data[:,self.nb_points_start1:self.nb_points_end1], axis=1)
 
-        self.data_pulse_raw1 = np.mean(self.ideal_pulse1[None,self.nb_points_start1:self.nb_points_end1]\
+        self.data_pulse_raw1 = np.mean(ideal_pulse1[None,self.nb_points_start1:self.nb_points_end1]\
                     *data[:,self.nb_points_start1:self.nb_points_end1], axis=1)#\
                     # /np.mean(self.ideal_pulse1)
 
-        self.data_pulse_raw2 =  np.mean(self.ideal_pulse2[None,self.nb_points_start2:self.nb_points_end2]\
+        self.data_pulse_raw2 =  np.mean(ideal_pulse2[None,self.nb_points_start2:self.nb_points_end2]\
                     *data[:,self.nb_points_start2:self.nb_points_end2], axis=1)#\
                     # /np.mean(self.ideal_pulse2)
         # np.mean(data[:,self.nb_points_start2:self.nb_points_end2], axis=1)
@@ -1540,3 +2234,203 @@ class HomodyneRealImag_raw_sevROWeighted(DataTreatment):
         # self.data_pulse_raw1 -= self.data_nopulse_raw
         # self.data_pulse_raw2 -= self.data_nopulse_raw
         queue_treatment.put((self.data_pulse_raw1, self.data_pulse_raw2, self.data_nopulse_raw))
+
+
+class HomodyneMatchedFilterCalibration(DataTreatment):
+    """
+        Calibration of the integration kernel of HomodyneMatchedFilter.
+        Two records of each sequence are measured with the qubit prepared in
+        the ground state and in the excited state.
+        Their mean traces and the variance of their noise are accumulated
+        and the optimal integration kernel, for a noise without correlation
+        between samples, is obtained from them:
+            kernel = (mean_excited - mean_ground)/variance
+        normalised to a maximum of 1 as the ideal_pulse of the weighted
+        processors.
+        Return (kernel, mean_ground, mean_excited), the mean traces in V.
+    """
+
+
+
+    def __init__(self, acquisition_time, samplerate, ground=0, excited=1):
+        """
+            Input:
+                - acquisition_time (float): in second
+                - samplerate (float): in sample per second
+                - ground (int): index in the sequence of the record with the
+                  qubit in the ground state
+                - excited (int): index in the sequence of the record with
+                  the qubit in the excited state
+        """
+
+        self.nb_points = int(samplerate*acquisition_time)
+
+        if self.nb_points < 1:
+            raise ValueError('The number of acquired points must be larger than 1')
+
+        self.records = [ground, excited]
+
+        # Sums of the 16-bit sample values and of their square, exact in
+        # int64, allocated for the first sequence
+        self.data_sum   = None
+        self.square_sum = None
+        self.nb_chunks  = 0
+
+
+
+    def process(self, data, queue_treatment, parameters):
+
+        data = self.data_in_code(data)[self.records,:self.nb_points]
+
+        if self.data_sum is None:
+            self.data_sum   = np.zeros(data.shape, dtype=np.int64)
+            self.square_sum = np.zeros(data.shape, dtype=np.int64)
+
+        self.data_sum   += data
+        self.square_sum += np.square(data, dtype=np.uint32)
+        self.nb_chunks  += 1
+
+        mean = self.sum_in_volt(self.data_sum, self.nb_chunks)
+
+        # Variance of the noise in V**2, averaged over both states
+        code_mean = self.data_sum/float(self.nb_chunks)
+        variance  = (0.4/2047.5/16.)**2\
+                    *np.mean(self.square_sum/float(self.nb_chunks) - code_mean**2,
+                             axis=0)
+
+        # Without estimation of the noise yet, the kernel is null
+        kernel = np.divide(mean[1] - mean[0], variance,
+                           out=np.zeros(variance.shape), where=variance > 0.)
+
+        if np.max(np.abs(kernel)) > 0.:
+            kernel /= np.max(np.abs(kernel))
+
+        queue_treatment.put((kernel, mean[0], mean[1]))
+
+
+
+class HomodyneMatchedFilter(DataTreatment):
+    """
+        By using the homodyne method with an integration kernel, for
+        instance the one given by HomodyneMatchedFilterCalibration.
+        Return, for each record of the sequence, np.mean(kernel*data) with
+        the data in V, taken from the beginning of the record:
+            - averaged over the buffers if raw is False,
+            - of the last buffer if raw is True.
+    """
+
+
+
+    def __init__(self, kernel, raw=False):
+        """
+            Input:
+                - kernel (array): integration kernel, one weight per sample
+                - raw (bool): return the integration of the records of the
+                  last buffer instead of their average.
+        """
+
+        self.kernel    = np.asarray(kernel, dtype=np.float64)
+        self.nb_points = self.kernel.size
+
+        if self.nb_points < 1:
+            raise ValueError('The number of acquired points must be larger than 1')
+
+        # The volt per 16-bit sample value and the normalisation are folded
+        # in the float32 kernel used for the matrix product
+        self.weights = (0.4/2047.5/16.*self.kernel/self.nb_points)\
+                       .astype(np.float32)
+
+        self.raw = raw
+        if raw:
+            self.reduction = 'last'
+        else:
+            self.reduction = 'mean'
+
+        self.data_sum  = 0.
+        self.nb_chunks = 0
+
+
+
+    def process(self, data, queue_treatment, parameters):
+
+        # The 16-bit sample values are centred on the zero volt value
+        # 16*2047.5 = 32760 while they are converted for the matrix product
+        data = np.subtract(data[:,:self.nb_points], 32760, dtype=np.float32)
+        data = np.dot(data, self.weights).astype(np.float64)
+
+        if self.raw:
+
+            queue_treatment.put(data)
+
+        else:
+
+            self.data_sum   = self.data_sum + data
+            self.nb_chunks += 1
+
+            queue_treatment.put(self.data_sum/self.nb_chunks)
+
+
+
+class PowerSpectrum(DataTreatment):
+    """
+        Average the spectra computed by the on-FPGA FFT, in the "FFT" mode
+        of the instrument, see ATS9360_NPT.set_fft. No FFT is computed by
+        the host.
+        The records are read in the output format of the FFT and averaged in
+        place in float64:
+            - power spectra for the AMP2 formats,
+            - spectra in dB for the LOG formats, averaged as given,
+            - real or imaginary parts for the REAL_S32 and IMAG_S32 formats,
+              which are then averaged coherently.
+        Return (frequency, spectrum): the frequency in MHz of the bins, from
+        0 to half the samplerate, and for each record of the sequence its
+        averaged spectrum in the units of the output format.
+    """
+
+    reduction = ('last', 'mean')
+
+    # Type of the output samples of each output format of the on-FPGA FFT
+    dtypes = {'U32'        : np.uint32,
+              'U16_LOG'    : np.uint16,
+              'U16_AMP2'   : np.uint16,
+              'U8_LOG'     : np.uint8,
+              'U8_AMP2'    : np.uint8,
+              'REAL_S32'   : np.int32,
+              'IMAG_S32'   : np.int32,
+              'FLOAT_AMP2' : np.float32,
+              'FLOAT_LOG'  : np.float32}
+
+
+
+    def __init__(self):
+
+        self.spectrum_sum = None
+        self.frequency    = None
+        self.nb_chunks    = 0
+
+
+
+    def process(self, data, queue_treatment, parameters):
+
+        # The buffers are transferred as 16 bits words, they are read in the
+        # output format
+        spectra = np.ascontiguousarray(self.data_in_code(data))\
+                    .view(self.dtypes[parameters['fft_format']])
+
+        # For the first sequence, the sum and the frequencies are allocated
+        if self.spectrum_sum is None:
+
+            self.spectrum_sum = np.zeros(spectra.shape, dtype=np.float64)
+
+            # The records are padded up to the length of the FFT
+            fft_length = 1
+            while fft_length < parameters['samplesPerRecord']:
+                fft_length *= 2
+
+            self.frequency = np.arange(spectra.shape[1])\
+                             *parameters['samplerate']/float(fft_length)
+
+        np.add(self.spectrum_sum, spectra, out=self.spectrum_sum)
+        self.nb_chunks += 1
+
+        queue_treatment.put((self.frequency, self.spectrum_sum/self.nb_chunks))
@@ -0,0 +1,200 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    Demodulation of the records by the cos, sin method.
+
+    The processors used to compute 2.*np.mean(data_in_volt(data)*cos, axis=1)
+    and the same with the sin: two conversions in volt, two full size
+    temporaries and two passes over the data.
+    The Demodulator stores the cos and sin in a single local oscillator
+    matrix of shape (nb_points, 2) in which the conversion in volt and the
+    normalisation are folded. The demodulation of all the records of a
+    buffer is then a single conversion of the raw data followed by a single
+    matrix product done by BLAS.
+    The MultiToneDemodulator does the same for several frequencies read
+    through the same channel: one pair of columns per tone.
+"""
+
+from __future__ import division
+import numpy as np
+
+
+class Demodulator(object):
+    """
+        Demodulate the records at the frequency by the cos, sin method.
+        Return the real and imaginary parts in V:
+            real = 2.*np.mean(data_in_volt(data)*cos, axis=1)
+            imag = 2.*np.mean(data_in_volt(data)*sin, axis=1)
+    """
+
+
+
+    def __init__(self, nb_points, samplerate, frequency, dtype=np.float32):
+        """
+            Input:
+                - nb_points (int): number of points demodulated at the
+                  beginning of each record
+                - samplerate (float): in sample per second
+                - frequency (float): in hertz
+                - dtype (numpy dtype): type of the matrix product.
+                  The conversion of raw 16-bit sample values is exact in
+                  float32 and the float32 product matches the float64 one to
+                  about 1e-7 relative. Use float64 to demodulate sums of
+                  them or to keep the double precision of the float64
+                  processors.
+        """
+
+        self.nb_points = int(nb_points)
+        self.dtype     = dtype
+
+        # We calculate the sin and cos
+        time = np.arange(self.nb_points)/samplerate
+
+        self.cos = np.cos(2.*np.pi*frequency*time)
+        self.sin = np.sin(2.*np.pi*frequency*time)
+
+        # Local oscillator with the volt per 16-bit sample value and the
+        # normalisation 2/nb_points folded in
+        self.lo = np.empty((self.nb_points, 2), dtype=dtype)
+        self.lo[:,0] = 2.*0.4/2047.5/16.*self.cos/self.nb_points
+        self.lo[:,1] = 2.*0.4/2047.5/16.*self.sin/self.nb_points
+
+
+
+    def demodulate(self, data, nb_data=1):
+        """
+            Demodulate the records of data.
+
+            Input:
+                - data (array): records of raw data coming from the board,
+                  one record per line, or sums of nb_data of them.
+                - nb_data (int): number of raw data summed in data.
+
+            Output:
+                - real (array): real part in V, one per record
+                - imag (array): imaginary part in V, one per record
+        """
+
+        # The 16-bit sample values are centred on the zero volt value
+        # 16*2047.5 = 32760 while they are converted for the matrix product
+        data = np.subtract(data[:,:self.nb_points], 32760*nb_data,
+                           dtype=self.dtype)
+
+        # The results are few, they are given in float64 as the processors
+        # work with
+        result = np.dot(data, self.lo).astype(np.float64)
+
+        if nb_data != 1:
+            result /= nb_data
+
+        return result[:,0], result[:,1]
+
+
+
+class MultiToneDemodulator(object):
+    """
+        Demodulate the records at several frequencies, each one in its own
+        integration window, with a single matrix product.
+        Return the real and imaginary parts in V of each tone:
+            real[:,i] = 2.*np.mean(data_in_volt(data[:,window_i])*cos_i, axis=1)
+            imag[:,i] = 2.*np.mean(data_in_volt(data[:,window_i])*sin_i, axis=1)
+    """
+
+
+
+    def __init__(self, samplerate, frequencies, windows, dtype=np.float32):
+        """
+            Input:
+                - samplerate (float): in sample per second
+                - frequencies (list): frequency of each tone in hertz
+                - windows (list): integration window (start, stop) of each
+                  tone in second from the beginning of the record.
+                  As for the single tone processors, only the integer number
+                  of oscillations at the beginning of the window is used.
+                - dtype (numpy dtype): type of the matrix product.
+                  The conversion of raw 16-bit sample values is exact in
+                  float32 and the float32 product matches the float64 one to
+                  about 1e-7 relative. Use float64 to demodulate sums of
+                  them or to keep the double precision of the float64
+                  processors.
+        """
+
+        if len(frequencies) != len(windows):
+            raise ValueError('There must be one integration window per tone')
+
+        self.nb_tones = len(frequencies)
+        self.dtype    = dtype
+
+        # Integration window of each tone in points
+        self.windows = []
+        for frequency, (start, stop) in zip(frequencies, windows):
+
+            nb_oscillations = int(frequency*(stop - start))
+
+            if nb_oscillations < 1:
+                raise ValueError('The number of acquired oscillations must be larger than 1')
+
+            first = int(round(start*samplerate))
+            self.windows.append((first,
+                                 first + int(nb_oscillations/frequency*samplerate)))
+
+        self.nb_points = max(stop for start, stop in self.windows)
+
+        time = np.arange(self.nb_points)/samplerate
+
+        # Local oscillators of the tones, the cos then the sin, with the
+        # volt per 16-bit sample value and the normalisation folded in.
+        # They are null out of their integration window.
+        self.lo = np.zeros((self.nb_points, 2*self.nb_tones), dtype=dtype)
+        for i, (frequency, (start, stop)) in enumerate(zip(frequencies,
+                                                           self.windows)):
+
+            factor = 2.*0.4/2047.5/16./(stop - start)
+            phase  = 2.*np.pi*frequency*time[start:stop]
+
+            self.lo[start:stop,i]               = factor*np.cos(phase)
+            self.lo[start:stop,self.nb_tones+i] = factor*np.sin(phase)
+
+
+
+    def demodulate(self, data, nb_data=1):
+        """
+            Demodulate the records of data at all the frequencies.
+
+            Input:
+                - data (array): records of raw data coming from the board,
+                  one record per line, or sums of nb_data of them.
+                - nb_data (int): number of raw data summed in data.
+
+            Output:
+                - real (array): real parts in V, shape (records, tones)
+                - imag (array): imaginary parts in V, shape (records, tones)
+        """
+
+        # The 16-bit sample values are centred on the zero volt value
+        # 16*2047.5 = 32760 while they are converted for the matrix product
+        data = np.subtract(data[:,:self.nb_points], 32760*nb_data,
+                           dtype=self.dtype)
+
+        result = np.dot(data, self.lo).astype(np.float64)
+
+        if nb_data != 1:
+            result /= nb_data
+
+        return result[:,:self.nb_tones], result[:,self.nb_tones:]
@@ -0,0 +1,93 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    Low-pass filtering and decimation of the records.
+
+    The filter is applied as second-order sections, which stay stable in
+    float32 where the transfer function of a high order filter with a low
+    cutoff does not. Once the high frequencies are filtered out, most of the
+    samples are redundant: only one sample every factor is kept so that the
+    averaging, the memory and the transfer of the results run at the reduced
+    rate.
+    The filter being recursive, all the samples have to be filtered before
+    the decimation, the saving of a polyphase decomposition only applies to
+    FIR filters.
+"""
+
+from __future__ import division
+import numpy as np
+import scipy.signal as scisig
+
+
+class Decimator(object):
+    """
+        Filter each record independently, from a null initial state as
+        scipy.signal.lfilter does, and keep one sample every factor.
+    """
+
+
+
+    def __init__(self, sos, factor=1, dtype=np.float32):
+        """
+            Input:
+                - sos (array): second-order sections of the filter, as given
+                  by the scipy.signal filter design functions with
+                  output='sos'.
+                - factor (int): decimation factor, 1 to keep all the samples
+                - dtype (numpy dtype): type of the filtering
+        """
+
+        if int(factor) < 1:
+            raise ValueError('The decimation factor must be larger than 1')
+
+        self.sos    = np.asarray(sos, dtype=dtype)
+        self.factor = int(factor)
+        self.dtype  = dtype
+
+
+
+    def nb_points(self, nb_points):
+        """
+            Return the number of points of a record of nb_points once
+            decimated.
+        """
+
+        return -(-nb_points//self.factor)
+
+
+
+    def filter(self, data):
+        """
+            Filter and decimate the records of data.
+
+            Input:
+                - data (array): records, one per line, or a single record.
+
+            Output:
+                - data (array): filtered records, one sample every factor.
+        """
+
+        data = scisig.sosfilt(self.sos, np.asarray(data, dtype=self.dtype),
+                              axis=-1)
+
+        if self.factor == 1:
+            return data
+        else:
+            # A copy is kept so that the full rate records are freed
+            return np.array(data[...,::self.factor])
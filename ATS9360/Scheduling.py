@@ -0,0 +1,175 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    CPU affinity and scheduling priority of the acquisition and treatment
+    processes.
+
+    The processes compete for the cores with the GUI and the plots of the
+    measurement program: a redraw delaying the acquisition process more than
+    the DMA buffers posted to the board can hold overflows the acquisition.
+    Pinning the processes on cores left to them and raising their priority
+    keeps them running.
+    Only the standard library is used, through ctypes: the system calls of
+    Linux and the kernel32 functions of Windows.
+
+    Priorities:
+        'high'     : nice value of -10 on Linux, HIGH_PRIORITY_CLASS on
+                     Windows.
+        'realtime' : SCHED_RR on Linux, REALTIME_PRIORITY_CLASS on Windows.
+                     Windows gives HIGH_PRIORITY_CLASS instead without the
+                     administrator rights. A real-time process which never
+                     blocks starves the cores it runs on, it should be
+                     pinned on cores left to it.
+"""
+
+import os
+import sys
+import ctypes
+import ctypes.util
+
+
+PRIORITIES = ('high', 'realtime')
+
+# Linux
+PRIO_PROCESS     = 0
+HIGH_NICE        = -10
+SCHED_RR         = 2
+REALTIME_RR_PRIO = 10
+
+# Windows
+PROCESS_SET_INFORMATION   = 0x0200
+PROCESS_QUERY_INFORMATION = 0x0400
+PRIORITY_CLASSES = {'high'     : 0x00000080,
+                    'realtime' : 0x00000100}
+
+
+def set_affinity(pid, cpus):
+    """
+        Pin a process on a set of CPUs.
+
+        Input:
+            - pid (int): identifier of the process
+            - cpus (iterable): indices of the CPUs the process may run on
+
+        Raise OSError if the system refuses it or does not support it.
+    """
+
+    cpus = sorted(set(int(cpu) for cpu in cpus))
+
+    if not cpus or cpus[0] < 0:
+        raise ValueError('The CPUs must be a non empty set of non negative '\
+                         'indices')
+
+    if sys.platform.startswith('linux'):
+
+        libc = _libc()
+
+        # cpu_set_t of 1024 CPUs
+        bits = 8*ctypes.sizeof(ctypes.c_ulong)
+        mask = (ctypes.c_ulong*(1024//bits))()
+        for cpu in cpus:
+            mask[cpu//bits] |= 1 << (cpu % bits)
+
+        _check(libc.sched_setaffinity(pid, ctypes.sizeof(mask), mask))
+
+    elif sys.platform == 'win32':
+
+        mask = 0
+        for cpu in cpus:
+            mask |= 1 << cpu
+
+        _windows_call(pid, 'SetProcessAffinityMask', ctypes.c_size_t(mask))
+
+    else:
+        raise OSError('The CPU affinity is not supported on '+sys.platform)
+
+
+
+def set_priority(pid, priority):
+    """
+        Raise the scheduling priority of a process.
+
+        Input:
+            - pid (int): identifier of the process
+            - priority (string): "high" or "realtime", see the module
+
+        Raise OSError if the system refuses it or does not support it.
+    """
+
+    if priority not in PRIORITIES:
+        raise ValueError('priority must be "high" or "realtime"')
+
+    if sys.platform.startswith('linux'):
+
+        libc = _libc()
+
+        if priority == 'high':
+            _check(libc.setpriority(PRIO_PROCESS, pid, HIGH_NICE))
+        else:
+            # struct sched_param holds the static priority only
+            param = ctypes.c_int(REALTIME_RR_PRIO)
+            _check(libc.sched_setscheduler(pid, SCHED_RR,
+                                           ctypes.byref(param)))
+
+    elif sys.platform == 'win32':
+
+        _windows_call(pid, 'SetPriorityClass',
+                      ctypes.c_uint32(PRIORITY_CLASSES[priority]))
+
+    else:
+        raise OSError('The scheduling priority is not supported on '\
+                      +sys.platform)
+
+
+
+def _libc():
+
+    return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+
+def _check(result):
+    """
+        Raise the error of a failed call of the C library.
+    """
+
+    if result != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+
+def _windows_call(pid, function, argument):
+    """
+        Call a kernel32 function taking the handle of the process and
+        argument.
+    """
+
+    kernel32 = ctypes.windll.kernel32
+
+    handle = kernel32.OpenProcess(PROCESS_SET_INFORMATION\
+                                  | PROCESS_QUERY_INFORMATION, False, pid)
+    if not handle:
+        raise ctypes.WinError()
+
+    try:
+        if not getattr(kernel32, function)(handle, argument):
+            raise ctypes.WinError()
+    finally:
+        kernel32.CloseHandle(handle)
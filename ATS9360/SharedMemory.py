@@ -0,0 +1,458 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import ctypes
+import time
+import numpy as np
+import multiprocessing as mp
+
+try:
+    import cPickle as pickle
+except ImportError:
+    # Python 3
+    import pickle
+
+
+class RingBuffer(object):
+    """
+        Ring of fixed-size slots allocated in shared memory.
+        Used to transfer the DMA buffers from the acquisition process to a
+        treatment process without pickling them.
+
+        The producer copies a buffer in a free slot and sends the index of the
+        slot, the consumer reads the samples in place and gives the slot back
+        to the producer when it asks for the next buffer.
+        The put, get and close methods mimic the ones of multiprocessing.Queue
+        so that the ring can be used wherever a queue of buffers is expected.
+    """
+
+
+
+    def __init__(self, nb_slots, slot_size, dtype=np.uint16):
+        """
+            Input:
+                - nb_slots (int): number of slots in the ring. When all the
+                  slots are filled, the producer waits for the consumer.
+                - slot_size (int): maximum number of samples per slot
+                - dtype (numpy dtype): type of the samples
+        """
+
+        self.nb_slots  = int(nb_slots)
+        self.slot_size = int(slot_size)
+        self.dtype     = np.dtype(dtype)
+
+        # The memory of all slots is allocated once for all
+        self._memory = mp.RawArray(ctypes.c_uint8,
+                                   self.nb_slots*self.slot_size*self.dtype.itemsize)
+
+        # Index of the slots available for the producer and
+        # index (with the number of written samples) of the slots filled
+        self._free   = mp.Queue()
+        self._filled = mp.Queue()
+
+        for slot in range(self.nb_slots):
+            self._free.put(slot)
+
+        # The numpy view of the memory is built in each process when needed
+        self._slots   = None
+
+        # Slot currently read by the consumer
+        self._current = None
+
+
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['_slots']   = None
+        state['_current'] = None
+
+        return state
+
+
+
+    @property
+    def slots(self):
+        """
+            2D numpy array (nb_slots, slot_size) sharing the memory of the ring.
+        """
+
+        if self._slots is None:
+            self._slots = np.frombuffer(self._memory, dtype=self.dtype)\
+                            .reshape(self.nb_slots, self.slot_size)
+
+        return self._slots
+
+
+
+    def put(self, data):
+        """
+            Copy data in a free slot and send it to the consumer.
+            Wait if all the slots are currently used.
+            None is sent as it is, without using a slot, to indicate the end
+            of the data to the consumer.
+        """
+
+        if data is None:
+            self._filled.put(None)
+            return
+
+        if data.size > self.slot_size:
+            raise ValueError('The data are larger than the slots of the ring')
+
+        # The data may be a strided view, as the records without their
+        # footers, they are copied once in the slot
+        slot = self._free.get()
+        self.slots[slot, :data.size].reshape(data.shape)[...] = data
+        self._filled.put((slot, data.size))
+
+
+
+    def get(self):
+        """
+            Return the next filled slot as a numpy array.
+            The array shares the memory of the ring, it is valid until the next
+            call of get, the slot is then given back to the producer.
+            Return None if the producer has put None.
+        """
+
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+
+        filled = self._filled.get()
+        if filled is None:
+            return None
+
+        slot, size = filled
+        self._current = slot
+
+        return self.slots[slot, :size]
+
+
+
+    def close(self):
+        """
+            Indicate that no more data will be put or get by the current process.
+        """
+
+        self._free.close()
+        self._filled.close()
+
+
+
+class Mailbox(object):
+    """
+        Latest result of a treatment process, in shared memory.
+        Used instead of a queue of results when only the most recent one
+        matters, for instance to display a running average: the results are
+        not accumulated and the parent process unpickles only the one it
+        reads.
+
+        The result is pickled in one of two slots in turn, each slot having
+        a sequence number which is -1 while it is written. The treatment
+        process never waits, the parent process reads the last written slot
+        and reads again if the slot has been overwritten meanwhile.
+        The put and close methods mimic the ones of multiprocessing.Queue so
+        that the mailbox can be used wherever a queue of results is expected.
+    """
+
+
+
+    def __init__(self, size):
+        """
+            Input:
+                - size (int): maximum size of a pickled result in bytes
+        """
+
+        self.size = int(size)
+
+        self._slots     = [mp.RawArray(ctypes.c_char, self.size) for i in range(2)]
+        self._lengths   = mp.RawArray(ctypes.c_long, 2)
+        self._sequences = mp.RawArray(ctypes.c_long, 2)
+
+        # Number of results put since the last clear
+        self._count = mp.RawValue(ctypes.c_long, 0)
+
+
+
+    def clear(self):
+        """
+            Forget the results before a new measurement.
+            Should only be called while no process puts results.
+        """
+
+        self._count.value = 0
+        for slot in range(2):
+            self._sequences[slot] = 0
+
+
+
+    def put(self, result):
+        """
+            Replace the result by a new one.
+            None, which indicates the end of a measurement to a queue, is not
+            stored.
+        """
+
+        if result is None:
+            return
+
+        data = pickle.dumps(result, -1)
+
+        if len(data) > self.size:
+            raise ValueError('The result of %d bytes is larger than the '\
+                             'mailbox of %d bytes' % (len(data), self.size))
+
+        count = self._count.value + 1
+        slot  = count % 2
+
+        self._sequences[slot] = -1
+        ctypes.memmove(self._slots[slot], data, len(data))
+        self._lengths[slot]   = len(data)
+        self._sequences[slot] = count
+
+        self._count.value = count
+
+
+
+    def count(self):
+        """
+            Return the number of results put, without reading them.
+        """
+
+        return self._count.value
+
+
+
+    def read(self):
+        """
+            Return the number of results put and the last one, None if there
+            is none yet.
+        """
+
+        while True:
+
+            count = self._count.value
+            if count == 0:
+                return 0, None
+
+            slot = count % 2
+            data = ctypes.string_at(ctypes.addressof(self._slots[slot]),
+                                    self._lengths[slot])
+
+            # The slot has not been written meanwhile
+            if self._sequences[slot] == count:
+                return count, pickle.loads(data)
+
+
+
+    def close(self):
+        """
+            Nothing to release, the memory is freed with the instance.
+        """
+
+        pass
+
+
+
+class ControlBlock(object):
+    """
+        State of a measurement shared between the instrument, the acquisition
+        process and the treatment processes.
+
+        The configuration of the measurement is given to the processes when
+        they are started, only what changes during the measurement is shared:
+            - the stop event, set by the instrument to end the acquisition,
+              or by the treatment processes once their results converged,
+            - the converged event, set with the stop event when all the
+              treatment processes converged,
+            - one finished event per process, set by the process when it has
+              released the board or treated its last buffer,
+            - a status block in shared memory, written by a single process
+              for each field and read without any lock nor IPC. The
+              buffer counters and the cumulated times are updated after each
+              buffer so that the instrument reads them during the
+              measurement.
+    """
+
+    # Fields of the status block written by the acquisition process
+    acquisition_fields = ('measured_buffers',
+                          'wait_time',
+                          'samplesPerRecord',
+                          'capture_time',
+                          'transferred_bytes',
+                          'buffer_interval_mean',
+                          'buffer_interval_std',
+                          'buffer_interval_max',
+                          'overflow',
+                          'overflow_boards',
+                          'dropped_records',
+                          'missed_triggers',
+                          'trigger_period')
+
+    # Fields of the status block written by each treatment process
+    treatment_fields = ('treated_buffers',
+                        'treated_sequences',
+                        'treated_samples',
+                        'process_time',
+                        'treatment_time',
+                        'converged')
+
+
+
+    def __init__(self, nb_treatments=1):
+        """
+            Input:
+                - nb_treatments (int): number of treatment processes
+        """
+
+        self.nb_treatments = int(nb_treatments)
+
+        self.stop                 = mp.Event()
+        self.converged            = mp.Event()
+        self.acquisition_finished = mp.Event()
+        self.treatment_finished   = [mp.Event() for i in range(self.nb_treatments)]
+
+        self._status = mp.RawArray(ctypes.c_double,
+                                   len(self.acquisition_fields)\
+                                   + self.nb_treatments*len(self.treatment_fields))
+
+
+
+    def clear(self):
+        """
+            Clear all the events and the status before a new acquisition.
+        """
+
+        self.stop.clear()
+        self.converged.clear()
+        self.acquisition_finished.clear()
+        for event in self.treatment_finished:
+            event.clear()
+
+        for index in range(len(self._status)):
+            self._status[index] = 0.
+
+
+
+    def _index(self, field, channel=None):
+
+        if channel is None:
+            return self.acquisition_fields.index(field)
+        else:
+            return len(self.acquisition_fields)\
+                   + channel*len(self.treatment_fields)\
+                   + self.treatment_fields.index(field)
+
+
+
+    def set_acquisition(self, **status):
+        """
+            Write fields of the acquisition status.
+            Should only be called by the acquisition process.
+        """
+
+        for field, value in status.items():
+            self._status[self._index(field)] = value
+
+
+
+    def get_acquisition(self):
+        """
+            Return the acquisition status as a dictionnary.
+        """
+
+        return dict((field, self._status[self._index(field)])
+                    for field in self.acquisition_fields)
+
+
+
+    def set_treatment(self, channel, **status):
+        """
+            Write fields of the status of a treatment process.
+            Should only be called by the treatment process of the channel.
+        """
+
+        for field, value in status.items():
+            self._status[self._index(field, channel)] = value
+
+
+
+    def converge(self, channel):
+        """
+            Report that the results of a treatment process converged.
+            Should only be called by the treatment process of the channel.
+            Once all the treatment processes converged, the acquisition is
+            stopped: the buffers already acquired are still treated.
+        """
+
+        self.set_treatment(channel, converged=1.)
+
+        if all(self._status[self._index('converged', treatment)]
+               for treatment in range(self.nb_treatments)):
+            self.converged.set()
+            self.stop.set()
+
+
+
+    def get_treatment(self, channel):
+        """
+            Return the status of a treatment process as a dictionnary.
+        """
+
+        return dict((field, self._status[self._index(field, channel)])
+                    for field in self.treatment_fields)
+
+
+
+    def finished(self):
+        """
+            Return True if the acquisition process and all the treatment
+            processes are finished, without waiting.
+        """
+
+        return all(event.is_set() for event
+                   in [self.acquisition_finished] + self.treatment_finished)
+
+
+
+    def wait(self, timeout=None):
+        """
+            Wait until the acquisition process and all the treatment processes
+            are finished.
+
+            Input:
+                - timeout (float): maximum waiting time in second, None to
+                  wait without limit.
+
+            Output:
+                - finished (bool): False if the timeout expired before
+        """
+
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        for event in [self.acquisition_finished] + self.treatment_finished:
+
+            if timeout is None:
+                event.wait()
+            elif not event.wait(max(deadline - time.time(), 0.)):
+                return False
+
+        return True
@@ -0,0 +1,679 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+'''Simulated ATS9360 board.
+
+The Board class of this module has the methods of atsapi.Board used by the
+DataAcquisition class. Instead of transferring data from a digitizer, it
+fills the DMA buffers with synthetic records: IF tones, gaussian noise and
+trigger timing are configurable.
+
+The module also defines the constants and helpers of atsapi used by the
+driver so that it can replace atsapi when the AlazarTech library is not
+installed.
+'''
+
+from __future__ import division
+import collections
+import ctypes
+import time
+import numpy as np
+
+'''Clock sources'''
+INTERNAL_CLOCK = 0x1
+FAST_EXTERNAL_CLOCK = 0x2
+EXTERNAL_CLOCK_10MHz_REF = 0x7
+
+'''Sample rates of the internal clock'''
+SAMPLE_RATE_1KSPS = 0x1
+SAMPLE_RATE_2KSPS = 0x2
+SAMPLE_RATE_5KSPS = 0x5
+SAMPLE_RATE_10KSPS = 0x8
+SAMPLE_RATE_20KSPS = 0xA
+SAMPLE_RATE_50KSPS = 0xC
+SAMPLE_RATE_100KSPS = 0xE
+SAMPLE_RATE_200KSPS = 0x10
+SAMPLE_RATE_500KSPS = 0x12
+SAMPLE_RATE_1MSPS = 0x14
+SAMPLE_RATE_2MSPS = 0x18
+SAMPLE_RATE_5MSPS = 0x1A
+SAMPLE_RATE_10MSPS = 0x1C
+SAMPLE_RATE_20MSPS = 0x1E
+SAMPLE_RATE_50MSPS = 0x22
+SAMPLE_RATE_100MSPS = 0x24
+SAMPLE_RATE_200MSPS = 0x28
+SAMPLE_RATE_500MSPS = 0x30
+SAMPLE_RATE_800MSPS = 0x32
+SAMPLE_RATE_1000MSPS = 0x35
+SAMPLE_RATE_1200MSPS = 0x37
+SAMPLE_RATE_1500MSPS = 0x3A
+SAMPLE_RATE_1800MSPS = 0x3D
+
+'''Clock edges'''
+CLOCK_EDGE_RISING = 0
+CLOCK_EDGE_FALLING = 1
+
+'''Channels'''
+CHANNEL_A = 1
+CHANNEL_B = 2
+
+'''Inputs'''
+DC_COUPLING = 2
+INPUT_RANGE_PM_400_MV = 0x7
+IMPEDANCE_50_OHM = 2
+
+'''Trigger'''
+TRIG_ENGINE_J = 0
+TRIG_ENGINE_K = 1
+TRIG_ENGINE_OP_J = 0
+TRIG_EXTERNAL = 2
+TRIG_DISABLE = 3
+TRIGGER_SLOPE_POSITIVE = 1
+TRIGGER_SLOPE_NEGATIVE = 2
+ETR_5V = 0
+ETR_1V = 1
+ETR_2V5 = 3
+AUX_OUT_TRIGGER = 0
+
+'''AutoDMA flags'''
+ADMA_NPT = 0x200
+ADMA_EXTERNAL_STARTCAPTURE = 0x1
+ADMA_FIFO_ONLY_STREAMING = 0x800
+ADMA_DSP = 0x4000
+ADMA_ENABLE_RECORD_FOOTERS = 0x10000
+
+'''DSP'''
+DSP_WINDOW_NONE = 0
+DSP_WINDOW_HANNING = 1
+DSP_WINDOW_HAMMING = 2
+DSP_WINDOW_BLACKMAN = 3
+DSP_WINDOW_BLACKMAN_HARRIS = 4
+DSP_WINDOW_BARTLETT = 5
+DSP_MODULE_FFT = 0x10000
+FFT_OUTPUT_FORMAT_U32 = 0x0
+FFT_OUTPUT_FORMAT_U16_LOG = 0x1
+FFT_OUTPUT_FORMAT_U16_AMP2 = 0x101
+FFT_OUTPUT_FORMAT_U8_LOG = 0x2
+FFT_OUTPUT_FORMAT_U8_AMP2 = 0x102
+FFT_OUTPUT_FORMAT_REAL_S32 = 0x3
+FFT_OUTPUT_FORMAT_IMAG_S32 = 0x4
+FFT_OUTPUT_FORMAT_FLOAT_AMP2 = 0xA
+FFT_OUTPUT_FORMAT_FLOAT_LOG = 0xB
+FFT_FOOTER_NONE = 0x0
+
+'''On-board record averaging'''
+CRA_MODE_DISABLE = 0
+CRA_MODE_ENABLE_FPGA_AVE = 1
+CRA_OPTION_UNSIGNED = 0
+CRA_OPTION_SIGNED = 1
+
+# Sample rates of the internal clock in S/s
+_samplerates = {SAMPLE_RATE_1KSPS    : 1e3,
+                SAMPLE_RATE_2KSPS    : 2e3,
+                SAMPLE_RATE_5KSPS    : 5e3,
+                SAMPLE_RATE_10KSPS   : 10e3,
+                SAMPLE_RATE_20KSPS   : 20e3,
+                SAMPLE_RATE_50KSPS   : 50e3,
+                SAMPLE_RATE_100KSPS  : 100e3,
+                SAMPLE_RATE_200KSPS  : 200e3,
+                SAMPLE_RATE_500KSPS  : 500e3,
+                SAMPLE_RATE_1MSPS    : 1e6,
+                SAMPLE_RATE_2MSPS    : 2e6,
+                SAMPLE_RATE_5MSPS    : 5e6,
+                SAMPLE_RATE_10MSPS   : 10e6,
+                SAMPLE_RATE_20MSPS   : 20e6,
+                SAMPLE_RATE_50MSPS   : 50e6,
+                SAMPLE_RATE_100MSPS  : 100e6,
+                SAMPLE_RATE_200MSPS  : 200e6,
+                SAMPLE_RATE_500MSPS  : 500e6,
+                SAMPLE_RATE_800MSPS  : 800e6,
+                SAMPLE_RATE_1000MSPS : 1000e6,
+                SAMPLE_RATE_1200MSPS : 1200e6,
+                SAMPLE_RATE_1500MSPS : 1500e6,
+                SAMPLE_RATE_1800MSPS : 1800e6}
+
+# Boards of each simulated system, by systemId and boardId, so that the
+# master board starts the capture of the whole system
+_systems = {}
+
+# Type of the output samples of the on-FPGA FFT for each output format
+_fft_dtypes = {FFT_OUTPUT_FORMAT_U32        : np.uint32,
+               FFT_OUTPUT_FORMAT_U16_LOG    : np.uint16,
+               FFT_OUTPUT_FORMAT_U16_AMP2   : np.uint16,
+               FFT_OUTPUT_FORMAT_U8_LOG     : np.uint8,
+               FFT_OUTPUT_FORMAT_U8_AMP2    : np.uint8,
+               FFT_OUTPUT_FORMAT_REAL_S32   : np.int32,
+               FFT_OUTPUT_FORMAT_IMAG_S32   : np.int32,
+               FFT_OUTPUT_FORMAT_FLOAT_AMP2 : np.float32,
+               FFT_OUTPUT_FORMAT_FLOAT_LOG  : np.float32}
+
+# Window functions of the on-FPGA FFT
+_windows = {DSP_WINDOW_NONE            : np.ones,
+            DSP_WINDOW_HANNING         : np.hanning,
+            DSP_WINDOW_HAMMING         : np.hamming,
+            DSP_WINDOW_BLACKMAN        : np.blackman,
+            DSP_WINDOW_BLACKMAN_HARRIS : lambda n: np.blackman(n)**2,
+            DSP_WINDOW_BARTLETT        : np.bartlett}
+
+
+
+def boardsInSystemBySystemID(sid):
+    '''Number of simulated boards instanced in the system.'''
+    return len(_systems.get(sid, {}))
+
+
+
+def dspGenerateWindowFunction(windowType,
+                              windowLength_samples,
+                              paddingLength_samples):
+    window = np.zeros(windowLength_samples+paddingLength_samples, dtype=np.float32)
+    window[:windowLength_samples] = _windows[windowType](windowLength_samples)
+    return window
+
+
+
+class NPTFooter(ctypes.Structure):
+    _fields_ = [("trigger_timestamp", ctypes.c_uint64),
+                ("record_number", ctypes.c_uint32),
+                ("frame_count", ctypes.c_uint32),
+                ("aux_in_state", ctypes.c_uint32)]
+
+
+
+# Footer written by the simulated board in the last 16 bytes of each record
+_footer_dtype = np.dtype([('trigger_timestamp', '<u8'),
+                          ('record_number', '<u4'),
+                          ('frame_count', '<u4')])
+
+
+
+def extractNPTFooters(buffer,
+                      recordSize_bytes,
+                      bufferSize_bytes,
+                      footersArray,
+                      numFootersToExtract):
+    '''Copies the footers of the records of a buffer in footersArray.'''
+    addr = getattr(buffer, 'value', buffer)
+    footers = _as_array(addr, bufferSize_bytes, np.uint8)\
+                .reshape(-1, recordSize_bytes)[:numFootersToExtract, -16:]
+    footers = np.ascontiguousarray(footers).view(_footer_dtype).ravel()
+
+    for footer, values in zip(footersArray, footers):
+        footer.trigger_timestamp = int(values['trigger_timestamp'])
+        footer.record_number = int(values['record_number'])
+        footer.frame_count = int(values['frame_count'])
+        footer.aux_in_state = 0
+
+
+
+def _as_array(addr, size_bytes, dtype):
+    '''Numpy view of size_bytes of memory starting at addr.'''
+    ctypes_array = (ctypes.c_uint8*size_bytes).from_address(addr)
+    return np.frombuffer(ctypes_array, dtype=dtype)
+
+
+
+class DMABuffer:
+    '''Buffer with the interface of atsapi.DMABuffer.
+
+    The memory is allocated by numpy, the simulated board writes in it from
+    its address like the digitizer does with DMA transfers.
+    '''
+    def __init__(self, c_sample_type, size_bytes):
+        self.size_bytes = size_bytes
+
+        npSampleType = {
+            ctypes.c_uint8: np.uint8,
+            ctypes.c_uint16: np.uint16,
+            ctypes.c_uint32: np.uint32,
+            ctypes.c_int32: np.int32,
+            ctypes.c_float: np.float32
+        }.get(c_sample_type, 0)
+
+        self._memory = np.zeros(size_bytes, dtype=np.uint8)
+        self.addr    = self._memory.ctypes.data
+        self.buffer  = self._memory.view(npSampleType)
+
+
+
+class DspModule:
+    '''On-FPGA FFT module of the simulated board.'''
+    def __init__(self, board):
+        self.board = board
+        self.window = None
+        self._window_addr = None
+
+    def dspGetInfo(self):
+        '''Returns (dspModuleId, versionMajor, versionMinor, maxLength,
+        reserved0, reserved1).'''
+        return (DSP_MODULE_FFT, 1, 0, 4096, 0, 0)
+
+    def fftSetWindowFunction(self, samplesPerRecord, realWindowArray,
+                             imagWindowArray):
+        self._window_addr = realWindowArray.value
+
+    def fftSetup(self, inputChannelMask, recordLength_samples,
+                 fftLength_samples, outputFormat, footer, reserved):
+        '''Returns the number of bytes per output record.'''
+        if self._window_addr is None:
+            self.window = np.ones(fftLength_samples, dtype=np.float32)
+        else:
+            self.window = np.copy(_as_array(self._window_addr,
+                                            4*fftLength_samples, np.float32))
+        self.board._fft_length = fftLength_samples
+        self.board._fft_format = outputFormat
+
+        return fftLength_samples//2*np.dtype(_fft_dtypes[outputFormat]).itemsize
+
+
+
+class Board:
+    '''Simulated AlazarTech digitizer.
+
+    Each record of channel A contains the sum of the IF tones, channel B the
+    same tones in quadrature, as the outputs of an IQ mixer. Gaussian noise is
+    added to both channels before the 12 bits quantization.
+
+    With the on-board record averaging, see configureRecordAverage, each
+    record of a buffer is the sum of the 12 bits codes of recordsPerAverage
+    successive records, as unsigned 32 bits samples.
+
+    The boards instanced with the same systemId form a master-slave
+    system: startCapture called on the master board, boardId 1, starts the
+    capture of all of them, as the synchronization cable does.
+
+    Args:
+
+      systemId, boardId (int): Identifiers of the board in its system.
+
+      tones (list): (frequency [Hz], amplitude [V], phase [rad]) of each IF
+      tone.
+
+      noise (float): Standard deviation of the noise [V].
+
+      pulse (tuple): (start, stop) [s] of the tones in a record. By default
+      the tones last the whole record.
+
+      trigger_rate (float): Rate of the trigger events [Hz]. Buffers are
+      delivered at this pace. If None, buffers are delivered as fast as
+      possible.
+
+      trigger_jitter (float): Standard deviation of the trigger time [s],
+      seen as a random phase of the tones from record to record.
+
+      missed_triggers (float): Probability that the board misses a trigger
+      event. The record is then captured on the next trigger, as seen in the
+      trigger timestamps of the record footers.
+
+      overflow_buffer (int): Number of buffers after which the transfer
+      fails with ApiBufferOverflow, as when the buffers are not posted back
+      fast enough. If None, the transfer never overflows.
+
+      nb_records_bank (int): Number of synthetic records computed in
+      advance. Buffers are filled with randomly shifted copies of this bank
+      so that the simulation keeps up with high buffer rates. If 0, every
+      record is computed when its buffer is filled.
+
+      seed (int): Seed of the random generator. The seed of the board
+      boardId is seed + boardId - 1 so that the boards of a system have
+      independent noise.
+
+    '''
+    def __init__(self, systemId=1, boardId=1, tones=((50e6, 0.1, 0.),),
+                 noise=0.01, pulse=None, trigger_rate=None, trigger_jitter=0.,
+                 missed_triggers=0., overflow_buffer=None,
+                 nb_records_bank=1024, seed=None):
+        self.systemId = systemId
+        self.boardId = boardId
+        self.handle = boardId
+        self.type = 0
+
+        self.tones = [tuple(tone) for tone in tones]
+        self.noise = noise
+        self.pulse = pulse
+        self.trigger_rate = trigger_rate
+        self.trigger_jitter = trigger_jitter
+        self.missed_triggers = missed_triggers
+        self.overflow_buffer = overflow_buffer
+        self.nb_records_bank = nb_records_bank
+        if seed is None:
+            self.random = np.random.RandomState()
+        else:
+            self.random = np.random.RandomState(seed + boardId - 1)
+
+        self.samplerate = 1e9
+        self.channels = CHANNEL_A | CHANNEL_B
+        self.samplesPerRecord = 0
+        self.recordsPerBuffer = 0
+        self.recordsPerAcquisition = 0
+        self.flags = 0
+
+        self._posted = collections.deque()
+        self._dsp = DspModule(self)
+        self._fft_length = None
+        self._fft_format = FFT_OUTPUT_FORMAT_U16_AMP2
+        self._postTriggerSamples = 0
+        self._bank = None
+        self._start = None
+        self._records_completed = 0
+        self._triggers = 0
+        self._records_per_average = 1
+        self._bank_sums = None
+
+        _systems.setdefault(systemId, {})[boardId] = self
+
+    def abortAsyncRead(self):
+        '''Cancels any asynchronous acquisition running on a board.'''
+        self._posted.clear()
+        self._start = None
+
+    def beforeAsyncRead(self, channels, transferOffset, samplesPerRecord,
+                        recordsPerBuffer, recordsPerAcquisition, flags):
+        '''Prepares the board for an asynchronous acquisition.'''
+        self.channels = channels
+        self.samplesPerRecord = samplesPerRecord
+        self.recordsPerBuffer = recordsPerBuffer
+        self.recordsPerAcquisition = recordsPerAcquisition
+        self.flags = flags
+        self._posted.clear()
+        self._records_completed = 0
+
+        # In FFT mode, transferOffset is 0 and samplesPerRecord is the
+        # number of bytes per record, the records come from setRecordSize.
+        if flags & ADMA_DSP:
+            self.samplesPerRecord = self._postTriggerSamples
+
+        if self.nb_records_bank:
+            self._bank = self._records(max(self.nb_records_bank,
+                                           recordsPerBuffer))
+        else:
+            self._bank = None
+
+        # Cumulative sums of the 12 bits codes of the bank, repeated twice,
+        # so that the sum of any successive records of the bank costs a
+        # subtraction whatever the number of records averaged
+        if self._bank is not None and self._records_per_average > 1:
+            self._bank_sums = []
+            for bank in self._bank:
+                codes = np.concatenate(((bank >> 4), (bank >> 4)))
+                sums = np.zeros((codes.shape[0] + 1, codes.shape[1]),
+                                dtype=np.int64)
+                np.cumsum(codes, axis=0, out=sums[1:])
+                self._bank_sums.append(sums)
+        else:
+            self._bank_sums = None
+
+    def configureAuxIO(self, mode, parameter):
+        pass
+
+    def configureRecordAverage(self, mode, samplesPerRecord,
+                               recordsPerAverage, options):
+        '''Co-add ADC samples into accumulator record.'''
+        if mode == CRA_MODE_ENABLE_FPGA_AVE:
+            self._records_per_average = int(recordsPerAverage)
+        else:
+            self._records_per_average = 1
+
+    def dspAbortCapture(self):
+        self.abortAsyncRead()
+
+    def dspGetBuffer(self, buffer, timeout_ms):
+        '''Blocks until the buffer is filled with spectra.
+
+        The spectra of the centred 12 bits codes are given in the output
+        format set by fftSetup. The integer formats are relative to a full
+        scale tone: its squared amplitude gives the largest value of the
+        AMP2 formats and 0 dB the largest value of the LOG formats, which
+        cover 120 dB. The float formats are not scaled.'''
+        size_bytes = self._wait(buffer, timeout_ms)
+
+        records = self._records_of_buffer()[0]
+        fft_length = self._fft_length
+        window = self._dsp.window[:self.samplesPerRecord]
+
+        # Records are filled with zeros up to the FFT length
+        spectra = np.zeros((records.shape[0], fft_length), dtype=np.float32)
+        spectra[:, :self.samplesPerRecord] = ((records >> 4) - 2047.5)*window
+        spectra = np.fft.fft(spectra, axis=1)[:, :fft_length//2]
+
+        output = self._fft_format
+        dtype = _fft_dtypes[output]
+
+        # Spectrum of a full scale tone
+        full_scale = 2047.5*np.sum(window)/2.
+
+        if output in (FFT_OUTPUT_FORMAT_REAL_S32, FFT_OUTPUT_FORMAT_IMAG_S32):
+            if output == FFT_OUTPUT_FORMAT_REAL_S32:
+                spectra = spectra.real
+            else:
+                spectra = spectra.imag
+            spectra = spectra*(2**31 - 1)/full_scale
+        else:
+            spectra = np.abs(spectra)**2.
+            if output in (FFT_OUTPUT_FORMAT_U16_LOG, FFT_OUTPUT_FORMAT_U8_LOG):
+                spectra = (1. + 10.*np.log10(np.maximum(spectra, 1e-30)
+                                             /full_scale**2.)/120.)\
+                          *np.iinfo(dtype).max
+            elif output == FFT_OUTPUT_FORMAT_FLOAT_LOG:
+                spectra = 10.*np.log10(np.maximum(spectra, 1e-30))
+            elif output != FFT_OUTPUT_FORMAT_FLOAT_AMP2:
+                spectra *= np.iinfo(dtype).max/full_scale**2.
+
+        if np.issubdtype(dtype, np.integer):
+            spectra = np.clip(np.round(spectra), np.iinfo(dtype).min,
+                              np.iinfo(dtype).max)
+
+        _as_array(buffer, size_bytes, dtype)[:] = spectra.ravel()
+
+    def dspGetModules(self):
+        '''Returns a list of DSP modules for this board'''
+        return [self._dsp]
+
+    def getChannelInfo(self):
+        '''Get the on-board memory in samples per channe and sample size in bits per sample'''
+        return (ctypes.c_uint32(4*1024**3), ctypes.c_uint8(12))
+
+    def inputControl(self, channel, coupling, inputRange, impedance):
+        pass
+
+    def postAsyncBuffer(self, buffer, bufferLength):
+        '''Posts a DMA buffer to a board.'''
+        self._posted.append((buffer, bufferLength))
+
+    def setCaptureClock(self, source, rate, edge, decimation):
+        '''Configures the board's acquisition clock.'''
+        if source == INTERNAL_CLOCK:
+            self.samplerate = _samplerates[rate]
+        else:
+            self.samplerate = float(rate)
+
+    def setExternalTrigger(self, coupling, range):
+        pass
+
+    def setRecordSize(self, preTriggerSamples, postTriggerSamples):
+        self._postTriggerSamples = preTriggerSamples + postTriggerSamples
+
+    def setTriggerDelay(self, delay_samples):
+        pass
+
+    def setTriggerOperation(self, operation,
+                            engine1, source1, slope1, level1,
+                            engine2, source2, slope2, level2):
+        pass
+
+    def setTriggerTimeOut(self, timeout_clocks):
+        pass
+
+    def startCapture(self):
+        '''Starts the acquisition, of all the boards of the system when
+        called on the master board.'''
+        if self.boardId == 1:
+            boards = _systems[self.systemId].values()
+        else:
+            boards = [self]
+
+        start = time.time()
+        for board in boards:
+            board._start = start
+            board._records_completed = 0
+            board._triggers = 0
+
+    def waitAsyncBufferComplete(self, buffer, timeout_ms):
+        '''Blocks until the board confirms that buffer is filled with data.'''
+        size_bytes = self._wait(buffer, timeout_ms)
+
+        if self._records_per_average > 1:
+            records = self._averaged_records_of_buffer()
+            data = _as_array(buffer, size_bytes, np.uint32)
+        else:
+            records = self._records_of_buffer()
+            data = _as_array(buffer, size_bytes, np.uint16)
+
+        # The samples of both channels are interleaved
+        if len(records) == 2:
+            data[0::2] = records[0].ravel()
+            data[1::2] = records[1].ravel()
+        else:
+            data[:] = records[0].ravel()
+
+        if self.flags & ADMA_ENABLE_RECORD_FOOTERS:
+            self._write_footers(buffer, size_bytes)
+
+    def _write_footers(self, buffer, size_bytes):
+        '''Write the footer of each record of the buffer in its last 16
+        bytes. The trigger timestamps count the sample clock.'''
+        if self.trigger_rate is None:
+            period = self.samplesPerRecord
+        else:
+            period = max(int(round(self.samplerate/self.trigger_rate)), 1)
+
+        # Each record is captured on the next trigger which is not missed
+        if self.missed_triggers:
+            steps = self.random.geometric(1. - self.missed_triggers,
+                                          self.recordsPerBuffer)
+        else:
+            steps = np.ones(self.recordsPerBuffer, dtype=np.int64)
+        triggers = self._triggers + np.cumsum(steps) - 1
+        self._triggers = triggers[-1] + 1
+
+        footers = np.zeros(self.recordsPerBuffer, dtype=_footer_dtype)
+        footers['trigger_timestamp'] = triggers*period
+        footers['record_number'] = self._records_completed\
+                                   - self.recordsPerBuffer\
+                                   + np.arange(self.recordsPerBuffer)
+
+        _as_array(buffer, size_bytes, np.uint8)\
+            .reshape(self.recordsPerBuffer, -1)[:, -16:] = footers.view(np.uint8)\
+                                                             .reshape(-1, 16)
+
+    def _wait(self, buffer, timeout_ms):
+        '''Wait for the trigger events of the next buffer and return its
+        size in bytes.'''
+        if not self._posted or self._posted[0][0] != buffer:
+            raise Exception('Error calling function waitAsyncBufferComplete: '
+                            'ApiBufferNotReady')
+        if self._records_completed >= self.recordsPerAcquisition:
+            raise Exception('Error calling function waitAsyncBufferComplete: '
+                            'ApiWaitTimeout')
+        if self.overflow_buffer is not None\
+           and self._records_completed >= self.overflow_buffer*self.recordsPerBuffer:
+            raise Exception('Error calling function waitAsyncBufferComplete: '
+                            'ApiBufferOverflow')
+
+        self._records_completed += self.recordsPerBuffer
+
+        if self.trigger_rate is not None:
+            ready = self._start + self._records_completed\
+                                  *self._records_per_average/self.trigger_rate
+            delay = ready - time.time()
+            if delay > timeout_ms*1e-3:
+                time.sleep(timeout_ms*1e-3)
+                raise Exception('Error calling function waitAsyncBufferComplete: '
+                                'ApiWaitTimeout')
+            if delay > 0:
+                time.sleep(delay)
+
+        return self._posted.popleft()[1]
+
+    def _records_of_buffer(self):
+        '''List of the records (one 2D array per active channel) of the next
+        buffer.'''
+        if self._bank is None:
+            return self._records(self.recordsPerBuffer)
+
+        index = (self.random.randint(self._bank[0].shape[0])
+                 + np.arange(self.recordsPerBuffer)) % self._bank[0].shape[0]
+
+        return [bank[index] for bank in self._bank]
+
+    def _averaged_records_of_buffer(self):
+        '''List of the accumulated records (one 2D array per active channel)
+        of the next buffer, each one summing the 12 bits codes of
+        recordsPerAverage successive records.'''
+        average = self._records_per_average
+
+        if self._bank is None:
+            return [np.sum((records >> 4).reshape(self.recordsPerBuffer,
+                                                  average, -1),
+                           axis=1, dtype=np.uint32)
+                    for records in self._records(self.recordsPerBuffer
+                                                 *average)]
+
+        size = self._bank[0].shape[0]
+        start = (self.random.randint(size)
+                 + average*np.arange(self.recordsPerBuffer)) % size
+
+        # The averaged records cover the whole bank average//size times
+        accumulated = []
+        for bank, sums in zip(self._bank, self._bank_sums):
+            records = sums[start + average % size] - sums[start]
+            if average >= size:
+                records += average//size*sums[size]
+            accumulated.append(records.astype(np.uint32))
+
+        return accumulated
+
+    def _records(self, nb_records):
+        '''Compute nb_records synthetic records of each active channel as
+        16 bits codes.'''
+        time_record = np.arange(self.samplesPerRecord)/self.samplerate
+        delay = self.trigger_jitter*self.random.randn(nb_records, 1)
+
+        if self.pulse is None:
+            envelope = 1.
+        else:
+            envelope = (time_record >= self.pulse[0])\
+                       & (time_record < self.pulse[1])
+
+        records = []
+        for channel, shift in ((CHANNEL_A, 0.), (CHANNEL_B, -np.pi/2.)):
+            if not self.channels & channel:
+                continue
+
+            signal = self.noise*self.random.randn(nb_records,
+                                                  self.samplesPerRecord)
+            for frequency, amplitude, phase in self.tones:
+                signal += envelope*amplitude\
+                          *np.cos(2.*np.pi*frequency*(time_record + delay)
+                                  + phase + shift)
+
+            # Inverse of DataTreatment.data_in_volt
+            code = np.clip(np.round(signal*2047.5/0.4 + 2047.5), 0, 4095)
+            records.append(code.astype(np.uint16) << 4)
+
+        return records
@@ -0,0 +1,273 @@
+# This Python file uses the following encoding: utf-8
+# ATS9360_NPT.py driver for The aquisition board Alzar ATS9360
+# Etienne Dumur <etienne.dumur@neel.cnrs.fr> 2015
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+    Treatment of the buffers of one channel by several processes.
+
+    The acquisition process sends the buffers round-robin to the treatment
+    processes through a RoundRobinQueue: buffer b is treated by the process
+    b % nb_workers. Each treatment process runs its own copy of the processor,
+    with its own running averages.
+    The parent process reads the results through a ReductionQueue which gets
+    them in the order of the sequences and merges the partial averages of the
+    processes in the result the processor would have given alone.
+    When only the latest result matters, each process sends its results to
+    a Mailbox and the parent process merges the latest ones through a
+    ReductionMailbox.
+
+    Each buffer must contain an integer number of sequences so that no
+    sequence is shared between two processes.
+"""
+
+from __future__ import division
+import numpy as np
+
+
+class RoundRobinQueue(object):
+    """
+        Send the buffers of one channel to several memory buffers in turn.
+        The put and close methods mimic the ones of multiprocessing.Queue so
+        that the acquisition process uses it as its data queue.
+    """
+
+
+
+    def __init__(self, queues):
+        """
+            Input:
+                - queues (list): FIFO memory buffers or RingBuffer instances,
+                  one per treatment process.
+        """
+
+        self.queues = queues
+        self._nb_buffers = 0
+
+
+
+    def put(self, data):
+        """
+            Send data to the next treatment process.
+            None is sent to all the treatment processes and the next buffer
+            is sent to the first one again.
+        """
+
+        if data is None:
+            for queue in self.queues:
+                queue.put(None)
+            self._nb_buffers = 0
+        else:
+            self.queues[self._nb_buffers % len(self.queues)].put(data)
+            self._nb_buffers += 1
+
+
+
+    def close(self):
+
+        for queue in self.queues:
+            queue.close()
+
+
+
+class ReductionQueue(object):
+    """
+        Get the results of several treatment processes of one channel as if
+        they came from a single process.
+        The get and close methods mimic the ones of multiprocessing.Queue.
+    """
+
+
+
+    def __init__(self, queues, reduction, sequences_per_buffer):
+        """
+            Input:
+                - queues (list): FIFO memory buffers receiving the results of
+                  the treatment processes, in the order of the
+                  RoundRobinQueue.
+                - reduction (tuple or string): reduction attribute of the
+                  processor, see DataTreatment.
+                - sequences_per_buffer (int): number of results given by a
+                  treatment process for each buffer.
+        """
+
+        self.queues               = queues
+        self.reduction            = reduction
+        self.sequences_per_buffer = int(sequences_per_buffer)
+
+        self._nb_results = 0
+        self._counts     = [0]*len(queues)
+        self._results    = [None]*len(queues)
+
+
+
+    def get(self, block=True, timeout=None):
+        """
+            Return the result of the next sequence merged with the last
+            results of the other treatment processes.
+            Raise Queue.Empty, as multiprocessing.Queue.get, if the result
+            is not available within timeout.
+        """
+
+        # The results are read in the order in which the buffers have been
+        # sent to the treatment processes
+        worker = (self._nb_results//self.sequences_per_buffer)\
+                 % len(self.queues)
+
+        result = self.queues[worker].get(block, timeout)
+
+        # None indicates the end of a measurement of a session
+        if result is None:
+            return None
+
+        self._nb_results       += 1
+        self._counts[worker]   += 1
+        self._results[worker]   = result
+
+        return reduce_results(self.reduction, self._counts, self._results,
+                              worker)
+
+
+
+    def close(self):
+
+        for queue in self.queues:
+            queue.close()
+
+
+
+class ReductionMailbox(object):
+    """
+        Get the latest results of several treatment processes of one channel,
+        each one sent to a Mailbox, as if they came from a single process.
+    """
+
+
+
+    def __init__(self, mailboxes, reduction):
+        """
+            Input:
+                - mailboxes (list): Mailbox instances receiving the results of
+                  the treatment processes.
+                - reduction (tuple or string): reduction attribute of the
+                  processor, see DataTreatment.
+        """
+
+        self.mailboxes = mailboxes
+        self.reduction = reduction
+
+
+
+    def read(self):
+        """
+            Return the total number of results put by the treatment processes
+            and their last results merged, None if there is none yet.
+        """
+
+        counts, results = zip(*[mailbox.read() for mailbox in self.mailboxes])
+
+        if sum(counts) == 0:
+            return 0, None
+
+        # The last result is the one of the most advanced process, the
+        # buffers being sent in turn from the first process
+        worker = len(counts) - 1 - counts[::-1].index(max(counts))
+
+        return sum(counts), reduce_results(self.reduction, counts, results,
+                                           worker)
+
+
+
+    def count(self):
+        """
+            Return the total number of results put by the treatment
+            processes, without reading them.
+        """
+
+        return sum(mailbox.count() for mailbox in self.mailboxes)
+
+
+
+    def clear(self):
+
+        for mailbox in self.mailboxes:
+            mailbox.clear()
+
+
+
+    def close(self):
+
+        for mailbox in self.mailboxes:
+            mailbox.close()
+
+
+
+def reduce_results(reduction, counts, results, worker):
+    """
+        Merge the last results of the treatment processes of one channel.
+
+        Input:
+            - reduction (tuple or string): reduction attribute of the
+              processor, see DataTreatment.
+            - counts (list): number of results given by each process
+            - results (list): last result of each process
+            - worker (int): process which gave the last result
+
+        Output:
+            - result: result the processor would have given alone
+    """
+
+    # Results which are not a tuple have a single reduction
+    if isinstance(reduction, str):
+        return _reduce(reduction, lambda result: result, counts, results,
+                       worker)
+    else:
+        return tuple(_reduce(element_reduction,
+                             lambda result, index=index: result[index],
+                             counts, results, worker)
+                     for index, element_reduction in enumerate(reduction))
+
+
+
+def _reduce(reduction, element, counts, results, worker):
+    """
+        Merge one element of the last results of the treatment processes.
+    """
+
+    if reduction == 'last':
+        return element(results[worker])
+
+    total = 0.
+    value = 0.
+    for count, result in zip(counts, results):
+        if count:
+            total += count
+            if reduction == 'mean':
+                value = value + count*np.asarray(element(result))
+            elif reduction == 'std':
+                value = value + count*np.asarray(element(result))**2.
+            elif reduction == 'sum':
+                value = value + element(result)
+            else:
+                raise ValueError('reduction must be "mean", "std", "sum" '\
+                                 'or "last"')
+
+    if reduction == 'sum':
+        return value
+    elif reduction == 'std':
+        return np.sqrt(value/total)
+    else:
+        return value/total
@@ -154,6 +154,7 @@ ADMA_FIFO_ONLY_STREAMING = 0x800
 ADMA_INTERLEAVE_SAMPLES = 0x1000
 ADMA_GET_PROCESSED_DATA = 0x2000
 ADMA_DSP = 0x4000
+ADMA_ENABLE_RECORD_FOOTERS = 0x10000
 
 '''Boards'''
 ATS850  = 1
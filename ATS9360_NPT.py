@@ -21,10 +21,23 @@ import numpy as np
 import logging
 import types
 import time
+import Queue
 import multiprocessing as mp
 
-from ATS9360 import atsapi as ats
+try:
+    from ATS9360 import atsapi as ats
+except OSError:
+    # Without the AlazarTech library, only the simulated board can be used
+    from ATS9360 import SimulatedBoard as ats
+    logging.warning(__name__ + ' : AlazarTech library not found, '\
+                    + 'the board is simulated')
+
 from ATS9360.DataAcquisition import DataAcquisition
+from ATS9360.DataTreatment import DataTreatment
+from ATS9360.SharedMemory import RingBuffer, Mailbox, ControlBlock
+from ATS9360.TreatmentPool import RoundRobinQueue, ReductionQueue, ReductionMailbox
+from ATS9360.BufferGeometry import optimal_geometry
+from ATS9360 import Scheduling
 data_acquisition = DataAcquisition()
 
 class ATS9360_NPT(Instrument):
@@ -101,6 +114,33 @@ class ATS9360_NPT(Instrument):
             units       = '%'
             )
 
+        self.add_parameter('acquired_buffers',
+            type        = types.IntType,
+            flags       = Instrument.FLAG_GET
+            )
+
+        self.add_parameter('treated_buffers',
+            type        = types.IntType,
+            flags       = Instrument.FLAG_GET
+            )
+
+        self.add_parameter('queue_depth',
+            type        = types.IntType,
+            flags       = Instrument.FLAG_GET
+            )
+
+        self.add_parameter('wait_time',
+            type        = types.FloatType,
+            flags       = Instrument.FLAG_GET,
+            units       = 'ms'
+            )
+
+        self.add_parameter('process_time',
+            type        = types.FloatType,
+            flags       = Instrument.FLAG_GET,
+            units       = 'ms'
+            )
+
         self.add_parameter('mode',
             type        = types.StringType,
             flags       = Instrument.FLAG_GETSET,
@@ -155,6 +195,15 @@ class ATS9360_NPT(Instrument):
                             'CHANNEL_B',
                             'FFT'}
 
+        # Output formats and windows of the on-FPGA FFT, named as the
+        # FFT_OUTPUT_FORMAT_ and DSP_WINDOW_ constants of atsapi
+        self.allow_fft_formats = {'U32', 'U16_LOG', 'U16_AMP2', 'U8_LOG',
+                                  'U8_AMP2', 'REAL_S32', 'IMAG_S32',
+                                  'FLOAT_AMP2', 'FLOAT_LOG'}
+
+        self.allow_fft_windows = {'NONE', 'HANNING', 'HAMMING', 'BLACKMAN',
+                                  'BLACKMAN_HARRIS', 'BARTLETT'}
+
         # Attributes of the clock
         self.samplerate   = 1000. # In [MS/s], float
         self.clock_source = 'external' #  fast_external
@@ -175,21 +224,93 @@ class ATS9360_NPT(Instrument):
         # initialization of the board.
         self.records_per_buffer         = self.default_records_per_buffer
         self.nb_buffer_allocated        = 4 # Must be integer
+        self.nb_shared_slots            = 16 # Slots of the shared memory transfer, must be integer
         self.buffers_per_acquisition    = 200 # Must be integer
-        self.averaging                  = 100 # Must be integer
         self.nb_sequence                = 2 # Must be integer and even
 
+        # Requested averaging, the acquired one may have been rounded up
+        self.averaging = self.buffers_per_acquisition*self.records_per_buffer\
+                         //self.nb_sequence
+
+        # Options of the automatic choice of the geometry of the DMA
+        # buffers, None to keep the records per buffer set by hand,
+        # see optimize_geometry.
+        self._geometry_options = None
+
         # Keep trace of the number of buffers acquired by the board.
         # If a measurement is well executed, this number becomes equal to the
         # number of sequences times the number of averaging
         self._acquired_sequences = 0.
 
+        # Number of results of a measurement stopped early, known once its
+        # processes are finished, see _nb_results
+        self._final_nb_results = None
+
+        # Events and status shared with the processes of the measurement,
+        # see _create_processes
+        self.control = None
+
         # Attributes of the display of the acquisition
         self.T_display = 1
 
+        # Maximum time in second to wait for the processes when the
+        # measurement is closed
+        self.close_timeout = 10.
+
+        # Persistent acquisition session, see session_open
+        self._session = None
+
         # Mode of the digitizer.
         self.mode = 'CHANNEL_AB'
 
+        # Transfer of the buffers between the acquisition and the treatment
+        # processes and number of treatment processes per channel, see
+        # measurement_initialization.
+        self.transfer   = 'queue'
+        self.nb_workers = 1
+
+        # Transfer of the results from the treatment processes, see
+        # measurement_initialization, and maximum size in bytes of a result
+        # sent to a mailbox, None to deduce it from the acquisition geometry.
+        self.result      = 'queue'
+        self.result_size = None
+
+        # Size in bytes of a result declared by the processor of the last
+        # measurement, see DataTreatment.result_bytes.
+        self._processor_result_bytes = None
+
+        # Processor of the last measurement, which gives the returned results,
+        # see DataTreatment.final_result.
+        self._processor = None
+
+        # Collection of the record footers, see set_footers.
+        self.footers = False
+
+        # Number of records averaged by the board before the transfer, see
+        # set_hardware_averaging.
+        self.hardware_averaging = 1
+
+        # Number of boards of the system acquiring together, see
+        # set_nb_boards.
+        self.nb_boards = 1
+
+        # Output format and window of the on-FPGA FFT, see set_fft.
+        self.fft_format = 'U16_AMP2'
+        self.fft_window = 'HAMMING'
+
+        # CPUs and scheduling priority of the acquisition and treatment
+        # processes, None to leave them to the system, see set_scheduling.
+        self.acquisition_cpus = None
+        self.treatment_cpus   = None
+        self.priority         = None
+
+        # Options of the simulated board, None to use the ATS9360,
+        # see set_simulation.
+        if ats.__name__.endswith('SimulatedBoard'):
+            self.simulation = {}
+        else:
+            self.simulation = None
+
         # For the display, we get all parameters at the end of the
         # initialization
         self.get_all()
@@ -218,6 +339,7 @@ class ATS9360_NPT(Instrument):
         self.get_nb_sequence()
 
         self.get_completed_acquisition()
+        self.get_counters()
 
         self.get_mode()
 
@@ -235,13 +357,15 @@ class ATS9360_NPT(Instrument):
 
     def _get_parameters(self):
         """
-            Create a Manager for the multiprocessing containing all parameters
-            needed to tune the board.
-            The method returns the manager as pickable variable.
+            Create a dictionnary containing all parameters needed to tune the
+            board.
+            The dictionnary is copied in the acquisition and treatment
+            processes when they start, it is never modified afterwards.
+            What changes during the measurement is shared through a
+            ControlBlock, see measurement_initialization.
         """
 
-        manager    = mp.Manager()
-        parameters = manager.dict()
+        parameters = {}
 
         # Clock parameters
         parameters['samplerate']   = self.samplerate
@@ -268,19 +392,396 @@ class ATS9360_NPT(Instrument):
         parameters['allow_trigger_ranges'] = self.allow_trigger_ranges
         parameters['allow_trigger_slopes'] = self.allow_trigger_slopes
 
-        # Communication parameters to end correctly the measurement
-        parameters['measuring']        = True # True means measuring
-        parameters['safe_acquisition'] = False # True means the board has been closed properly
-        parameters['safe_treatment']  = [False, False] # True means the treatment is finished
-        parameters['measured_buffers'] = None
-
         # Mode of the digitizer
         parameters['mode'] = self.mode
 
+        # Transfer of the buffers between the acquisition and the treatment
+        parameters['transfer']   = self.transfer
+        parameters['nb_workers'] = self.nb_workers
+
+        # Collection of the record footers
+        parameters['footers'] = self.footers
+
+        # Records averaged by the board
+        parameters['hardware_averaging'] = self.hardware_averaging
+
+        # Boards of the system
+        parameters['nb_boards'] = self.nb_boards
+
+        # On-FPGA FFT
+        parameters['fft_format'] = self.fft_format
+        parameters['fft_window'] = self.fft_window
+
+        # Options of the simulated board
+        parameters['simulation'] = self.simulation
+
         return parameters
 
 
 
+    def set_simulation(self, simulation=None):
+        """
+            Replace the ATS9360 by a simulated board for the next measurements.
+            The simulated board delivers synthetic records (IF tones, noise,
+            trigger timing) so that the whole acquisition and treatment
+            pipeline can run without the digitizer.
+
+            Input:
+                - simulation (dict): keyword arguments of
+                  SimulatedBoard.Board, for instance
+                  {'tones' : [(50e6, 0.1, 0.)], 'noise' : 0.01,
+                   'trigger_rate' : 100e3}.
+                  An empty dictionnary uses the default synthetic signal.
+                  None to use the ATS9360.
+
+            Output:
+                - None
+        """
+
+        if simulation is None and ats.__name__.endswith('SimulatedBoard'):
+            raise ValueError('The AlazarTech library is not installed, only '\
+                             'the simulated board can be used')
+
+        self.simulation = simulation
+
+
+
+    def set_footers(self, footers=True):
+        """
+            Enable the NPT footers for the next measurements.
+            The board then writes the record number and the trigger timestamp
+            at the end of each record. The acquisition process reads them to
+            count the lost records and the missed triggers, see
+            get_acquisition_diagnostics. The footer takes the last 16 bytes
+            of each record: the board acquires 128 more samples per record
+            and the treatment receives the requested samples only.
+            The footers cannot be used with the on-FPGA FFT.
+
+            Input:
+                - footers (bool): True to enable the footers
+
+            Output:
+                - None
+        """
+
+        self.footers = bool(footers)
+
+
+
+    def set_hardware_averaging(self, nb_records=1):
+        """
+            Let the board average nb_records successive records before the
+            transfer, see atsapi.Board.configureRecordAverage. Only the
+            averaged records are transferred and treated: the processors
+            receive them as acquired records, with 4 more bits of
+            resolution, while the transfer and the treatment are nb_records
+            times lighter.
+            The averaging set by set_averaging stays the total number of
+            averages, the host averages it divided by nb_records, rounded
+            up.
+            The board co-adds successive triggers: with several sequences,
+            each record of the sequence has to be repeated nb_records times
+            in a row.
+            The on-board averaging cannot be used with the on-FPGA FFT or
+            with the footers.
+
+            Input:
+                - nb_records (int): number of records averaged by the board,
+                  1 to disable the on-board averaging.
+
+            Output:
+                - None
+        """
+
+        # The 12-bit sample codes are summed in 32 bits
+        if not 1 <= int(nb_records) <= 2**20:
+            raise ValueError('The number of records averaged by the board '\
+                             'must be between 1 and 2**20')
+
+        self.hardware_averaging = int(nb_records)
+
+        # The averages are shared again between the board and the host
+        self.set_averaging(self.averaging)
+
+
+
+    def set_nb_boards(self, nb_boards=1):
+        """
+            Acquire with the nb_boards first boards of the system for the
+            next measurements. The boards share the clock and the trigger
+            through their synchronization cable and are set with the same
+            parameters: the master board starts the capture of all of them
+            and each board has its own DMA buffers, see
+            DataAcquisition.data_acquisition.
+            The channels of each board are treated by their own treatment
+            processes and measurement returns the results of all the
+            channels, board after board: (A1, B1, A2, B2, ...) in
+            "CHANNEL_AB" mode, (A1, A2, ...) in "CHANNEL_A" mode.
+
+            Input:
+                - nb_boards (int): number of boards
+
+            Output:
+                - None
+        """
+
+        if int(nb_boards) < 1:
+            raise ValueError('The number of boards must be larger than 1')
+
+        if self.simulation is None\
+           and ats.boardsInSystemBySystemID(1) < int(nb_boards):
+            raise ValueError('The system has only %d boards'\
+                             % ats.boardsInSystemBySystemID(1))
+
+        self.nb_boards = int(nb_boards)
+
+
+
+    def set_fft(self, output_format='U16_AMP2', window='HAMMING'):
+        """
+            Set the on-FPGA FFT of the "FFT" mode for the next measurements.
+            Each record is windowed, padded with zeros up to the next power
+            of 2 and its spectrum, up to half the samplerate, is transferred
+            instead of the record. The spectra are averaged by the
+            DataTreatment.PowerSpectrum processor.
+
+            Input:
+                - output_format (string): format of the spectra, named as
+                  the FFT_OUTPUT_FORMAT_ constants of atsapi:
+                  "U16_AMP2", "U8_AMP2", "U32", "FLOAT_AMP2": squared
+                  amplitude,
+                  "U16_LOG", "U8_LOG", "FLOAT_LOG": amplitude in dB,
+                  "REAL_S32", "IMAG_S32": real or imaginary part.
+                - window (string): window applied to the records, "NONE",
+                  "HANNING", "HAMMING", "BLACKMAN", "BLACKMAN_HARRIS" or
+                  "BARTLETT".
+
+            Output:
+                - None
+        """
+
+        if output_format not in self.allow_fft_formats:
+            raise ValueError('The output format of the FFT must be in '\
+                             + str(sorted(self.allow_fft_formats)))
+
+        if window not in self.allow_fft_windows:
+            raise ValueError('The window of the FFT must be in '\
+                             + str(sorted(self.allow_fft_windows)))
+
+        self.fft_format = output_format
+        self.fft_window = window
+
+
+
+    def set_scheduling(self, acquisition_cpus=None, treatment_cpus=None,
+                       priority=None):
+        """
+            Pin the acquisition and treatment processes on sets of CPUs and
+            raise their scheduling priority, see the Scheduling module.
+            Giving them cores which the GUI and the plots do not use keeps a
+            redraw from delaying the acquisition until the DMA buffers
+            overflow.
+            The options are applied to the processes once they are started,
+            and at once to the processes of an open session. What the system
+            does not permit, typically a higher priority without the
+            administrator rights, is skipped with a warning.
+
+            Input:
+                - acquisition_cpus (list): CPUs of the acquisition process,
+                  None to leave it to the system.
+                - treatment_cpus (list): CPUs shared by the treatment
+                  processes, None to leave them to the system.
+                - priority (string): "high" or "realtime" for the acquisition
+                  and treatment processes, None to keep the normal priority.
+
+            Output:
+                - None
+        """
+
+        for cpus in (acquisition_cpus, treatment_cpus):
+            if cpus is not None:
+                if len(cpus) == 0 or not set(cpus) <= set(range(mp.cpu_count())):
+                    raise ValueError('The CPUs must be a non empty list of '\
+                                     'CPUs between 0 and '\
+                                     + str(mp.cpu_count() - 1))
+
+        if priority not in (None,) + Scheduling.PRIORITIES:
+            raise ValueError('priority must be None, "high" or "realtime"')
+
+        self.acquisition_cpus = acquisition_cpus
+        self.treatment_cpus   = treatment_cpus
+        self.priority         = priority
+
+        if self._session is not None:
+            self._schedule_processes()
+
+
+
+    def _schedule_processes(self):
+        """
+            Apply the options of set_scheduling to the started acquisition
+            and treatment processes.
+        """
+
+        workers = [(self.worker_acquire_data, self.acquisition_cpus)]\
+                  + [(worker, self.treatment_cpus)
+                     for worker in self.worker_treat_data]
+
+        for worker, cpus in workers:
+            try:
+                if cpus is not None:
+                    Scheduling.set_affinity(worker.pid, cpus)
+                if self.priority is not None:
+                    Scheduling.set_priority(worker.pid, self.priority)
+            except OSError as error:
+                logging.warning(__name__ + ' : the scheduling of process %d '\
+                                'is not permitted: %s' % (worker.pid, error))
+
+
+
+    def _host_averaging(self):
+        """
+            Number of averages done by the host, see set_hardware_averaging.
+        """
+
+        return -(-self.averaging//self.hardware_averaging)
+
+
+
+    def get_acquisition_diagnostics(self):
+        """
+            Return the diagnostics of the last acquisition, available once
+            the measurement is closed.
+
+            Output:
+                - diagnostics (dict):
+                    'measured_buffers' (int): number of acquired buffers
+                    'overflow' (bool): True if the transfer stopped on a DMA
+                        overflow
+                    'overflow_boards' (list): identifiers of the boards whose
+                        transfer overflowed, from 1 for the master board
+                    'buffer_interval_mean', 'buffer_interval_std',
+                    'buffer_interval_max' (float): mean, jitter and maximum
+                        of the interval between buffers in second
+                    'dropped_records' (int): records lost between buffers
+                    'missed_triggers' (int): triggers missed by the board
+                    'trigger_period' (float): interval between triggers in
+                        timestamp counts
+                  The last three are None without the footers, see
+                  set_footers.
+        """
+
+        if self.control is None:
+            raise ValueError('No acquisition has been done')
+
+        acquisition = self.control.get_acquisition()
+
+        # Bit b is set when the transfer of the board b + 1 overflowed
+        overflow_boards = int(acquisition['overflow_boards'])
+
+        diagnostics = {'measured_buffers'     : int(acquisition['measured_buffers']),
+                       'overflow'             : bool(acquisition['overflow']),
+                       'overflow_boards'      : [board for board in range(1, self.nb_boards + 1)
+                                                 if overflow_boards & 2**(board - 1)],
+                       'buffer_interval_mean' : acquisition['buffer_interval_mean'],
+                       'buffer_interval_std'  : acquisition['buffer_interval_std'],
+                       'buffer_interval_max'  : acquisition['buffer_interval_max']}
+
+        for field, kind in (('dropped_records', int),
+                            ('missed_triggers', int),
+                            ('trigger_period', float)):
+            if acquisition[field] < 0:
+                diagnostics[field] = None
+            else:
+                diagnostics[field] = kind(acquisition[field])
+
+        return diagnostics
+
+
+
+    def optimize_geometry(self, target_size=4., min_size=1., max_size=16.,
+                          automatic=False):
+        """
+            Choose the records per buffer, the buffers per acquisition and
+            the number of allocated DMA buffers so that a buffer holds about
+            target_size MB, see the BufferGeometry module.
+            The buffers stay aligned on the sequences and the requested
+            averaging is kept when possible, otherwise it is rounded up as
+            little as possible.
+
+            Input:
+                - target_size (float): preferred size of a buffer in MB
+                - min_size, max_size (float): range of the size of a buffer
+                  in MB
+                - automatic (bool): if True, the geometry is chosen again
+                  each time the acquisition time, the averaging, the number
+                  of sequence or the mode is set. Hand set records per buffer
+                  are then overwritten until optimize_geometry is called
+                  with automatic False.
+
+            Output:
+                - geometry (dict): the chosen geometry, see
+                  BufferGeometry.optimal_geometry
+        """
+
+        options = {'target_bytes' : int(target_size*1024**2),
+                   'min_bytes'    : int(min_size*1024**2),
+                   'max_bytes'    : int(max_size*1024**2)}
+
+        if automatic:
+            self._geometry_options = options
+        else:
+            self._geometry_options = None
+
+        return self._apply_geometry(options)
+
+
+
+    def _update_geometry(self):
+        """
+            Choose the geometry again if it is chosen automatically.
+        """
+
+        if self._geometry_options is not None:
+            self._apply_geometry(self._geometry_options)
+
+
+
+    def _apply_geometry(self, options):
+        """
+            Set the geometry given by BufferGeometry.optimal_geometry.
+        """
+
+        if self.mode == 'CHANNEL_AB':
+            nb_channels = 2
+        else:
+            nb_channels = 1
+
+        # 2 bytes per sample, in FFT mode the record is the padded one
+        record_bytes = 2*nb_channels*self._slot_size()//self.records_per_buffer
+
+        # The board transfers 32 bits sums with the on-board averaging
+        if self.hardware_averaging > 1:
+            record_bytes *= 2
+
+        geometry = optimal_geometry(record_bytes, self.nb_sequence,
+                                    self._host_averaging(), **options)
+
+        self.records_per_buffer      = geometry['records_per_buffer']
+        self.buffers_per_acquisition = geometry['buffers_per_acquisition']
+        self.nb_buffer_allocated     = geometry['nb_buffer_allocated']
+
+        logging.info(__name__ + ' : %d records per buffer of %.2f MB, ' %\
+                     (geometry['records_per_buffer'],
+                      geometry['buffer_bytes']/1024.**2)\
+                     + '%d buffers per acquisition, ' % geometry['buffers_per_acquisition']\
+                     + '%d buffers allocated, ' % geometry['nb_buffer_allocated']\
+                     + 'averaging %d' % geometry['nb_averaging'])
+
+        return geometry
+
+
+
     #########################################################################
     #
     #
@@ -291,104 +792,407 @@ class ATS9360_NPT(Instrument):
 
 
 
-    def measurement_initialization(self, processor):
+    def _slot_size(self):
+        """
+            Number of samples of one channel in a DMA buffer, used as the
+            size of the slots of the shared memory transfer.
+        """
+
+        # In FFT mode, the record length is only known once the FFT module
+        # is configured, we allocate slots for the padded record.
+        if self.mode == 'FFT':
+            samples_per_record = 1
+            while samples_per_record < self.samplesPerRecord:
+                samples_per_record *= 2
+        else:
+            samples_per_record = self.samplesPerRecord
+
+        return samples_per_record*self.records_per_buffer
+
+
+
+    def _nb_channels(self):
+        """
+            Number of channels treated, those of all the boards.
+        """
+
+        if self.mode == 'CHANNEL_AB':
+            # In case operation mode is 'CHANNEL_AB',
+            # two channels are treated
+            nb_channels = 2
+        elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
+            # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
+            # only one channel is treated
+            nb_channels = 1
+        else:
+            raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
+                             "CHANNEL_A" or "CHANNEL_B" or "FFT"')
+
+        return nb_channels*self.nb_boards
+
+
+
+    def _data_queue(self):
+        """
+            Create the memory buffer transferring the data of one channel from
+            the acquisition process to the treatment process.
+        """
+
+        if self.transfer == 'queue':
+
+            return mp.Queue()
+        elif self.transfer == 'shared_memory':
+
+            return RingBuffer(self.nb_shared_slots, self._slot_size())
+        else:
+
+            raise ValueError('transfer must be "queue" or "shared_memory"')
+
+
+
+    def _result_size(self):
+        """
+            Size in bytes of the mailboxes receiving the results.
+            By default, room for two float64 arrays of the size of a sequence,
+            or for the results of the processor if it declares them larger,
+            see DataTreatment.result_bytes.
+        """
+
+        if self.result_size is not None:
+            return int(self.result_size)
+
+        samples_per_record = self._slot_size()//self.records_per_buffer
+
+        size = 16*self.nb_sequence*samples_per_record + 65536
+
+        if self._processor_result_bytes is not None:
+            size = max(size, self._processor_result_bytes + 65536)
+
+        return size
+
+
+
+    def _treatment_queue(self):
+        """
+            Create the memory buffer transferring the results of a treatment
+            process to the instrument.
+        """
+
+        if self.result == 'queue':
+
+            return mp.Queue()
+        elif self.result == 'latest':
+
+            return Mailbox(self._result_size())
+        else:
+
+            raise ValueError('result must be "queue" or "latest"')
+
+
+
+    def _check_workers(self, processor, nb_workers):
+        """
+            Check that the processor can be used by nb_workers treatment
+            processes per channel.
+        """
+
+        if nb_workers < 1:
+            raise ValueError('The number of treatment processes must be '\
+                             'larger than 1')
+
+        if nb_workers > 1:
+
+            if processor.reduction is None:
+                raise ValueError('The results of '+type(processor).__name__\
+                                 +' cannot be merged, only one treatment '\
+                                 +'process can be used')
+
+            if self.records_per_buffer % self.nb_sequence:
+                raise ValueError('With several treatment processes, the '\
+                                 +'number of records per buffer must be a '\
+                                 +'multiple of the number of sequence')
+
+
+
+    def _create_processes(self, nb_workers, treatment_target, treatment_args,
+                          acquisition_target, acquisition_args):
+        """
+            Create the memory buffers, the control block and the processes of
+            a measurement or of a session.
+            Each channel is treated by nb_workers processes, see the
+            TreatmentPool module.
+
+            Input:
+                - nb_workers (int): number of treatment processes per channel
+                - treatment_target (function): target of the treatment
+                  processes
+                - treatment_args (function): return the arguments of a
+                  treatment process from its data queue, its treatment queue
+                  and its index in the control block
+                - acquisition_target (function): target of the acquisition
+                  process
+                - acquisition_args (function): return the arguments of the
+                  acquisition process from its data queue(s)
+        """
+
+        nb_channels = self._nb_channels()
+
+        # Events and status shared with the processes
+        self.control = ControlBlock(nb_channels*nb_workers)
+
+        # We create shared memory to share data between processes.
+        # For each channel, one data queue and one treatment queue per
+        # treatment process.
+        self._data_queues      = [[self._data_queue() for worker in range(nb_workers)]
+                                  for channel in range(nb_channels)]
+        self._treatment_queues = [[self._treatment_queue() for worker in range(nb_workers)]
+                                  for channel in range(nb_channels)]
+
+        # We create the data treatment processes
+        self.worker_treat_data = []
+        for channel in range(nb_channels):
+            for worker in range(nb_workers):
+                args = treatment_args(self._data_queues[channel][worker],
+                                      self._treatment_queues[channel][worker],
+                                      channel*nb_workers + worker)
+                self.worker_treat_data.append(mp.Process(target = treatment_target,
+                                                         args   = args))
+
+        # The acquisition process sends the buffers of a channel in turn to
+        # its treatment processes
+        queue_data = []
+        for queues in self._data_queues:
+            if nb_workers == 1:
+                queue_data.append(queues[0])
+            else:
+                queue_data.append(RoundRobinQueue(queues))
+
+        # The acquisition process receives the memory buffer(s) of each
+        # board, see DataAcquisition.acquire
+        channels_per_board = nb_channels//self.nb_boards
+        queue_data = [queue_data[board*channels_per_board:(board + 1)*channels_per_board]
+                      for board in range(self.nb_boards)]
+
+        if channels_per_board == 1:
+            queue_data = [queues[0] for queues in queue_data]
+
+        if self.nb_boards == 1:
+            queue_data = queue_data[0]
+
+        # We create the data acquisition process
+        self.worker_acquire_data = mp.Process(target = acquisition_target,
+                                              args   = acquisition_args(queue_data))
+
+
+
+    def _reduction_queues(self, processor):
+        """
+            Set the queue_treatment attribute from which the results are
+            obtained: for each channel, its treatment queue or, with several
+            treatment processes, a ReductionQueue merging their results.
+            With mailboxes, a ReductionMailbox merges their latest results.
+            The processor gives the returned results from them, see
+            DataTreatment.final_result.
+        """
+
+        self._processor = processor
+
+        # Number of results of a treatment process for each buffer
+        if processor.publish_per_buffer:
+            results_per_buffer = 1
+        else:
+            results_per_buffer = self.records_per_buffer//self.nb_sequence
+
+        queue_treatment = []
+        for queues in self._treatment_queues:
+            if len(queues) == 1:
+                queue_treatment.append(queues[0])
+            elif self.result == 'latest':
+                queue_treatment.append(ReductionMailbox(queues,
+                                                        processor.reduction))
+            else:
+                queue_treatment.append(ReductionQueue(queues,
+                                                      processor.reduction,
+                                                      results_per_buffer))
+
+        # With several channels, one queue per channel
+        if len(queue_treatment) > 1:
+            self.queue_treatment = queue_treatment
+        else:
+            self.queue_treatment = queue_treatment[0]
+
+
+
+    def _close_queues(self):
+        """
+            Close the data and treatment queues in this process.
+        """
+
+        for queues in self._data_queues + self._treatment_queues:
+            for queue in queues:
+                queue.close()
+
+
+
+    def measurement_initialization(self, processor, transfer='queue',
+                                   nb_workers=1, result='queue'):
         """
             Initialize the board and launch a measurement.
 
             Input:
                 - processor (obj instance): Instance of class coming from the
                   file DataTreatment with the class DataTreatment as parent.
+                - transfer (string): How buffers are sent from the acquisition
+                  process to the treatment process.
+                  "queue": each buffer is copied and pickled through a
+                  multiprocessing queue.
+                  "shared_memory": each buffer is copied in a ring of slots in
+                  shared memory and read in place by the treatment process.
+                - nb_workers (int): Number of treatment processes per
+                  channel. With more than one process, the buffers are treated
+                  in turn by the processes and their results are merged, see
+                  the TreatmentPool module. The processor must then define
+                  its reduction and the number of records per buffer must be
+                  a multiple of the number of sequence.
+                - result (string): How results are sent from the treatment
+                  processes.
+                  "queue": every result is pickled through a multiprocessing
+                  queue and measurement returns them one after the other.
+                  "latest": each result replaces the previous one in a
+                  Mailbox in shared memory and measurement returns the latest
+                  one every T_display. The size of the mailbox is given by
+                  the result_size attribute, by default it is deduced from
+                  the geometry and from DataTreatment.result_bytes.
+
+            When the processor stops the acquisition once its results
+            converged, see DataTreatment.treat_buffers, or when the transfer
+            overflows, the completed acquisition reaches 100 % with the last
+            treated sequence.
 
             Output:
                 - None
         """
-        if self.mode == 'CHANNEL_AB':
 
-            # In case operation mode is 'CHANNEL_AB',
-            # two data treatment processed are required
+        if transfer not in ('queue', 'shared_memory'):
+            raise ValueError('transfer must be "queue" or "shared_memory"')
 
-            queue_data=[None, None]
-            self.queue_treatment=[None, None]
-            self.worker_treat_data=[None, None]
+        if result not in ('queue', 'latest'):
+            raise ValueError('result must be "queue" or "latest"')
 
-            # We create shared memory to share data between processes
-            queue_data[0]       = mp.Queue() # Contains measured data cha channel
-            queue_data[1]       = mp.Queue() # Contains measured data chb channel
+        if self.footers and self.mode == 'FFT':
+            raise ValueError('The footers cannot be used with the on-FPGA FFT')
 
-            self.queue_treatment[0] = mp.Queue() # Contains treated data
-            self.queue_treatment[1] = mp.Queue() # Contains treated data
+        if self.hardware_averaging > 1 and (self.footers or self.mode == 'FFT'):
+            raise ValueError('The on-board averaging cannot be used with the '\
+                             'on-FPGA FFT or with the footers')
 
-            # Obtain all the parameters to set the board
-            self.parameters      = self._get_parameters()
+        self._check_workers(processor, nb_workers)
 
-            # We create the data treatment process
-            self.worker_treat_data[0] = mp.Process(target = processor.treat_data,
-                                                    args   = (queue_data[0],
-                                                              self.queue_treatment[0],
-                                                              self.parameters))
+        # The mailboxes are sized for the results of the processor, a result
+        # larger than its mailbox would stop the treatment process
+        self._processor_result_bytes = processor.result_bytes(self._get_parameters())
 
-            self.worker_treat_data[1] = mp.Process(target = processor.treat_data,
-                                                    args   = (queue_data[1],
-                                                              self.queue_treatment[1],
-                                                              self.parameters))
+        if result == 'latest' and self._processor_result_bytes is not None\
+           and self._processor_result_bytes > self._result_size():
+            raise ValueError('The results of the processor of %d bytes are '\
+                             'larger than the mailboxes of %d bytes, set '\
+                             'the result_size attribute to None or larger'\
+                             % (self._processor_result_bytes,
+                                self._result_size()))
 
-            # We create the data acquisition process
-            self.worker_acquire_data = mp.Process(target = data_acquisition.get_data,
-                                                  args   = (queue_data,
-                                                            self.parameters))
+        # In a session, the measurement is launched by the running processes
+        if self._session is not None:
 
-            # At this point the process is started
-            # Consequently, the measurement is launched.
-            self.worker_acquire_data.start()
-            self.worker_treat_data[0].start()
-            self.worker_treat_data[1].start()
+            self._session_measurement(processor, transfer, nb_workers, result)
+            return
 
-            # The share memories are not used anymore in this process
-            queue_data[0].close()
-            queue_data[1].close()
+        self.transfer   = transfer
+        self.nb_workers = nb_workers
+        self.result     = result
 
-            # Initialize the number of acquired sequence to zero
-            self._acquired_sequences = 0.
+        # Obtain all the parameters to set the board
+        self.parameters = self._get_parameters()
 
-        elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
+        # We create the data treatment and data acquisition processes
+        self._create_processes(nb_workers,
+                               processor.treat_data,
+                               lambda queue_data, queue_treatment, index:\
+                                   (queue_data, queue_treatment,
+                                    self.parameters, self.control, index),
+                               data_acquisition.get_data,
+                               lambda queue_data:\
+                                   (queue_data, self.parameters, self.control))
 
-            # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
-            # only one data treatment process is required
+        self._reduction_queues(processor)
 
-            # We create shared memory to share data between processes
-            queue_data       = mp.Queue() # Contains measured data cha channel
+        # At this point the process is started
+        # Consequently, the measurement is launched.
+        self.worker_acquire_data.start()
+        for worker in self.worker_treat_data:
+            worker.start()
 
-            self.queue_treatment = mp.Queue() # Contains treated data
+        self._schedule_processes()
 
+        # The share memories are closed with the child processes, see
+        # measurement_close, since the treatment process gives the slots
+        # of a RingBuffer back up to its last buffer.
 
-            # Obtain all the parameters to set the board
-            self.parameters      = self._get_parameters()
+        # Initialize the number of acquired sequence to zero
+        self._acquired_sequences = 0.
+        self._final_nb_results   = None
+        self._result = None
 
-            # We create the data treatment process
-            self.worker_treat_data = mp.Process(target = processor.treat_data,
-                                                    args   = (queue_data,
-                                                              self.queue_treatment,
-                                                              self.parameters))
 
-            # We create the data acquisition process
-            self.worker_acquire_data = mp.Process(target = data_acquisition.get_data,
-                                                  args   = (queue_data,
-                                                            self.parameters))
 
-            # At this point the process is started
-            # Consequently, the measurement is launched.
-            self.worker_acquire_data.start()
-            self.worker_treat_data.start()
+    def sweep_initialization(self, processor, nb_points, records_per_point,
+                             averaging, transfer='queue', nb_workers=1,
+                             result='queue'):
+        """
+            Initialize the board and launch the measurement of a sweep whose
+            points are stepped by the triggers, as a microwave source in
+            STEP sweep mode.
+            The whole sweep is a sequence: the board is armed once and the
+            source goes through its list once per sequence, records_per_point
+            triggers per point. Record r of a sequence belongs to the point
+            r//records_per_point.
+            The processor reduces each sequence to the points of the sweep,
+            as DataTreatment.SweepRealImag, so that measurement returns the
+            points averaged over their records and over the sequences.
 
-            # The share memories are not used anymore in this process
-            queue_data.close()
+            Input:
+                - processor (obj instance): Instance of class coming from the
+                  file DataTreatment with nb_points points.
+                - nb_points (int): number of points of the sweep
+                - records_per_point (int): number of records acquired per
+                  point in a sequence
+                - averaging (int): number of records averaged per point, it
+                  is rounded up to an even number of sequences.
+                - transfer, nb_workers, result: see measurement_initialization
+
+            Output:
+                - None
+        """
+
+        if int(nb_points) < 1 or int(records_per_point) < 1:
+            raise ValueError('The number of points and of records per point '\
+                             'must be larger than 1')
+
+        if getattr(processor, 'nb_sweep', nb_points) != nb_points:
+            raise ValueError('The processor must treat '+str(nb_points)\
+                             +' points')
+
+        # The board repeats the sequence, the averaging is completed to an
+        # even number of them
+        nb_averaging  = -(-int(averaging)//int(records_per_point))
+        nb_averaging += nb_averaging % 2
+
+        self.set_nb_sequence(int(nb_points)*int(records_per_point))
+        self.set_averaging(nb_averaging)
+
+        self.measurement_initialization(processor, transfer, nb_workers,
+                                        result)
 
-            # Initialize the number of acquired sequence to zero
-            self._acquired_sequences = 0
-        else:
 
-            raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                             "CHANNEL_A" or "CHANNEL_B" or "FFT"')
 
     def measurement(self):
         """
@@ -404,31 +1208,158 @@ class ATS9360_NPT(Instrument):
                 - None
         """
 
+        if self.result == 'latest':
+            return self._latest_measurement()
+
         start_meas = time.clock() # Keep track of when the measurement started
 
         while time.clock()-start_meas< self.T_display and self.get_completed_acquisition() != 100.:
             # Each times the treatment buffer memory is loaded means a  new
             # averaging has been treated
 
-            if self.mode == 'CHANNEL_AB':
-                # In case operation mode is 'CHANNEL_AB',
-                # two data treatment processed are required
-                result = self.queue_treatment[0].get(), self.queue_treatment[1].get()
-            elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
+            if isinstance(self.queue_treatment, list):
+                # In case operation mode is 'CHANNEL_AB' or several boards
+                # are used, one result per channel
+                result = tuple(self._get_result(queue)
+                               for queue in self.queue_treatment)
+                if any(channel is None for channel in result):
+                    break
+            else:
                 # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
                 # only one data treatment process is required
-                result = self.queue_treatment.get()
-            else:
-                raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
-                                 "CHANNEL_A" or "CHANNEL_B" or "FFT"')
+                result = self._get_result(self.queue_treatment)
+                if result is None:
+                    break
 
+            self._result = result
             self._acquired_sequences += 1.
 
-        # We update the percentage of the measurement
+        # We update the percentage of the measurement and the counters
         self.get_completed_acquisition()
+        self.get_counters()
 
         # We return the data of the buffer memory
-        return result
+        return self._final_result(self._result)
+
+
+
+    def _final_result(self, result):
+        """
+            Return the result given by the processor from the last result of
+            each channel, see DataTreatment.final_result.
+        """
+
+        if result is None:
+            return None
+
+        if isinstance(self.queue_treatment, list):
+            return tuple(self._processor.final_result(channel)
+                         for channel in result)
+        else:
+            return self._processor.final_result(result)
+
+
+
+    def _get_result(self, queue):
+        """
+            Return the next result of a treatment queue.
+            When the acquisition stops early, the parent process may have
+            read the last result before knowing it is the last one: the
+            queue is polled and None is returned once all the results have
+            been read.
+            Raise RuntimeError if a process stopped before its last result.
+        """
+
+        while True:
+            try:
+                return queue.get(True, 0.1)
+            except Queue.Empty:
+                if self.get_completed_acquisition() == 100.:
+                    return None
+                self._check_processes()
+
+
+
+    def _latest_measurement(self):
+        """
+            Return the latest results of the mailboxes after T_display, or
+            before if the measurement is completed.
+            Wait for the first result of each channel.
+            Raise RuntimeError if a process stopped or if neither buffers
+            nor results came for close_timeout.
+        """
+
+        if isinstance(self.queue_treatment, list):
+            mailboxes = self.queue_treatment
+        else:
+            mailboxes = [self.queue_treatment]
+
+        start_meas = time.time()
+        progress   = None
+
+        # Only the number of results is read while waiting
+        while True:
+
+            # Each result means a new averaging has been treated
+            self._acquired_sequences = float(min(mailbox.count()
+                                                 for mailbox in mailboxes))
+
+            if self._acquired_sequences > 0\
+               and (time.time() - start_meas >= self.T_display\
+                    or self.get_completed_acquisition() == 100.):
+                break
+
+            self._check_processes()
+
+            # The waiting is bounded since the last buffer or result, a slow
+            # trigger rate does not stop the measurement
+            state = (self.get_acquired_buffers(), self.get_treated_buffers(),
+                     self._acquired_sequences)
+            if state != progress:
+                progress      = state
+                last_progress = time.time()
+            elif time.time() - last_progress > self.close_timeout:
+                raise RuntimeError('No buffer nor result since %s s, the '\
+                                   'acquisition is stalled' % self.close_timeout)
+
+            time.sleep(1e-3)
+
+        counts, results = zip(*[mailbox.read() for mailbox in mailboxes])
+        self._acquired_sequences = float(min(counts))
+
+        # We update the percentage of the measurement and the counters
+        self.get_completed_acquisition()
+        self.get_counters()
+
+        if isinstance(self.queue_treatment, list):
+            return self._final_result(results)
+        else:
+            return self._final_result(results[0])
+
+
+    def _check_processes(self):
+        """
+            Raise RuntimeError if the acquisition process or a treatment
+            process stopped before the end of the measurement, typically on
+            an exception whose traceback is printed by the process, instead
+            of waiting for its results forever.
+        """
+
+        processes = [('acquisition process', self.worker_acquire_data,
+                      self.control.acquisition_finished)]\
+                    + [('treatment process %d' % index, worker,
+                        self.control.treatment_finished[index])
+                       for index, worker in enumerate(self.worker_treat_data)]
+
+        for name, worker, finished in processes:
+
+            # The processes of a session run until it is closed
+            if not worker.is_alive()\
+               and (self._session is not None or not finished.is_set()):
+                raise RuntimeError('The %s stopped with the exit code %s '\
+                                   'before the end of the measurement, see '\
+                                   'its traceback' % (name, worker.exitcode))
+
 
 
     def measurement_close(self, transfert_info=False):
@@ -444,42 +1375,341 @@ class ATS9360_NPT(Instrument):
                 - transfert_info (str): If requested the transfert info
         """
 
+        # In a session, the processes are kept for the next measurement
+        if self._session is not None:
+
+            return self._session_measurement_close(transfert_info)
+
         # We inform child process that the measurement is finished
-        self.parameters['measuring'] = False
+        self.control.stop.set()
 
-        # While the child process doesn't "close" properly the board and the
-        # data treatment is finished, we wait
-        while not self.parameters['safe_acquisition'] and not all(self.parameters['safe_treatment']):
+        # We wait until the child process "close" properly the board and the
+        # data treatment is finished
+        if not self.control.wait(self.close_timeout):
+            logging.warning(__name__ + ' : the acquisition or the treatment '\
+                            + 'did not finish within %s s, ' % self.close_timeout\
+                            + 'the processes are terminated')
 
-            pass
+        # Once the board is "close" properly, we close the child processes
+        # and the share memory.
+        # The processes are closed first, otherwise the thread feeding the
+        # treatment queue may still write in a closed pipe.
 
-        # Once the board is "close" properly, we close the FIFO memory and
-        # we close the child processes and the share memory
+        self.worker_acquire_data.terminate()
+        for worker in self.worker_treat_data:
+            worker.terminate()
 
-        if self.mode == 'CHANNEL_AB':
-            # In case operation mode is 'CHANNEL_AB',
-            # two data treatment processed are required
-            self.queue_treatment[0].close()
-            self.queue_treatment[1].close()
-            self.worker_acquire_data.terminate()
-            self.worker_treat_data[0].terminate()
-            self.worker_treat_data[1].terminate()
-        elif self.mode in {'CHANNEL_A', 'CHANNEL_B', 'FFT'}:
-            # In case operation mode is 'CHANNEL_A' or 'CHANNEL_B' or 'FFT',
-            # only one data treatment process is required
-            self.queue_treatment.close()
-            self.worker_acquire_data.terminate()
-            self.worker_treat_data.terminate()
-        else:
+        self._close_queues()
+
+        self._acquired_sequences = 0.
+        self.get_completed_acquisition()
+
+        if transfert_info:
+            return self._transfer_info()
+
+
+
+    def _transfer_info(self):
+        """
+            Build the message giving the performance of the acquisition and
+            of the data treatment from the status of the control block.
+        """
+
+        acquisition = self.control.get_acquisition()
+
+        # The buffers of all the boards
+        buffersCompleted   = int(acquisition['measured_buffers'])*self.nb_boards
+        bytesTransferred   = int(acquisition['transferred_bytes'])
+        transferTime_sec   = acquisition['capture_time']
+        recordsCompleted   = self.records_per_buffer*buffersCompleted
+        samplesTransferred = bytesTransferred//2 # 2 bytes per sample
+
+        buffersPerSec = 0
+        bytesPerSec   = 0
+        recordsPerSec = 0
+        samplePerSec  = 0
+        if transferTime_sec > 0:
+            buffersPerSec = buffersCompleted / transferTime_sec
+            bytesPerSec   = bytesTransferred / transferTime_sec
+            recordsPerSec = recordsCompleted / transferTime_sec
+            samplePerSec  = samplesTransferred / transferTime_sec
+
+        message  = 'Attempt to capture %d buffers\n' % (self.buffers_per_acquisition*self.nb_boards)
+        message += 'Capture completed in %f sec\n' % transferTime_sec
+        message += 'Captured %d buffers (%f buffers per sec)\n' % (buffersCompleted, buffersPerSec)
+        message += 'Captured %d records (%f records per sec)\n' % (recordsCompleted, recordsPerSec)
+        message += 'Transferred %d bytes (%f Mbytes per sec)\n' % (bytesTransferred, bytesPerSec/1024**2.)
+        message += 'Transferred %d samples (%f MS per sec)\n' % (samplesTransferred, samplePerSec/1e6)
+
+        diagnostics = self.get_acquisition_diagnostics()
+
+        message += 'Interval between buffers %f sec (jitter %f sec, max %f sec)\n' %\
+                   (diagnostics['buffer_interval_mean'],
+                    diagnostics['buffer_interval_std'],
+                    diagnostics['buffer_interval_max'])
+        if diagnostics['overflow']:
+            message += 'WARNING: the transfer stopped on a DMA overflow of '\
+                       'the board(s) %s\n'\
+                       % ', '.join(str(board) for board
+                                   in diagnostics['overflow_boards'])
+        if diagnostics['dropped_records']:
+            message += 'WARNING: %d records lost\n' % diagnostics['dropped_records']
+        if diagnostics['missed_triggers']:
+            message += 'WARNING: %d triggers missed\n' % diagnostics['missed_triggers']
+
+        for channel in range(self.control.nb_treatments):
+
+            treatment = self.control.get_treatment(channel)
+
+            elapsed_time     = treatment['treatment_time']
+            acquired_samples = int(treatment['treated_samples'])
+            acquired_bytes   = acquired_samples*2 # 2 bytes per sample
+
+            if elapsed_time > 0:
+                message += 'Treatment completed in %f sec\n' % elapsed_time
+                message += 'Treated %d bytes (%f Mbytes per sec)\n' %\
+                           (acquired_bytes, acquired_bytes/elapsed_time/1024**2)
+                message += 'Treated %d samples (%f Ms per sec)\n' %\
+                           (acquired_samples, acquired_samples/elapsed_time/1e6)
+
+        return message
+
+
+
+    #########################################################################
+    #
+    #
+    #                           Persistent acquisition session
+    #
+    #
+    #########################################################################
+
+
+
+    def session_open(self, transfer='queue', nb_workers=1, result='queue'):
+        """
+            Launch an acquisition process and treatment processes which stay
+            alive between measurements.
+            While the session is open, measurement_initialization only sends
+            the parameters and the processor to these processes: the board is
+            not instanced again, only the changed parameters are applied, the
+            DMA buffers are reused if the geometry of the acquisition does
+            not change and measurement_close does not terminate the processes.
+            Useful for sweeps where the initialization of the board would
+            otherwise dominate the measurement time.
+
+            The session is opened again automatically if the mode, the
+            number of boards, the transfer, the number of treatment processes, the transfer of the
+            results change or if, with shared memory, the size of the
+            buffers or, with mailboxes, the size of the results increases.
+
+            Input:
+                - transfer (string): How buffers are sent from the acquisition
+                  process to the treatment process, see
+                  measurement_initialization.
+                - nb_workers (int): Number of treatment processes per
+                  channel, see measurement_initialization.
+                - result (string): How results are sent from the treatment
+                  processes, see measurement_initialization.
+
+            Output:
+                - None
+        """
+
+        if transfer not in ('queue', 'shared_memory'):
+            raise ValueError('transfer must be "queue" or "shared_memory"')
+
+        if result not in ('queue', 'latest'):
+            raise ValueError('result must be "queue" or "latest"')
+
+        if self.mode not in self.allow_modes:
             raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
                              "CHANNEL_A" or "CHANNEL_B" or "FFT"')
 
+        if nb_workers < 1:
+            raise ValueError('The number of treatment processes must be '\
+                             'larger than 1')
+
+        if self._session is not None:
+            self.session_close()
+
+        self.transfer   = transfer
+        self.nb_workers = nb_workers
+        self.result     = result
+
+        nb_treatments = self._nb_channels()*nb_workers
+
+        # We create shared memory to send the commands to the processes
+        queue_command_treat = [mp.Queue() for i in range(nb_treatments)]
+        queue_command_acq   = mp.Queue()
+
+        # We create the data treatment and data acquisition processes
+        self._create_processes(nb_workers,
+                               DataTreatment.run_session,
+                               lambda queue_data, queue_treatment, index:\
+                                   (queue_data, queue_treatment,
+                                    queue_command_treat[index],
+                                    self.control, index),
+                               data_acquisition.run_session,
+                               lambda queue_data:\
+                                   (queue_data, queue_command_acq, self.control))
+
+        # The processes are terminated with the interpreter if the session is
+        # not closed
+        self.worker_acquire_data.daemon = True
+        for worker in self.worker_treat_data:
+            worker.daemon = True
+
+        self.worker_acquire_data.start()
+        for worker in self.worker_treat_data:
+            worker.start()
+
+        self._schedule_processes()
+
+        self._session = {'mode'                : self.mode,
+                         'nb_boards'           : self.nb_boards,
+                         'transfer'            : transfer,
+                         'nb_workers'          : nb_workers,
+                         'slot_size'           : self._slot_size(),
+                         'result'              : result,
+                         'result_size'         : self._result_size(),
+                         'queue_command_acq'   : queue_command_acq,
+                         'queue_command_treat' : queue_command_treat,
+                         'measuring'           : False}
+
+
+
+    def session_close(self):
+        """
+            Close the session opened by session_open.
+            A running measurement is closed first.
+
+            Input:
+                - None
+
+            Output:
+                - None
+        """
+
+        if self._session is None:
+            return
+
+        if self._session['measuring']:
+            self.measurement_close()
+
+        # The session may have been closed by measurement_close
+        if self._session is None:
+            return
+
+        session       = self._session
+        self._session = None
+
+        # We ask the processes to finish and wait for them
+        session['queue_command_acq'].put(None)
+        for queue in session['queue_command_treat']:
+            queue.put(None)
+
+        deadline = time.time() + self.close_timeout
+        for worker in [self.worker_acquire_data] + self.worker_treat_data:
+            worker.join(max(deadline - time.time(), 0.))
+            if worker.is_alive():
+                worker.terminate()
+
+        self._close_queues()
+        for queue in session['queue_command_treat']\
+                     + [session['queue_command_acq']]:
+            queue.close()
+
+
+
+    def _session_measurement(self, processor, transfer, nb_workers, result):
+        """
+            Launch a measurement in the opened session.
+        """
+
+        # A running measurement is closed first
+        if self._session['measuring']:
+            self.measurement_close()
+
+        # The session is opened again if its processes cannot perform the
+        # measurement
+        if self._session is None\
+           or self._session['mode'] != self.mode\
+           or self._session['nb_boards'] != self.nb_boards\
+           or self._session['transfer'] != transfer\
+           or self._session['nb_workers'] != nb_workers\
+           or self._session['result'] != result\
+           or (transfer == 'shared_memory'\
+               and self._session['slot_size'] < self._slot_size())\
+           or (result == 'latest'\
+               and self._session['result_size'] < self._result_size()):
+            self.session_open(transfer, nb_workers, result)
+
+        # Obtain all the parameters to set the board
+        self.parameters = self._get_parameters()
+
+        # The events and the results of the previous measurement are
+        # cleared before the processes receive the new one
+        self.control.clear()
+        if result == 'latest':
+            for mailboxes in self._treatment_queues:
+                for mailbox in mailboxes:
+                    mailbox.clear()
+
+        # The results of the processes are merged from the first sequence
+        self._reduction_queues(processor)
+
+        for queue in self._session['queue_command_treat']:
+            queue.put((processor, self.parameters))
+        self._session['queue_command_acq'].put(self.parameters)
+
+        self._session['measuring'] = True
+
+        # Initialize the number of acquired sequence to zero
+        self._acquired_sequences = 0.
+        self._final_nb_results   = None
+        self._result = None
+
+
+
+    def _session_measurement_close(self, transfert_info):
+        """
+            Finish the measurement of the session without closing the
+            processes.
+        """
+
+        if self._session['measuring']:
+
+            # We inform child process that the measurement is finished
+            self.control.stop.set()
+
+            # We wait until the acquisition and the treatment are finished and
+            # we empty the treatment queues up to the end of the measurement.
+            # The mailboxes are cleared by the next measurement.
+            finished = self.control.wait(self.close_timeout)
+            try:
+                for queues in self._treatment_queues:
+                    for queue in queues:
+                        while finished and self.result == 'queue'\
+                              and queue.get(timeout=self.close_timeout) is not None:
+                            pass
+            except Queue.Empty:
+                finished = False
+
+            self._session['measuring'] = False
+
+            # If the processes are stuck, the session is closed
+            if not finished:
+                logging.warning(__name__ + ' : the acquisition or the treatment '\
+                                + 'did not finish within %s s, ' % self.close_timeout\
+                                + 'the session is closed')
+                self.session_close()
 
         self._acquired_sequences = 0.
         self.get_completed_acquisition()
 
         if transfert_info:
-            return self.parameters['message']
+            return self._transfer_info()
 
 
 
@@ -523,6 +1753,8 @@ class ATS9360_NPT(Instrument):
             self.samplesPerRecord = int(round(samplesPerRecord/128)*128)
             self.acquisition_time = self.samplesPerRecord/self.samplerate*1e3
 
+            self._update_geometry()
+
             # To display the new value of acquired sample of get it
             # self.get_samplesPerRecord()
         else:
@@ -565,7 +1797,14 @@ class ATS9360_NPT(Instrument):
         if nb_averaging%2:
             raise ValueError('The number of averaging should be even')
 
-        if nb_averaging*self.nb_sequence < self.default_records_per_buffer:
+        self.averaging = int(nb_averaging)
+
+        # Part of the averaging done by the host
+        nb_averaging = self._host_averaging()
+
+        if self._geometry_options is not None:
+            self._update_geometry()
+        elif nb_averaging*self.nb_sequence < self.default_records_per_buffer:
             self.buffers_per_acquisition = 1
             self.records_per_buffer      = int(nb_averaging*self.nb_sequence)
         else:
@@ -591,7 +1830,8 @@ class ATS9360_NPT(Instrument):
                 - number_of_averaging (int): number of averaging
         '''
 
-        return self.buffers_per_acquisition*self.records_per_buffer/self.nb_sequence
+        return self.buffers_per_acquisition*self.records_per_buffer\
+               *self.hardware_averaging/self.nb_sequence
 
 
     def do_set_nb_sequence(self, nb_sequence, output=False):
@@ -615,6 +1855,8 @@ class ATS9360_NPT(Instrument):
             self.records_per_buffer         = self.default_records_per_buffer
             self.nb_sequence = int(nb_sequence)
 
+        self._update_geometry()
+
         if output:
             m  = 'buffer per acquisition:', self.buffers_per_acquisition
             m += 'records per buffer:', self.records_per_buffer
@@ -976,7 +2218,180 @@ class ATS9360_NPT(Instrument):
         """
 
 
-        return round(self._acquired_sequences*100./self.get_averaging(), 2)
+        return round(self._acquired_sequences*100./self._nb_results(), 2)
+
+
+
+    def _nb_results(self):
+        """
+            Return the number of results per channel of the measurement: one
+            per sequence, or one per buffer for the processors publishing per
+            buffer, see DataTreatment.publish_per_buffer.
+            When the acquisition stopped early, because the results of the
+            treatment processes converged or because the transfer overflowed,
+            the buffers already acquired are treated and the number of
+            results is known once they are finished.
+            Until then, the requested number is returned: the parameter
+            getters never wait for the processes.
+        """
+
+        if self._final_nb_results is not None:
+            return self._final_nb_results
+
+        if self._processor is not None and self._processor.publish_per_buffer:
+            requested = self.buffers_per_acquisition
+            treated   = 'treated_buffers'
+        else:
+            requested = self.get_averaging()//self.hardware_averaging
+            treated   = 'treated_sequences'
+
+        # The records averaged by the board give a single result
+        if self.control is None:
+            return requested
+
+        overflow = self.control.acquisition_finished.is_set()\
+                   and self.control.get_acquisition()['overflow']
+
+        if not (self.control.converged.is_set() or overflow)\
+           or not self.control.finished():
+            return requested
+
+        nb_results = sum(self.control.get_treatment(channel)[treated]
+                         for channel in range(self.control.nb_treatments))
+
+        # The status does not change anymore
+        self._final_nb_results = max(nb_results/len(self._treatment_queues), 1.)
+
+        return self._final_nb_results
+
+
+    #########################################################################
+    #
+    #
+    #                           Performance counters
+    #
+    #
+    #########################################################################
+
+    # The counters are read in the control block of the measurement while it
+    # runs. When the wait time is close to the time between buffers given by
+    # the trigger rate and the queue depth stays low, the measurement is
+    # acquisition-bound. When the queue depth grows, the treatment is too
+    # slow: records_per_buffer should be increased to amortize the overhead
+    # of each buffer, or the number of treatment processes.
+
+
+
+    def get_counters(self):
+        """
+            Read all the performance counters, updating their parameters.
+
+            Output:
+                - counters (dict): value of each counter parameter
+        """
+
+        return {'acquired_buffers' : self.get_acquired_buffers(),
+                'treated_buffers'  : self.get_treated_buffers(),
+                'queue_depth'      : self.get_queue_depth(),
+                'wait_time'        : self.get_wait_time(),
+                'process_time'     : self.get_process_time()}
+
+
+
+    def _treated_buffers_per_channel(self):
+        """
+            Return the number of buffers treated for each channel by all its
+            treatment processes.
+        """
+
+        nb_channels = len(self._treatment_queues)
+        nb_workers  = self.control.nb_treatments//nb_channels
+
+        return [sum(self.control.get_treatment(channel*nb_workers + worker)['treated_buffers']
+                    for worker in range(nb_workers))
+                for channel in range(nb_channels)]
+
+
+
+    def do_get_acquired_buffers(self):
+        """
+            Return the number of buffers acquired since the beginning of the
+            measurement.
+        """
+
+        if self.control is None:
+            return 0
+
+        return int(self.control.get_acquisition()['measured_buffers'])
+
+
+
+    def do_get_treated_buffers(self):
+        """
+            Return the number of buffers treated since the beginning of the
+            measurement, for the slowest channel.
+        """
+
+        if self.control is None:
+            return 0
+
+        return int(min(self._treated_buffers_per_channel()))
+
+
+
+    def do_get_queue_depth(self):
+        """
+            Return the number of buffers acquired but not yet treated, for
+            the slowest channel.
+        """
+
+        if self.control is None:
+            return 0
+
+        return int(self.control.get_acquisition()['measured_buffers']\
+                   - min(self._treated_buffers_per_channel()))
+
+
+
+    def do_get_wait_time(self):
+        """
+            Return the mean time, in ms, the acquisition process waited for a
+            buffer to be filled by the board.
+        """
+
+        if self.control is None:
+            return 0.
+
+        acquisition = self.control.get_acquisition()
+
+        if acquisition['measured_buffers'] == 0:
+            return 0.
+
+        return 1e3*acquisition['wait_time']/acquisition['measured_buffers']
+
+
+
+    def do_get_process_time(self):
+        """
+            Return the mean time, in ms, a treatment process spent to treat a
+            buffer.
+        """
+
+        if self.control is None:
+            return 0.
+
+        treatments = [self.control.get_treatment(channel)
+                      for channel in range(self.control.nb_treatments)]
+
+        treated_buffers = sum(treatment['treated_buffers']
+                              for treatment in treatments)
+
+        if treated_buffers == 0:
+            return 0.
+
+        return 1e3*sum(treatment['process_time'] for treatment in treatments)\
+               /treated_buffers
+
 
 
     #########################################################################
@@ -1000,6 +2415,7 @@ class ATS9360_NPT(Instrument):
         if mode in self.allow_modes:
 
             self.mode = mode
+            self._update_geometry()
         else:
 
             raise ValueError('mode of the digitizer must be "CHANNEL_AB" or \
@@ -1063,7 +1063,7 @@ class virtual_pulsing_instrument(Instrument):
     #  Functions
     ############################################################################
     def prep_onetone(self, freq_vec, average, power, acq_time=500,
-            pulse_time=500, delta_t=0.):
+            pulse_time=500, delta_t=0., sweep=False):
         '''
         Preparing the instruments for a onetone pulses sequence. This function do not
         write in the awg memory.
@@ -1073,7 +1073,12 @@ class virtual_pulsing_instrument(Instrument):
             power: power at the awg output
             pulse_time in ns
             delta_t in ns
+            sweep (bool): heterodyne only, the pulses of each frequency are
+            averaged by the board treatment and the measurement returns one
+            real and imaginary part per frequency
         '''
+        if sweep and self.do_get_measurement_type() != 'heterodyne':
+            raise ValueError('The sweep is only available for the heterodyne measurement')
 
         # Setting the mw1 on the sweeping mode
         self._microwave_generator1.set_freqsweep('on')
@@ -1105,6 +1110,13 @@ class virtual_pulsing_instrument(Instrument):
         # Setting the measurement process
         if self.do_get_measurement_type() == 'homodyne':
             processus = dt.HomodyneRealImagPerSequence(pulse_time*1e-9, self._board.get_samplerate()*1e6, delta_t*1e-9)
+        elif sweep:
+            if self._acquisition:
+                processus = dt.SweepRealImag(self._board.get_acquisition_time()*1e-9, self._board.get_samplerate()*1e6,
+                              self.get_down_converted_frequency()*1e9, len(freq_vec))
+            else:
+                processus = dt.SweepRealImag(self._board.get_acquisition_time()*1e-9, self._board.get_samplerate()*1e6,
+                              self.get_down_converted_frequency()*1e9, len(freq_vec), t_ro=self.get_temp_length_firsttone())
         elif self.do_get_measurement_type() == 'heterodyne':
             if self._acquisition:
                 processus = dt.RealImagPerSequence(self._board.get_acquisition_time()*1e-9, self._board.get_samplerate()*1e6,
@@ -1113,7 +1125,12 @@ class virtual_pulsing_instrument(Instrument):
                 processus = dt.RealImagPerSequence(self._board.get_acquisition_time()*1e-9, self._board.get_samplerate()*1e6,
                               self.get_down_converted_frequency()*1e9, t_ro=self.get_temp_length_firsttone())
 
-        self._board.measurement_initialization(processor=processus)
+        if sweep:
+            # The board is armed once for the whole frequency list
+            self._board.sweep_initialization(processus, len(freq_vec),
+                                             self.get_pulsenumber_averaging(), average)
+        else:
+            self._board.measurement_initialization(processor=processus)
 
     def prep_twotone(self, cwf, freq_vec, average, power_tone1, power_tone2,
             acq_time=500, pulse_time=500, delta_t=0):